@@ -0,0 +1,232 @@
+"""
+Optional processing of the dub inside the merge's own FFmpeg pass.
+
+AudioPrep describes what to do to the audio before it is muxed: EBU R128
+loudness normalization, resampling, and a delay that is either fixed or
+found by matching the dub against the video's original audio.
+prepare_plan() turns it into one filter chain per audio input of the merge
+command, so no intermediate audio file is written.
+
+Loudness is normalized in two passes: a quick audio-only pass measures the
+dub, and the merge then applies linear normalization with those numbers,
+which keeps the dynamics intact where one-pass loudnorm would compress.
+
+Auto-sync decodes a window from the middle of both tracks to mono PCM at
+SYNC_SAMPLE_RATE (straight from FFmpeg's stdout) and takes the peak of
+their normalized cross-correlation, computed with NumPy FFTs, so a
+full-length episode costs a couple of seconds. Without numpy it is skipped.
+"""
+import json
+import logging
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:  # only auto-sync needs it
+    np = None
+
+from config import (LOUDNORM_TARGET_I, LOUDNORM_TARGET_TP, LOUDNORM_TARGET_LRA, SYNC_WINDOW, SYNC_MAX_OFFSET,
+                    SYNC_SAMPLE_RATE, SYNC_MIN_CORRELATION)
+from probe import probe
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Sample rates the output may be resampled to
+SAMPLE_RATES = (22050, 32000, 44100, 48000, 96000)
+# Largest fixed delay accepted, either way
+MAX_DELAY = 60.0  # seconds
+# Shortest window worth correlating
+MIN_SYNC_WINDOW = 5.0  # seconds
+# loudnorm works at 192kHz internally; its output is resampled to the input's
+# rate, or to this when that isn't known
+DEFAULT_SAMPLE_RATE = 48000
+ANALYSIS_TIMEOUT = 10 * 60  # seconds
+
+
+class AudioPrep:
+    """Audio processing requested for a merge
+
+    delay is in seconds; a negative delay trims the start of the dub. With
+    auto_sync the delay found by analysis replaces it, if one is found.
+    Raises ValueError for a sample rate or delay out of range.
+    """
+
+    __slots__ = ("loudnorm", "sample_rate", "delay", "auto_sync")
+
+    def __init__(self, loudnorm=False, sample_rate=None, delay=0.0, auto_sync=False):
+        self.loudnorm = bool(loudnorm)
+        self.sample_rate = int(sample_rate) if sample_rate else None
+        self.delay = float(delay or 0.0)
+        self.auto_sync = bool(auto_sync)
+        if self.sample_rate is not None and self.sample_rate not in SAMPLE_RATES:
+            raise ValueError(f"Unsupported sample rate {self.sample_rate}")
+        if not abs(self.delay) <= MAX_DELAY:  # also catches NaN
+            raise ValueError(f"Audio delay must be within {MAX_DELAY:.0f} seconds")
+
+    @property
+    def active(self):
+        return self.loudnorm or self.auto_sync or bool(self.sample_rate) or bool(self.delay)
+
+    def to_dict(self):
+        """Normalized options, as part of the result cache key"""
+        return {
+            "loudnorm": _loudnorm_target() if self.loudnorm else None,
+            "sample_rate": self.sample_rate,
+            "delay": round(self.delay, 3),
+            "auto_sync": [SYNC_WINDOW, SYNC_MAX_OFFSET, SYNC_SAMPLE_RATE] if self.auto_sync else None,
+        }
+
+
+def prepare_plan(plan, video_path, audio_paths):
+    """Set plan.audio_filters for these inputs, running any analysis it needs (once)"""
+    if plan.audio_filters is None:
+        plan.audio_filters = [build_filters(plan.audio_prep, video_path, path) for path in audio_paths]
+    return plan
+
+
+def build_filters(prep, video_path, audio_path):
+    """FFmpeg filter chain applying prep to audio_path ("" for none)"""
+    if prep is None or not prep.active:
+        return ""
+    filters = []
+    delay = prep.delay
+    if prep.auto_sync:
+        with timed("audio_analysis"):
+            detected = detect_offset(video_path, audio_path)
+        if detected is not None:
+            delay = detected
+    if delay > 0:
+        filters.append(f"adelay={round(delay * 1000)}:all=1")
+    elif delay < 0:
+        filters.append(f"atrim=start={-delay:.3f},asetpts=PTS-STARTPTS")
+
+    sample_rate = prep.sample_rate
+    if prep.loudnorm:
+        with timed("audio_analysis"):
+            filters.append(loudnorm_filter(audio_path))
+        if sample_rate is None:
+            info = probe(audio_path)
+            streams = info.audio_streams if info else []
+            sample_rate = (streams[0].sample_rate if streams else None) or DEFAULT_SAMPLE_RATE
+    if sample_rate:
+        # aformat rather than aresample, which fails to negotiate a channel
+        # layout with the native AAC encoder after loudnorm
+        filters.append(f"aformat=sample_rates={sample_rate}")
+    return ",".join(filters)
+
+
+def _loudnorm_target():
+    return f"I={LOUDNORM_TARGET_I}:TP={LOUDNORM_TARGET_TP}:LRA={LOUDNORM_TARGET_LRA}"
+
+
+def loudnorm_filter(audio_path):
+    """Second-pass loudnorm for audio_path, or one-pass if it can't be measured"""
+    measured = measure_loudness(audio_path)
+    if measured is None:
+        return f"loudnorm={_loudnorm_target()}"
+    return (
+        f"loudnorm={_loudnorm_target()}"
+        f":measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+        f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+        f":offset={measured['target_offset']}:linear=true"
+    )
+
+
+def measure_loudness(audio_path):
+    """loudnorm's first-pass measurements of audio_path, or None"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostats", "-i", audio_path, "-map", "0:a:0",
+        "-af", f"loudnorm={_loudnorm_target()}:print_format=json", "-f", "null", "-"
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=ANALYSIS_TIMEOUT)
+        # The measurements are the last JSON object FFmpeg prints
+        output = result.stderr
+        measured = json.loads(output[output.rindex("{"):output.rindex("}") + 1])
+        keys = ("input_i", "input_tp", "input_lra", "input_thresh", "target_offset")
+        # Silence measures as -inf, which the second pass can't use
+        if result.returncode != 0 or not all(_finite(measured.get(key)) for key in keys):
+            logger.warning(f"Could not measure loudness of {audio_path}; using one-pass loudnorm")
+            return None
+        return measured
+    except Exception as e:
+        logger.error(f"Error measuring loudness of {audio_path}: {e}")
+        return None
+
+
+def detect_offset(video_path, audio_path, window=SYNC_WINDOW, max_offset=SYNC_MAX_OFFSET,
+                  sample_rate=SYNC_SAMPLE_RATE):
+    """Seconds to delay audio_path by to line it up with the video's own audio, or None"""
+    if np is None:
+        logger.warning("numpy is not installed; skipping auto-sync")
+        return None
+    video_info, audio_info = probe(video_path), probe(audio_path)
+    if not video_info or not video_info.audio_streams:
+        logger.info(f"{video_path} has no audio track to sync to")
+        return None
+    durations = [info.duration for info in (video_info, audio_info) if info and info.duration]
+    if not durations:
+        return None
+    duration = min(durations)
+    window = min(window, duration - 2 * max_offset)
+    if window < MIN_SYNC_WINDOW:
+        logger.info(f"{audio_path} is too short to auto-sync")
+        return None
+
+    # The middle of the episode: intros and credits are the likeliest to be cut differently
+    start = max(max_offset, (duration - window) / 2)
+    reference = _decode_pcm(video_path, start, window, sample_rate)
+    dub = _decode_pcm(audio_path, start - max_offset, window + 2 * max_offset, sample_rate)
+    if reference is None or dub is None or len(reference) == 0 or len(dub) <= len(reference):
+        return None
+
+    lag, score = best_lag(reference, dub)
+    if score < SYNC_MIN_CORRELATION:
+        logger.info(f"No confident sync for {audio_path} (correlation {score:.2f}); leaving the delay alone")
+        return None
+    # reference[n] lines up with dub[n + lag], i.e. the dub runs lag - max_offset late
+    delay = max_offset - lag / sample_rate
+    logger.info(f"Auto-sync of {audio_path}: delay {delay * 1000:+.0f}ms (correlation {score:.2f})")
+    return delay
+
+
+def best_lag(reference, signal):
+    """Offset of reference within the longer signal, in samples, and its normalized correlation"""
+    reference = reference - reference.mean()
+    signal = signal - signal.mean()
+    n, m = len(reference), len(signal)
+    size = 1 << (n + m - 1).bit_length()
+    # Cross-correlation for every offset at once: corr[k] = sum(reference[i] * signal[i + k])
+    spectrum = np.conj(np.fft.rfft(reference, size)) * np.fft.rfft(signal, size)
+    corr = np.fft.irfft(spectrum, size)[:m - n + 1]
+    # Energy of the stretch of signal under reference at each offset
+    energy = np.concatenate(([0.0], np.cumsum(signal * signal)))
+    window_energy = energy[n:] - energy[:m - n + 1]
+    scores = corr / np.sqrt(np.maximum(window_energy * np.dot(reference, reference), 1e-12))
+    lag = int(np.argmax(scores))
+    return lag, float(scores[lag])
+
+
+def _decode_pcm(path, start, duration, sample_rate):
+    """Mono PCM of the first audio track from start for duration seconds, as floats"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error", "-ss", f"{max(0.0, start):.3f}", "-t", f"{duration:.3f}",
+        "-i", path, "-map", "0:a:0", "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "pipe:1"
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=ANALYSIS_TIMEOUT)
+        if result.returncode != 0:
+            logger.error(f"Error decoding {path} for auto-sync: {result.stderr.decode(errors='replace')}")
+            return None
+        return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float64)
+    except Exception as e:
+        logger.error(f"Error decoding {path} for auto-sync: {e}")
+        return None
+
+
+def _finite(value):
+    try:
+        return abs(float(value)) != float("inf")
+    except (TypeError, ValueError):
+        return False
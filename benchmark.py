@@ -0,0 +1,433 @@
+"""
+Reproducible benchmarks for the merge pipeline.
+
+Synthetic inputs are rendered locally from FFmpeg lavfi sources for every
+combination of duration, resolution, video codec, container and audio codec
+in the chosen matrix, then merged in each mode, either directly through
+MediaProcessor.merge_video_audio ("direct") or through the whole web flow of
+upload, merge and download with Flask's test client ("web").
+
+Every run happens in a fresh Python process inside an empty working directory
+(so temp_files, the session store and the result cache start out empty), and
+records wall time, CPU time, peak RSS and bytes read/written, including the
+FFmpeg children, plus the output size.
+
+    python benchmark.py run --output results.json
+    cp results.json benchmark_baseline.json            # after a known-good build
+    python benchmark.py run --baseline benchmark_baseline.json
+    python benchmark.py compare benchmark_baseline.json results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+
+# Named matrices of input parameters; every combination is one input pair
+MATRICES = {
+    "quick": {
+        "durations": [10],
+        "resolutions": ["640x360", "1280x720"],
+        "video_codecs": ["h264"],
+        "containers": ["mp4"],
+        "audio_codecs": ["aac", "mp3"],
+    },
+    "full": {
+        "durations": [10, 60, 300],
+        "resolutions": ["640x360", "1280x720", "1920x1080"],
+        "video_codecs": ["h264", "hevc", "vp9"],
+        "containers": ["mp4", "mkv"],
+        "audio_codecs": ["aac", "mp3", "opus"],
+    },
+}
+MODES = ["default", "fast"]
+PATHS = ["direct", "web"]
+
+# Encoders for rendering the synthetic inputs
+VIDEO_ENCODERS = {
+    "h264": ["libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"],
+    "hevc": ["libx265", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-tag:v", "hvc1"],
+    "vp9": ["libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-pix_fmt", "yuv420p"],
+}
+AUDIO_ENCODERS = {
+    "aac": ("m4a", ["aac", "-b:a", "128k"]),
+    "mp3": ("mp3", ["libmp3lame", "-b:a", "128k"]),
+    "opus": ("ogg", ["libopus", "-b:a", "96k"]),
+}
+
+METRICS = ["wall_s", "cpu_s", "peak_rss_bytes", "read_bytes", "write_bytes", "output_bytes"]
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def case_id(case):
+    return "{path}-{mode}-{duration}s-{resolution}-{video_codec}.{container}-{audio_codec}".format(**case)
+
+
+def build_cases(matrix, modes=MODES, paths=PATHS):
+    """Every combination of the matrix's inputs with every mode and path"""
+    combinations = itertools.product(
+        paths, modes, matrix["durations"], matrix["resolutions"], matrix["video_codecs"],
+        matrix["containers"], matrix["audio_codecs"]
+    )
+    keys = ("path", "mode", "duration", "resolution", "video_codec", "container", "audio_codec")
+    return [dict(zip(keys, values)) for values in combinations]
+
+
+def make_video(path, duration, resolution, codec, container):
+    """Render a test pattern video (with a tone as its own audio track) if not already there"""
+    if os.path.exists(path):
+        return path
+    tmp_path = f"{path}.tmp.{container}"
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=30",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+        "-t", str(duration), "-c:v", *VIDEO_ENCODERS[codec], "-c:a", "aac", "-b:a", "128k",
+        tmp_path, "-y"
+    ], check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def make_audio(path, duration, codec):
+    """Render a tone in the given codec if not already there"""
+    if os.path.exists(path):
+        return path
+    ext, encoder = AUDIO_ENCODERS[codec]
+    tmp_path = f"{path}.tmp.{ext}"
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "sine=frequency=660:sample_rate=48000",
+        "-t", str(duration), "-c:a", *encoder, tmp_path, "-y"
+    ], check=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def prepare_inputs(case, media_dir):
+    """Paths of the case's synthetic video and audio, rendering them on first use"""
+    os.makedirs(media_dir, exist_ok=True)
+    duration = case["duration"]
+    video_path = os.path.join(
+        media_dir, f"video_{duration}s_{case['resolution']}_{case['video_codec']}.{case['container']}"
+    )
+    ext, _ = AUDIO_ENCODERS[case["audio_codec"]]
+    audio_path = os.path.join(media_dir, f"audio_{duration}s_{case['audio_codec']}.{ext}")
+    return (make_video(video_path, duration, case["resolution"], case["video_codec"], case["container"]),
+            make_audio(audio_path, duration, case["audio_codec"]))
+
+
+def run_case(case, media_dir):
+    """Run one case in a fresh interpreter and working directory; returns its measurements"""
+    video_path, audio_path = prepare_inputs(case, media_dir)
+    env = dict(os.environ, RESULT_CACHE_ENABLED="0", SESSION_STORE="memory")
+    # Use this checkout's encoder profile, if it has one, from the scratch directory
+    env["ENCODER_PROFILE_PATH"] = os.path.abspath(os.getenv("ENCODER_PROFILE_PATH", "encoder_profile.json"))
+    with tempfile.TemporaryDirectory(prefix="merge_benchmark_") as work_dir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "_case", json.dumps(case), video_path, audio_path],
+            cwd=work_dir, env=env, capture_output=True, text=True
+        )
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"exit status {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _read_proc_io():
+    """Bytes this process and its reaped children read and wrote, or None off Linux"""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(func):
+    """Run func() and return (its result, resource usage of this process and its children)"""
+    io_before = _read_proc_io()
+    cpu_before = _cpu_seconds()
+    started = time.perf_counter()
+    result = func()
+    wall = time.perf_counter() - started
+    cpu = _cpu_seconds() - cpu_before
+    io_after = _read_proc_io()
+
+    # ru_maxrss is in KiB on Linux; the children figure is the largest single child
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    usage = {"wall_s": wall, "cpu_s": cpu, "peak_rss_bytes": peak_rss,
+             "read_bytes": None, "write_bytes": None}
+    if io_before and io_after:
+        usage["read_bytes"] = io_after[0] - io_before[0]
+        usage["write_bytes"] = io_after[1] - io_before[1]
+    return result, usage
+
+
+def _merge_direct(case, video_path, audio_path):
+    from media_processor import MediaProcessor
+    from merge_planner import tune_encoder
+    from probe import probe
+
+    fast_mode = case["mode"] == "fast"
+    plan = MediaProcessor.plan_merge(video_path, audio_path, os.path.join("temp_files", "merged.mp4"), fast_mode)
+    tune_encoder(plan, probe(video_path), active_jobs=1)
+    success, error_message = MediaProcessor.merge_video_audio(
+        video_path, audio_path, plan.output_path, fast_mode=fast_mode, plan=plan
+    )
+    if not success:
+        raise RuntimeError(error_message or "Failed to merge files")
+    return os.path.getsize(plan.output_path), {}
+
+
+def _merge_web(case, video_path, audio_path):
+    from main import app
+
+    # send_from_directory resolves relative folders against the app, not the working directory
+    app.config["UPLOAD_FOLDER"] = os.path.abspath(app.config["UPLOAD_FOLDER"])
+    client = app.test_client()
+    stages = {}
+
+    def timed(stage, func):
+        started = time.perf_counter()
+        result = func()
+        stages[stage] = time.perf_counter() - started
+        return result
+
+    def upload(url, field, path):
+        with open(path, "rb") as f:
+            response = client.post(url, data={field: (f, os.path.basename(path))},
+                                   content_type="multipart/form-data")
+        if response.status_code != 302:
+            raise RuntimeError(f"Upload to {url} failed with status {response.status_code}")
+        return response.headers["Location"]
+
+    location = timed("upload_video_s", lambda: upload("/upload_video", "video", video_path))
+    session_id = location.rstrip("/").rsplit("/", 1)[-1]
+    location = timed("upload_audio_s", lambda: upload(f"/upload_audio/{session_id}", "audio", audio_path))
+    if f"/merge/{session_id}" not in location:
+        raise RuntimeError(f"Audio upload was rejected (redirected to {location})")
+
+    def merge():
+        response = client.post(f"/merge/{session_id}",
+                               data={"fast_mode": "on" if case["mode"] == "fast" else "off"})
+        if response.status_code != 202:
+            raise RuntimeError(f"Merge request failed with status {response.status_code}")
+        job_id = response.get_json()["job_id"]
+        while True:
+            status = client.get(f"/job/{job_id}").get_json()
+            if status["status"] == "done":
+                return status["filename"]
+            if status["status"] == "failed":
+                raise RuntimeError(status.get("error") or "Merge failed")
+            time.sleep(0.05)
+
+    filename = timed("merge_s", merge)
+
+    def download():
+        response = client.get(f"/get_file/{filename}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Download failed with status {response.status_code}")
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+        return size
+
+    size = timed("download_s", download)
+    return size, stages
+
+
+def _run_case_here(case_json, video_path, audio_path):
+    """Entry point of the per-case child process; prints its measurements as JSON"""
+    case = json.loads(case_json)
+    runner = _merge_web if case["path"] == "web" else _merge_direct
+    # Import the app before measuring, so start-up cost isn't counted as merge time
+    __import__("main" if case["path"] == "web" else "media_processor")
+    (output_bytes, stages), usage = measure(lambda: runner(case, video_path, audio_path))
+    usage["output_bytes"] = output_bytes
+    print(json.dumps({"metrics": usage, "stages": stages}))
+
+
+def _median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def run_benchmarks(cases, media_dir, repeat=3, log=print):
+    """Run every case repeat times; returns one record per case with median metrics"""
+    records = []
+    for index, case in enumerate(cases):
+        record = {"id": case_id(case), "params": case, "runs": [], "error": None}
+        try:
+            for _ in range(repeat):
+                record["runs"].append(run_case(case, media_dir))
+        except Exception as e:
+            record["error"] = str(e)
+        runs = record["runs"]
+        record["metrics"] = {name: _median([run["metrics"][name] for run in runs]) for name in METRICS}
+        stage_names = sorted({name for run in runs for name in run["stages"]})
+        record["stages"] = {name: _median([run["stages"].get(name) for run in runs]) for name in stage_names}
+        records.append(record)
+
+        if record["error"]:
+            log(f"[{index + 1}/{len(cases)}] {record['id']}: FAILED ({record['error']})")
+        else:
+            metrics = record["metrics"]
+            log(f"[{index + 1}/{len(cases)}] {record['id']}: {metrics['wall_s']:.2f}s wall, "
+                f"{metrics['cpu_s']:.2f}s CPU, {metrics['peak_rss_bytes'] / 2 ** 20:.0f} MiB peak")
+    return records
+
+
+def environment():
+    """Facts about the machine that a comparison should take into account"""
+    try:
+        ffmpeg = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        ffmpeg = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIRECTORY,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "created_at": time.time(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg,
+    }
+
+
+def compare(baseline, results, threshold=0.10):
+    """Report lines comparing results against baseline, and whether anything regressed
+
+    A case regresses when its wall or CPU time grows by more than threshold
+    (a fraction), or when it fails where the baseline didn't.
+    """
+    base_records = {record["id"]: record for record in baseline["results"]}
+    lines = [f"{'case':<58} {'wall':>20} {'cpu':>20} {'peak rss':>10} {'output':>10}"]
+    regressed = False
+
+    def change(old, new):
+        if old is None or new is None:
+            return None
+        return (new - old) / old if old else 0.0
+
+    def cell(old, new, unit_format):
+        delta = change(old, new)
+        if delta is None:
+            return "n/a"
+        return f"{unit_format(old)}->{unit_format(new)} {delta:+.0%}"
+
+    for record in results["results"]:
+        base = base_records.pop(record["id"], None)
+        if base is None:
+            lines.append(f"{record['id']:<58} new case")
+            continue
+        if record["error"]:
+            regressed = regressed or not base["error"]
+            lines.append(f"{record['id']:<58} FAILED: {record['error']}")
+            continue
+        if base["error"]:
+            lines.append(f"{record['id']:<58} fixed (failed in baseline)")
+            continue
+
+        old, new = base["metrics"], record["metrics"]
+        slower = [name for name in ("wall_s", "cpu_s")
+                  if (change(old[name], new[name]) or 0) > threshold]
+        regressed = regressed or bool(slower)
+        lines.append(
+            f"{record['id']:<58} {cell(old['wall_s'], new['wall_s'], _format_seconds):>20} "
+            f"{cell(old['cpu_s'], new['cpu_s'], _format_seconds):>20} "
+            f"{_format_change(change(old['peak_rss_bytes'], new['peak_rss_bytes'])):>10} "
+            f"{_format_change(change(old['output_bytes'], new['output_bytes'])):>10}"
+            + ("  REGRESSION" if slower else "")
+        )
+
+    for case in base_records:
+        lines.append(f"{case:<58} missing from results")
+    return lines, regressed
+
+
+def _format_seconds(value):
+    return f"{value:.2f}s"
+
+
+def _format_change(delta):
+    return "n/a" if delta is None else f"{delta:+.0%}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the merge pipeline on synthetic media")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmark matrix")
+    run.add_argument("--matrix", choices=sorted(MATRICES), default="quick")
+    run.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    run.add_argument("--paths", nargs="+", choices=PATHS, default=PATHS)
+    run.add_argument("--repeat", type=int, default=3, help="runs per case; the median is reported")
+    run.add_argument("--filter", help="only run cases whose id contains this text")
+    run.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "merge_benchmark_media"),
+                     help="where synthetic inputs are rendered and kept between runs")
+    run.add_argument("--output", default="benchmark_results.json")
+    run.add_argument("--baseline", help="results file to compare against")
+    run.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+
+    diff = commands.add_parser("compare", help="compare two results files")
+    diff.add_argument("baseline")
+    diff.add_argument("results")
+    diff.add_argument("--threshold", type=float, default=0.10)
+
+    child = commands.add_parser("_case")
+    child.add_argument("case")
+    child.add_argument("video_path")
+    child.add_argument("audio_path")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "_case":
+        _run_case_here(args.case, args.video_path, args.audio_path)
+        return 0
+
+    if args.command == "run":
+        cases = build_cases(MATRICES[args.matrix], args.modes, args.paths)
+        if args.filter:
+            cases = [case for case in cases if args.filter in case_id(case)]
+        results = {"environment": environment(), "matrix": args.matrix, "repeat": args.repeat,
+                   "results": run_benchmarks(cases, args.media_dir, max(1, args.repeat))}
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {len(cases)} results to {args.output}")
+        if not args.baseline:
+            return 1 if any(record["error"] for record in results["results"]) else 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+
+    if baseline["environment"].get("cpu_count") != results["environment"].get("cpu_count"):
+        print("Warning: baseline was recorded on a machine with a different number of cores")
+    lines, regressed = compare(baseline, results, args.threshold)
+    print("\n".join(lines))
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Content-addressed store of input files under TEMP_DIRECTORY/blobs.
+
+The same source episode or dub track is often sent by many users. Each
+upload or download is hashed (while it streams in where it arrives in
+order) and kept once, as blobs/<digest[:2]>/<digest>; the job's own path is
+a hard link to it. A second copy of a stored file is replaced by a link to
+the first, so it costs no disk.
+
+Links are the reference count: a blob's st_nlink is one for the store plus
+one per job path using it, and storage deletes job paths as usual. A blob
+left with a single link is unused, and goes after BLOB_TTL (its ctime
+changes whenever a link is added or removed) or when the temp directory
+needs the room.
+
+Telegram's file_unique_id of every downloaded file is mapped to its digest
+under blobs/telegram, so a file we already have is linked into place
+without downloading it again.
+
+Blobs are shared, so nothing may write to a job's input path in place:
+replace it (os.replace or unlink first) instead.
+"""
+import os
+import re
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from config import TEMP_DIRECTORY, BLOB_STORE_ENABLED, BLOB_TTL
+from metrics import CACHE_LOOKUPS
+from result_cache import file_digest, link_or_copy, remember_digest
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+INGEST_THREADS = 2
+TELEGRAM_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+
+class BlobStore:
+    """Input files stored once per SHA-256 and hard-linked into jobs"""
+
+    def __init__(self, directory=None, ttl=BLOB_TTL, enabled=BLOB_STORE_ENABLED):
+        self.directory = directory or os.path.join(TEMP_DIRECTORY, "blobs")
+        self.telegram_directory = os.path.join(self.directory, "telegram")
+        self.ttl = ttl
+        self.enabled = enabled
+        self._ingester = None
+        self._ingester_pid = None
+        self._ingester_lock = threading.Lock()
+        Path(self.telegram_directory).mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def save_stream(self, stream, path):
+        """Write a readable binary stream to path, hashing it on the way
+
+        Returns the digest, for ingest() once the file has been accepted.
+        """
+        sha = hashlib.sha256()
+        # A new inode, never a write into a file that may be a shared blob
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: stream.read(COPY_BUFFER_SIZE), b""):
+                    sha.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        return sha.hexdigest()
+
+    def ingest(self, path, digest=None, telegram_id=None):
+        """Store the finished file at path, or link path to the copy already stored
+
+        digest saves hashing the file again if it was hashed while written.
+        Returns the digest, or None if the store is disabled or failed.
+        """
+        if not self.enabled:
+            return None
+        try:
+            digest = digest or file_digest(path)
+            blob = self.blob_path(digest)
+            Path(blob).parent.mkdir(exist_ok=True)
+            try:
+                os.link(path, blob)
+                CACHE_LOOKUPS.inc(cache="blob", result="miss")
+            except FileExistsError:
+                if not os.path.samefile(blob, path):
+                    link_or_copy(blob, path)
+                    logger.info(f"Deduplicated {os.path.basename(path)} (blob {digest[:12]})")
+                CACHE_LOOKUPS.inc(cache="blob", result="hit")
+            remember_digest(path, digest)
+            if telegram_id:
+                self._map_telegram(telegram_id, digest)
+            return digest
+        except Exception as e:
+            logger.error(f"Error storing blob for {path}: {e}")
+            return None
+
+    def ingest_later(self, path):
+        """ingest() on a background thread, for files that weren't hashed while written"""
+        if not self.enabled:
+            return
+        with self._ingester_lock:
+            # Threads do not survive fork(), so each process gets its own pool
+            if self._ingester_pid != os.getpid():
+                self._ingester = ThreadPoolExecutor(max_workers=INGEST_THREADS, thread_name_prefix="ingest")
+                self._ingester_pid = os.getpid()
+            self._ingester.submit(self.ingest, path)
+
+    def fetch(self, digest, path):
+        """Link the blob with this digest to path; returns False if it isn't stored"""
+        if not self.enabled:
+            return False
+        try:
+            link_or_copy(self.blob_path(digest), path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(f"Error linking blob {digest[:12]}: {e}")
+            return False
+        remember_digest(path, digest)
+        return True
+
+    def fetch_telegram(self, file_unique_id, path):
+        """Place a Telegram file we already have at path; returns False if we don't"""
+        if not self.enabled or not file_unique_id or not TELEGRAM_ID_PATTERN.fullmatch(file_unique_id):
+            return False
+        try:
+            with open(os.path.join(self.telegram_directory, file_unique_id)) as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            CACHE_LOOKUPS.inc(cache="telegram_blob", result="miss")
+            return False
+        found = self.fetch(digest, path)
+        CACHE_LOOKUPS.inc(cache="telegram_blob", result="hit" if found else "miss")
+        if found:
+            logger.info(f"Telegram file {file_unique_id} is already stored; skipping the download")
+        return found
+
+    def _map_telegram(self, file_unique_id, digest):
+        if not TELEGRAM_ID_PATTERN.fullmatch(file_unique_id):
+            return
+        mapping = os.path.join(self.telegram_directory, file_unique_id)
+        tmp_path = f"{mapping}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(digest)
+        os.replace(tmp_path, mapping)
+
+    def sweep(self, max_age=None):
+        """Delete blobs no job has linked for max_age seconds (default BLOB_TTL)"""
+        cutoff = time.time() - (self.ttl if max_age is None else max_age)
+        removed = 0
+        try:
+            for prefix in os.scandir(self.directory):
+                if not prefix.is_dir() or prefix.path == self.telegram_directory:
+                    continue
+                for entry in os.scandir(prefix.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    # A job linking it right now keeps its inode; only deduplication is lost
+                    if stat.st_nlink == 1 and stat.st_ctime < cutoff:
+                        _remove(entry.path)
+                        removed += 1
+            if removed:
+                for entry in os.scandir(self.telegram_directory):
+                    try:
+                        with open(entry.path) as f:
+                            digest = f.read().strip()
+                    except FileNotFoundError:
+                        continue
+                    if not os.path.exists(self.blob_path(digest)):
+                        _remove(entry.path)
+                logger.info(f"Removed {removed} unused blob(s)")
+        except OSError as e:
+            logger.error(f"Error sweeping blobs: {e}")
+        return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Shared blob store
+blob_store = BlobStore()
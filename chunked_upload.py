@@ -0,0 +1,312 @@
+"""
+Resumable chunked uploads for the web interface.
+
+An upload is created with its total size, which preallocates the destination
+file. Chunks are then PUT at fixed offsets and written straight into place
+with positioned writes, so memory use per upload is constant no matter how
+big the file is. Upload state lives in a JSON file next to the other uploads,
+so a dropped connection or a restarted worker can pick up where it left off.
+
+Chunk writers hold a shared flock on the destination file. seal_upload()
+takes it exclusively and marks the upload finalized, so once a file has been
+validated (and possibly hard-linked into the blob store) no late chunk can
+change it.
+"""
+import os
+import io
+import json
+import time
+import uuid
+import fcntl
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+from config import TEMP_DIRECTORY, UPLOAD_CHUNK_SIZE, UPLOAD_STREAM_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_STATE_DIRECTORY = os.path.join(TEMP_DIRECTORY, "uploads")
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+
+class UploadError(Exception):
+    """Raised for chunks that don't fit the upload they are sent to
+    
+    status is the HTTP status the web interface answers with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUpload:
+    """State of one resumable upload"""
+
+    def __init__(self, upload_id, kind, original_name, path, size,
+                 chunk_size=UPLOAD_CHUNK_SIZE, session_id=None, received=None, created_at=None,
+                 finalized=False):
+        self.upload_id = upload_id
+        self.kind = kind
+        self.original_name = original_name
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.session_id = session_id
+        self.received = set(received or [])
+        self.created_at = created_at or time.time()
+        self.finalized = finalized
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def missing_chunks(self):
+        return [i for i in range(self.chunk_count) if i not in self.received]
+
+    @property
+    def bytes_received(self):
+        return sum(self._chunk_length(i) for i in self.received)
+
+    @property
+    def contiguous_bytes(self):
+        """Length of the prefix of the file that has fully arrived"""
+        index = 0
+        while index in self.received:
+            index += 1
+        return min(self.size, index * self.chunk_size)
+
+    @property
+    def is_complete(self):
+        return len(self.received) == self.chunk_count
+
+    def _chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def to_dict(self):
+        return {
+            "upload_id": self.upload_id,
+            "kind": self.kind,
+            "original_name": self.original_name,
+            "path": self.path,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "session_id": self.session_id,
+            "received": sorted(self.received),
+            "created_at": self.created_at,
+            "finalized": self.finalized,
+        }
+
+    def status(self):
+        """Public view of the upload for the JS client"""
+        return {
+            "upload_id": self.upload_id,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "bytes_received": self.bytes_received,
+            "missing_chunks": self.missing_chunks,
+            "complete": self.is_complete,
+        }
+
+
+def _state_path(upload_id):
+    return os.path.join(UPLOAD_STATE_DIRECTORY, f"{upload_id}.json")
+
+
+@contextmanager
+def _locked(upload_id):
+    """Serialize state updates for one upload across threads and processes"""
+    Path(UPLOAD_STATE_DIRECTORY).mkdir(parents=True, exist_ok=True)
+    fd = os.open(_state_path(upload_id) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _save(upload):
+    state_path = _state_path(upload.upload_id)
+    tmp_path = f"{state_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(upload.to_dict(), f)
+    os.replace(tmp_path, state_path)
+
+
+def load_upload(upload_id):
+    """Load an upload's state, or None if it doesn't exist"""
+    # Upload ids are uuid hex strings; anything else could escape the directory
+    if not upload_id or not upload_id.isalnum():
+        return None
+    try:
+        with open(_state_path(upload_id)) as f:
+            return ChunkedUpload(**json.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading upload {upload_id}: {e}")
+        return None
+
+
+def create_upload(kind, original_name, path, size, session_id=None, upload_id=None):
+    """Start an upload and preallocate its destination file"""
+    upload = ChunkedUpload(upload_id or uuid.uuid4().hex, kind, original_name, path, size,
+                           session_id=session_id)
+    # A new inode: path may still be a link to a shared blob from an earlier upload
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as f:
+        f.truncate(size)
+    with _locked(upload.upload_id):
+        _save(upload)
+    logger.info(f"Started {kind} upload {upload.upload_id} ({size} bytes)")
+    return upload
+
+
+def write_chunk(upload_id, offset, stream, length):
+    """Copy one chunk from stream into place; returns the updated upload"""
+    upload = load_upload(upload_id)
+    if upload is None:
+        raise UploadError("Unknown upload", status=404)
+    if offset % upload.chunk_size or offset >= upload.size:
+        raise UploadError(f"Invalid chunk offset {offset}")
+    index = offset // upload.chunk_size
+    if length != upload._chunk_length(index):
+        raise UploadError(f"Chunk {index} must be {upload._chunk_length(index)} bytes")
+
+    # Positioned writes let chunks arrive in any order, on any worker.
+    # The file is gone if the upload was rejected while this chunk was on
+    # its way; a finalized upload is caught by the check under the flock.
+    try:
+        fd = os.open(upload.path, os.O_WRONLY)
+    except FileNotFoundError:
+        raise UploadError("Upload no longer exists", status=404)
+    try:
+        # Held until the chunk is recorded; seal_upload() waits for it
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if _sealed(upload_id):
+            raise UploadError("Upload has already been finalized", status=409)
+        try:
+            written = 0
+            while written < length:
+                data = stream.read(min(COPY_BUFFER_SIZE, length - written))
+                if not data:
+                    raise UploadError(f"Chunk {index} ended after {written} bytes")
+                view = memoryview(data)
+                while view:
+                    count = os.pwrite(fd, view, offset + written)
+                    view = view[count:]
+                    written += count
+        except OSError as e:
+            logger.error(f"Error writing chunk {index} of upload {upload_id}: {e}")
+            raise UploadError(f"Could not write chunk {index}", status=409)
+
+        with _locked(upload_id):
+            upload = load_upload(upload_id)
+            if upload is None or upload.finalized:
+                raise UploadError("Upload has already been finalized", status=409)
+            upload.received.add(index)
+            _save(upload)
+    finally:
+        # Closing the file also drops the flock
+        os.close(fd)
+    return upload
+
+
+def _sealed(upload_id):
+    upload = load_upload(upload_id)
+    return upload is None or upload.finalized
+
+
+def seal_upload(upload_id):
+    """Stop taking chunks for a complete upload so its file can be validated
+
+    Waits for chunks still being written. Returns the upload, which is only
+    sealed if it is complete; raises UploadError if it is unknown or was
+    sealed already.
+    """
+    upload = load_upload(upload_id)
+    if upload is None:
+        raise UploadError("Unknown upload", status=404)
+    try:
+        fd = os.open(upload.path, os.O_RDONLY)
+    except FileNotFoundError:
+        raise UploadError("Upload no longer exists", status=404)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with _locked(upload_id):
+            upload = load_upload(upload_id)
+            if upload is None:
+                raise UploadError("Unknown upload", status=404)
+            if upload.finalized:
+                raise UploadError("Upload has already been finalized", status=409)
+            if upload.is_complete:
+                upload.finalized = True
+                _save(upload)
+    finally:
+        os.close(fd)
+    return upload
+
+
+def finish_upload(upload_id):
+    """Forget an upload's state once its file has been accepted or rejected"""
+    for path in (_state_path(upload_id), _state_path(upload_id) + ".lock"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadStreamReader(io.RawIOBase):
+    """Read an upload front to back while its chunks are still arriving
+    
+    read() returns bytes as soon as the contiguous prefix of the file covers
+    them and blocks otherwise, so FFmpeg can consume an upload in flight.
+    """
+
+    def __init__(self, upload, poll_interval=0.5, timeout=UPLOAD_STREAM_TIMEOUT):
+        self.upload_id = upload.upload_id
+        self.path = upload.path
+        self.size = upload.size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._position = 0
+        self._fd = os.open(self.path, os.O_RDONLY)
+
+    def readable(self):
+        return True
+
+    def _available(self):
+        upload = load_upload(self.upload_id)
+        if upload is None:
+            # State is removed on finalize; a rejected upload also loses its file
+            if not os.path.exists(self.path):
+                raise UploadError("Upload was rejected")
+            return self.size
+        return upload.contiguous_bytes
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        waited = 0.0
+        while True:
+            available = self._available() - self._position
+            if available > 0:
+                data = os.pread(self._fd, min(len(buffer), available), self._position)
+                buffer[:len(data)] = data
+                self._position += len(data)
+                return len(data)
+            if waited >= self.timeout:
+                raise UploadError(f"Upload {self.upload_id} stalled")
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
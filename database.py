@@ -1,9 +1,35 @@
+import os
+import uuid
+import socket
 import logging
+from datetime import datetime, timedelta, timezone
 import motor.motor_asyncio
-from config import MONGO_URI, DATABASE_NAME, USERS_COLLECTION, TASKS_COLLECTION
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from config import (MONGO_URI, DATABASE_NAME, USERS_COLLECTION, TASKS_COLLECTION,
+                    TASK_LEASE_SECONDS, TASK_MAX_ATTEMPTS, TASK_RETENTION_SECONDS)
 
 logger = logging.getLogger(__name__)
 
+# Task lifecycle: queued -> downloading -> probing -> merging -> uploading -> done,
+# or failed from any state
+TASK_QUEUED = "queued"
+TASK_DOWNLOADING = "downloading"
+TASK_PROBING = "probing"
+TASK_MERGING = "merging"
+TASK_UPLOADING = "uploading"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+ACTIVE_TASK_STATES = [TASK_QUEUED, TASK_DOWNLOADING, TASK_PROBING, TASK_MERGING, TASK_UPLOADING]
+FINISHED_TASK_STATES = [TASK_DONE, TASK_FAILED]
+
+DEFAULT_SETTINGS = {
+    "rename_file": False,
+    "upload_mode": "default",
+    "loudnorm": False,
+    "auto_sync": False,
+    "keep_original": False,
+}
+
 class Database:
     def __init__(self):
         try:
@@ -11,6 +37,8 @@ class Database:
             self.db = self.client[DATABASE_NAME]
             self.users = self.db[USERS_COLLECTION]
             self.tasks = self.db[TASKS_COLLECTION]
+            # Lease holder name of this process on the tasks it works on
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
             logger.info("MongoDB connection established")
         except Exception as e:
             logger.error(f"MongoDB connection error: {e}")
@@ -19,24 +47,53 @@ class Database:
     async def get_user_settings(self, user_id: int):
         """Get user settings or create default if not exists"""
         try:
-            user = await self.users.find_one({"user_id": user_id})
-            if not user:
-                default_settings = {
-                    "user_id": user_id,
-                    "rename_file": False,
-                    "upload_mode": "default",
-                }
-                await self.users.insert_one(default_settings)
-                return default_settings
-            return user
+            # One atomic upsert, so two processes can't both create the user
+            return await self.users.find_one_and_update(
+                {"user_id": user_id},
+                {"$setOnInsert": dict(DEFAULT_SETTINGS)},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
         except Exception as e:
             logger.error(f"Error getting user settings: {e}")
             # Return default settings in case of error
-            return {
-                "user_id": user_id,
-                "rename_file": False,
-                "upload_mode": "default",
-            }
+            return {"user_id": user_id, **DEFAULT_SETTINGS}
+
+    async def ensure_indexes(self):
+        """Create the indexes the queries below rely on"""
+        try:
+            await self.users.create_index([("user_id", ASCENDING)], unique=True)
+            # get_pending_task
+            await self.tasks.create_index([("user_id", ASCENDING), ("status", ASCENDING), ("_id", DESCENDING)])
+            # claim_next_task, oldest first
+            await self.tasks.create_index([("status", ASCENDING), ("worker_id", ASCENDING), ("created_at", ASCENDING)])
+            # requeue_stale_tasks
+            await self.tasks.create_index([("status", ASCENDING), ("heartbeat_at", ASCENDING)])
+            # Finished tasks are deleted once expires_at passes
+            await self.tasks.create_index("expires_at", expireAfterSeconds=0)
+            return True
+        except Exception as e:
+            logger.error(f"Error creating indexes: {e}")
+            return False
+
+    async def upsert_users(self, updates: dict):
+        """Apply {user_id: {field: value}} to many users in one round trip"""
+        try:
+            requests = [
+                UpdateOne(
+                    {"user_id": user_id},
+                    {"$set": fields,
+                     "$setOnInsert": {k: v for k, v in DEFAULT_SETTINGS.items() if k not in fields}},
+                    upsert=True,
+                )
+                for user_id, fields in updates.items()
+            ]
+            if requests:
+                await self.users.bulk_write(requests, ordered=False)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving user settings: {e}")
+            return False
 
     async def update_user_settings(self, user_id: int, field: str, value):
         """Update specific user setting"""
@@ -50,11 +107,14 @@ class Database:
             logger.error(f"Error updating user settings: {e}")
             return False
 
-    async def create_task(self, user_id: int, task_data: dict):
-        """Create a new task for user"""
+    async def create_task(self, user_id: int, task_data: dict, status: str = TASK_QUEUED):
+        """Create a new task for user, leased to this process"""
         try:
+            now = _utcnow()
             task_data["user_id"] = user_id
-            task_data["status"] = "pending"
+            task_data["status"] = status
+            task_data.update(created_at=now, updated_at=now, heartbeat_at=now,
+                             worker_id=self.worker_id, attempts=1)
             result = await self.tasks.insert_one(task_data)
             return str(result.inserted_id)
         except Exception as e:
@@ -62,9 +122,13 @@ class Database:
             return None
 
     async def update_task(self, task_id: str, update_data: dict):
-        """Update task data"""
+        """Update task data; a finished status starts the task's retention period"""
         try:
             from bson.objectid import ObjectId
+            now = _utcnow()
+            update_data = {**update_data, "updated_at": now}
+            if update_data.get("status") in FINISHED_TASK_STATES:
+                update_data["expires_at"] = now + timedelta(seconds=TASK_RETENTION_SECONDS)
             await self.tasks.update_one(
                 {"_id": ObjectId(task_id)}, 
                 {"$set": update_data}
@@ -84,12 +148,70 @@ class Database:
             return None
 
     async def get_pending_task(self, user_id: int):
-        """Get latest pending task for user"""
+        """Get latest unfinished task for user"""
         try:
             return await self.tasks.find_one(
-                {"user_id": user_id, "status": "pending"},
+                {"user_id": user_id, "status": {"$in": ACTIVE_TASK_STATES}},
                 sort=[("_id", -1)]
             )
         except Exception as e:
             logger.error(f"Error getting pending task: {e}")
             return None
+
+    async def claim_next_task(self):
+        """Atomically take the oldest unclaimed queued task for this process, or None"""
+        try:
+            now = _utcnow()
+            return await self.tasks.find_one_and_update(
+                {"status": TASK_QUEUED, "worker_id": None},
+                {"$set": {"worker_id": self.worker_id, "heartbeat_at": now, "updated_at": now},
+                 "$inc": {"attempts": 1}},
+                sort=[("created_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception as e:
+            logger.error(f"Error claiming task: {e}")
+            return None
+
+    async def heartbeat_tasks(self):
+        """Renew the lease on every unfinished task this process holds"""
+        try:
+            await self.tasks.update_many(
+                {"status": {"$in": ACTIVE_TASK_STATES}, "worker_id": self.worker_id},
+                {"$set": {"heartbeat_at": _utcnow()}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error renewing task leases: {e}")
+            return False
+
+    async def requeue_stale_tasks(self, max_attempts=TASK_MAX_ATTEMPTS):
+        """Re-queue unfinished tasks whose process stopped renewing their lease
+
+        Tasks that have already been tried max_attempts times are failed
+        instead. Returns the number of tasks re-queued.
+        """
+        try:
+            now = _utcnow()
+            stale = {"status": {"$in": ACTIVE_TASK_STATES}, "worker_id": {"$ne": None},
+                     "heartbeat_at": {"$lt": now - timedelta(seconds=TASK_LEASE_SECONDS)}}
+            failed = await self.tasks.update_many(
+                {**stale, "attempts": {"$gte": max_attempts}},
+                {"$set": {"status": TASK_FAILED, "error": f"Interrupted {max_attempts} times",
+                          "updated_at": now, "expires_at": now + timedelta(seconds=TASK_RETENTION_SECONDS)}}
+            )
+            requeued = await self.tasks.update_many(
+                stale,
+                {"$set": {"status": TASK_QUEUED, "worker_id": None, "updated_at": now}}
+            )
+            if failed.modified_count or requeued.modified_count:
+                logger.info(f"Re-queued {requeued.modified_count} interrupted task(s), "
+                            f"gave up on {failed.modified_count}")
+            return requeued.modified_count
+        except Exception as e:
+            logger.error(f"Error re-queueing stale tasks: {e}")
+            return 0
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
@@ -0,0 +1,195 @@
+"""
+Serving merged files to browsers without tying up a Python worker.
+
+send_output() answers conditional (If-None-Match, If-Modified-Since) and
+single byte-range requests, with an ETag that is the file's SHA-256 when its
+job published one (or its size and mtime otherwise), so interrupted
+downloads resume instead of restarting. Files are never hashed here. The body is
+handed to the server's wsgi.file_wrapper, which gunicorn sends with
+os.sendfile(); with DELIVERY_OFFLOAD set, the worker only returns an
+X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd) header and the
+front proxy serves the file itself.
+
+follow_file() streams an output that FFmpeg is still writing, for playing
+fragmented MP4 merges in the browser before they finish.
+"""
+import os
+import time
+import logging
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date, quote_etag
+
+from config import TEMP_DIRECTORY, DELIVERY_OFFLOAD, DELIVERY_INTERNAL_PREFIX
+from result_cache import digest_key
+from session_store import session_store
+from utils import get_mime_type
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024  # 1MB
+FOLLOW_POLL_INTERVAL = 0.5  # seconds
+
+
+def content_etag(path, stat):
+    """SHA-256 shared by the job that wrote path, else one from its size and mtime"""
+    digest = session_store.get('digest', digest_key(path, stat))
+    if digest is None:
+        # Still changes whenever the file is replaced, without reading it
+        digest = f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    return digest
+
+
+def send_output(path, download_name=None, as_attachment=True):
+    """Response serving path, honouring Range and conditional request headers"""
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = content_etag(path, stat)
+    download_name = download_name or os.path.basename(path)
+
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=0, must-revalidate',
+        'Content-Disposition': _content_disposition(download_name, as_attachment),
+    }
+
+    if _not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    byte_range = _requested_range(etag, stat.st_mtime, size)
+    if byte_range == 'unsatisfiable':
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    start, end = byte_range or (0, size)
+    if byte_range:
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    status = 206 if byte_range else 200
+
+    if DELIVERY_OFFLOAD:
+        # The proxy does its own Range handling on the full file
+        headers.pop('Content-Range', None)
+        headers.update(_offload_headers(path))
+        return Response(status=200, headers=headers, mimetype=get_mime_type(path))
+
+    headers['Content-Length'] = str(end - start)
+    if request.method == 'HEAD':
+        return Response(status=status, headers=headers, mimetype=get_mime_type(path))
+    return Response(_file_body(path, start, end), status=status, headers=headers,
+                    mimetype=get_mime_type(path), direct_passthrough=True)
+
+
+def _not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def _requested_range(etag, mtime, size):
+    """(start, end) of the one requested range, None for the whole file, or 'unsatisfiable'"""
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        # Multipart ranges aren't worth supporting for media; send it all
+        return None
+
+    # If-Range: only honour the range if the client's copy is still current
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if if_range.startswith(('"', 'W/')):
+            if if_range.strip('"') != etag:
+                return None
+        else:
+            date = parse_date(if_range)
+            if date is None or int(mtime) > date.timestamp():
+                return None
+
+    bounds = byte_range.range_for_length(size)
+    if bounds is None:
+        return 'unsatisfiable'
+    return bounds
+
+
+def _file_body(path, start, end):
+    """Iterable over bytes start..end of path, zero-copy where the server supports it"""
+    f = open(path, 'rb')
+    f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # gunicorn sends a wrapped file with os.sendfile() from its current offset
+    # and stops at Content-Length, so ranges stay zero-copy there
+    if file_wrapper is not None and request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        return file_wrapper(f, READ_CHUNK_SIZE)
+    return _read_range(f, end - start)
+
+
+def _read_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def follow_file(path, is_finished, not_before=None, poll_interval=FOLLOW_POLL_INTERVAL, timeout=None):
+    """Yield the bytes of path as they are appended until is_finished() and EOF
+    
+    Waits for path to be (re)created at or after not_before, so a stale file
+    from an earlier merge with the same name isn't streamed.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+
+    def waiting():
+        if deadline is not None and time.monotonic() > deadline:
+            logger.error(f"Timed out following {os.path.basename(path)}")
+            return False
+        time.sleep(poll_interval)
+        return True
+
+    while True:
+        try:
+            if not_before is None or os.stat(path).st_mtime >= int(not_before):
+                f = open(path, 'rb')
+                break
+        except FileNotFoundError:
+            pass
+        if is_finished() or not waiting():
+            return
+
+    with f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            # Check before the final read so bytes written just before
+            # the job finished aren't lost
+            if is_finished():
+                yield from iter(lambda: f.read(READ_CHUNK_SIZE), b'')
+                return
+            if not waiting():
+                return
+
+
+def _offload_headers(path):
+    if DELIVERY_OFFLOAD == 'x-accel':
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(TEMP_DIRECTORY))
+        return {'X-Accel-Redirect': f"{DELIVERY_INTERNAL_PREFIX.rstrip('/')}/{relative}"}
+    if DELIVERY_OFFLOAD == 'x-sendfile':
+        return {'X-Sendfile': os.path.abspath(path)}
+    raise ValueError(f"Unknown DELIVERY_OFFLOAD mode: {DELIVERY_OFFLOAD}")
+
+
+def _content_disposition(filename, as_attachment):
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        return f'{disposition}; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"{disposition}; filename*=UTF-8''{quote(filename)}"
@@ -0,0 +1,268 @@
+"""
+Parallel, resumable HTTP downloads of Telegram files and other URLs.
+
+A file is fetched as DOWNLOAD_PART_SIZE byte ranges, DOWNLOAD_CONNECTIONS at
+a time, each written straight to its place in a preallocated partial file
+with os.pwrite(). A JSON sidecar next to the partial file records finished
+parts, so a download interrupted by a crash or restart continues where it
+stopped the next time the same file is requested. Failed requests are
+retried with exponential backoff, continuing from the last byte written.
+The finished file is checked against the expected size before it is moved
+into place.
+
+All downloads share one httpx connection pool, so requests to the same host
+reuse keep-alive connections instead of opening one per file.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import httpx
+
+from config import (
+    TEMP_DIRECTORY, TEMP_FILE_TTL, DOWNLOAD_CONNECTIONS, DOWNLOAD_PART_SIZE, DOWNLOAD_POOL_SIZE,
+    DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 30  # seconds
+# Statuses worth retrying; other errors (e.g. an expired Telegram link) are final
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """A download failed for good"""
+
+
+class _Retry(Exception):
+    """A transient failure of one range request"""
+
+
+def telegram_file_url(file):
+    """Download URL of a telegram.File, with non-ASCII characters escaped"""
+    parts = urlsplit(str(file.file_path))
+    return urlunsplit(parts._replace(path=quote(parts.path)))
+
+
+class Downloader:
+    """Range downloads into TEMP_DIRECTORY over a shared connection pool"""
+
+    def __init__(self, directory=None, connections=DOWNLOAD_CONNECTIONS, part_size=DOWNLOAD_PART_SIZE,
+                 pool_size=DOWNLOAD_POOL_SIZE, retries=DOWNLOAD_RETRIES, timeout=DOWNLOAD_TIMEOUT):
+        self.directory = directory or os.path.join(TEMP_DIRECTORY, ".downloads")
+        self.connections = connections
+        self.part_size = part_size
+        self.pool_size = pool_size
+        self.retries = retries
+        self.timeout = timeout
+        self._client = None
+        self._client_loop = None
+        self._locks = {}
+
+    def _get_client(self):
+        # An AsyncClient belongs to the event loop it was first used on
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            if self._client is None:
+                Path(self.directory).mkdir(parents=True, exist_ok=True)
+                self.sweep()
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=httpx.Timeout(self.timeout),
+                follow_redirects=True,
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def close(self):
+        """Close the pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def download(self, url, path, size=None, key=None):
+        """Download url to path; size is the expected size if known
+
+        key identifies the file for resuming (e.g. a Telegram file_unique_id)
+        and defaults to a hash of the URL.
+        """
+        key = key or hashlib.sha256(url.encode()).hexdigest()
+        # Two requests for the same file take turns on its partial file
+        lock, users = self._locks.get(key, (asyncio.Lock(), 0))
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                return await self._download(url, path, size, key)
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    async def _download(self, url, path, size, key):
+        client = self._get_client()
+        part_path = os.path.join(self.directory, f"{key}.part")
+        state_path = os.path.join(self.directory, f"{key}.json")
+        if size is None:
+            size = await self._probe_size(client, url)
+        if size is None:
+            # No ranges on this server: one plain request, no resume
+            await self._download_whole(client, url, part_path)
+        else:
+            await self._download_ranges(client, url, part_path, state_path, size)
+        os.replace(part_path, path)
+        _remove(state_path)
+        return path
+
+    async def _probe_size(self, client, url):
+        """Total size if the server answers range requests, else None"""
+        async with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+            if response.status_code == 206:
+                await response.aread()
+                return _content_range_total(response)
+            response.raise_for_status()
+            return None
+
+    async def _download_ranges(self, client, url, part_path, state_path, size):
+        done = self._load_state(state_path, part_path, size)
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Preallocate, so every part can be written at its own offset
+            os.ftruncate(fd, size)
+            parts = [(index, start, min(start + self.part_size, size))
+                     for index, start in enumerate(range(0, size, self.part_size)) if index not in done]
+            if done:
+                logger.info(f"Resuming download of {os.path.basename(part_path)}: "
+                            f"{len(done)} part(s) already on disk, {len(parts)} to go")
+            semaphore = asyncio.Semaphore(self.connections)
+
+            async def fetch(index, start, end):
+                async with semaphore:
+                    await self._fetch_part(client, url, fd, start, end, size)
+                done.add(index)
+                self._save_state(state_path, size, done)
+
+            tasks = [asyncio.ensure_future(fetch(*part)) for part in parts]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            os.fsync(fd)
+            actual = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if actual != size or len(done) != -(-size // self.part_size):
+            raise DownloadError(f"Downloaded {actual} bytes in {len(done)} parts, expected {size} bytes")
+
+    async def _fetch_part(self, client, url, fd, start, end, size):
+        """Write bytes start..end of url at the same offsets of fd, retrying transient failures"""
+        offset = start
+        for attempt in range(self.retries + 1):
+            try:
+                async with client.stream("GET", url, headers={"Range": f"bytes={offset}-{end - 1}"}) as response:
+                    if response.status_code in RETRY_STATUSES:
+                        raise _Retry(f"HTTP {response.status_code}")
+                    if response.status_code != 206:
+                        response.raise_for_status()
+                        raise DownloadError(f"Server ignored the range request (HTTP {response.status_code})")
+                    if _content_range_total(response) not in (None, size):
+                        raise DownloadError("File size changed during the download")
+                    # Read the body to the end, so the connection goes back to the pool
+                    async for chunk in response.aiter_bytes():
+                        chunk = chunk[:end - offset]
+                        # Page-cache writes are quick enough to do on the event loop
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                if offset < end:
+                    raise _Retry("connection closed early")
+                return
+            except (_Retry, httpx.TransportError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"Giving up on bytes {offset}-{end - 1} after {attempt + 1} attempts: {e}")
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Range {offset}-{end - 1} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _download_whole(self, client, url, part_path):
+        for attempt in range(self.retries + 1):
+            try:
+                async with client.stream("GET", url) as response:
+                    if response.status_code in RETRY_STATUSES:
+                        raise _Retry(f"HTTP {response.status_code}")
+                    response.raise_for_status()
+                    expected = response.headers.get("Content-Length")
+                    written = 0
+                    with open(part_path, "wb") as f:
+                        async for chunk in response.aiter_bytes():
+                            f.write(chunk)
+                            written += len(chunk)
+                if expected is not None and written != int(expected):
+                    raise _Retry(f"got {written} of {expected} bytes")
+                return
+            except (_Retry, httpx.TransportError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"Giving up after {attempt + 1} attempts: {e}")
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Download failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def _load_state(self, state_path, part_path, size):
+        """Parts already downloaded by an earlier attempt at the same file"""
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if (state["size"] == size and state["part_size"] == self.part_size
+                    and os.path.getsize(part_path) == size):
+                return set(state["done"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        _remove(part_path)
+        return set()
+
+    def _save_state(self, state_path, size, done):
+        tmp_path = f"{state_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"size": size, "part_size": self.part_size, "done": sorted(done)}, f)
+            os.replace(tmp_path, state_path)
+        except OSError as e:
+            logger.error(f"Error saving download state: {e}")
+
+    def sweep(self, max_age=TEMP_FILE_TTL):
+        """Remove partial downloads nobody has resumed for max_age seconds"""
+        cutoff = time.time() - max_age
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    _remove(entry.path)
+        except OSError as e:
+            logger.error(f"Error sweeping partial downloads: {e}")
+
+
+def _content_range_total(response):
+    # Content-Range: bytes 0-0/12345
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Shared downloader, so every job draws from the same connection pool
+downloader = Downloader()
@@ -0,0 +1,172 @@
+"""
+Measured libx264 throughput of this machine, for tuning merge transcodes.
+
+Run `python encoder_profile.py` once per machine (and again after a hardware
+change). It encodes a short reference clip with every preset at several
+thread counts and saves the frames per second of each run to
+ENCODER_PROFILE_PATH. The merge planner reads the profile to pick the best
+quality preset that still reaches the target speed with the threads a job
+gets when sharing the CPU with the other running merges.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import subprocess
+import tempfile
+import threading
+
+from config import ENCODER_PROFILE_PATH
+
+logger = logging.getLogger(__name__)
+
+# Slowest (smallest output) to fastest
+PRESETS = ["medium", "fast", "faster", "veryfast", "superfast", "ultrafast"]
+
+# Reference clip encoded during calibration
+REFERENCE_WIDTH = 1280
+REFERENCE_HEIGHT = 720
+REFERENCE_FPS = 30
+
+
+class EncoderProfile:
+    """Frames per second measured per preset and thread count"""
+
+    def __init__(self, results, cpu_count=None, created_at=None):
+        # {preset: {threads: fps}}
+        self.results = {preset: {int(threads): fps for threads, fps in by_threads.items()}
+                        for preset, by_threads in results.items()}
+        self.cpu_count = cpu_count or os.cpu_count()
+        self.created_at = created_at or time.time()
+
+    def fps(self, preset, threads, width=REFERENCE_WIDTH, height=REFERENCE_HEIGHT):
+        """Expected encode fps for a width x height video, or None if preset wasn't measured
+
+        Uses the largest measured thread count not above threads and scales
+        by pixel count from the reference resolution.
+        """
+        by_threads = self.results.get(preset)
+        if not by_threads:
+            return None
+        usable = [count for count in by_threads if count <= threads] or [min(by_threads)]
+        fps = by_threads[max(usable)]
+        return fps * (REFERENCE_WIDTH * REFERENCE_HEIGHT) / max(1, width * height)
+
+    def to_dict(self):
+        return {
+            "created_at": self.created_at,
+            "cpu_count": self.cpu_count,
+            "reference": {"width": REFERENCE_WIDTH, "height": REFERENCE_HEIGHT, "fps": REFERENCE_FPS},
+            "results": {preset: {str(threads): fps for threads, fps in by_threads.items()}
+                        for preset, by_threads in self.results.items()},
+        }
+
+    def save(self, path=ENCODER_PROFILE_PATH):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=ENCODER_PROFILE_PATH):
+        """Read a saved profile, or None if there is none"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(data["results"], data.get("cpu_count"), data.get("created_at"))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error loading encoder profile {path}: {e}")
+            return None
+
+
+_profile = None
+_profile_mtime = None
+_profile_lock = threading.Lock()
+
+
+def get_profile(path=ENCODER_PROFILE_PATH):
+    """The saved profile, reloaded when the file changes; None if never calibrated"""
+    global _profile, _profile_mtime
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _profile_lock:
+        if mtime != _profile_mtime:
+            _profile = EncoderProfile.load(path)
+            _profile_mtime = mtime
+        return _profile
+
+
+def make_reference_clip(path, duration):
+    """Render a synthetic 720p clip with enough detail and motion to keep x264 busy"""
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={REFERENCE_WIDTH}x{REFERENCE_HEIGHT}:rate={REFERENCE_FPS}",
+        "-f", "lavfi", "-i", f"nullsrc=size={REFERENCE_WIDTH}x{REFERENCE_HEIGHT},geq=random(1)*255:128:128",
+        "-filter_complex", "[0:v][1:v]blend=all_mode=overlay:all_opacity=0.3,format=yuv420p",
+        "-t", str(duration), "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", path, "-y"
+    ], check=True)
+
+
+def measure(clip_path, preset, threads, frames):
+    """Encode clip_path with preset and threads; returns frames per second"""
+    started = time.monotonic()
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-v", "error", "-i", clip_path,
+        "-c:v", "libx264", "-preset", preset, "-crf", "23", "-threads", str(threads),
+        "-f", "null", "-"
+    ], check=True)
+    return frames / (time.monotonic() - started)
+
+
+def default_thread_counts(cpu_count=None):
+    """1, 2, 4, ... up to the number of cores"""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    counts = []
+    threads = 1
+    while threads < cpu_count:
+        counts.append(threads)
+        threads *= 2
+    counts.append(cpu_count)
+    return counts
+
+
+def calibrate(presets=PRESETS, thread_counts=None, duration=5):
+    """Measure every preset at every thread count on a fresh reference clip"""
+    thread_counts = thread_counts or default_thread_counts()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        clip_path = os.path.join(tmp, "reference.mp4")
+        make_reference_clip(clip_path, duration)
+        frames = duration * REFERENCE_FPS
+        for preset in presets:
+            results[preset] = {}
+            for threads in thread_counts:
+                fps = measure(clip_path, preset, threads, frames)
+                results[preset][threads] = round(fps, 2)
+                logger.info(f"{preset} with {threads} thread(s): {fps:.1f} fps")
+    return EncoderProfile(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure x264 throughput and save an encoder profile")
+    parser.add_argument("--output", default=ENCODER_PROFILE_PATH, help="profile file to write")
+    parser.add_argument("--duration", type=int, default=5, help="seconds of reference video per run")
+    parser.add_argument("--presets", nargs="+", default=PRESETS, choices=PRESETS)
+    parser.add_argument("--threads", nargs="+", type=int, help="thread counts to try (default 1, 2, 4 ... cores)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    profile = calibrate(args.presets, args.threads, args.duration)
+    profile.save(args.output)
+    print(f"Saved encoder profile to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
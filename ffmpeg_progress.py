@@ -0,0 +1,177 @@
+"""
+Parsing of FFmpeg's machine-readable `-progress` output.
+
+FFmpeg writes blocks of key=value lines terminated by `progress=continue`
+(or `progress=end` for the last block). Each block is turned into a
+MergeProgress with percent done and ETA computed against the input duration.
+"""
+import time
+import threading
+
+
+class MergeProgress:
+    """Snapshot of a running FFmpeg job"""
+
+    __slots__ = ("out_time", "duration", "speed", "fps", "elapsed", "done")
+
+    def __init__(self, out_time=0.0, duration=None, speed=None, fps=None, elapsed=0.0, done=False):
+        self.out_time = out_time
+        self.duration = duration
+        self.speed = speed
+        self.fps = fps
+        self.elapsed = elapsed
+        self.done = done
+
+    @property
+    def percent(self):
+        """Percent done (0-100), or None when the duration is unknown"""
+        if self.done:
+            return 100.0
+        if not self.duration:
+            return None
+        return max(0.0, min(100.0, self.out_time * 100.0 / self.duration))
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, or None when it can't be estimated"""
+        if self.done:
+            return 0.0
+        if not self.duration or self.out_time <= 0:
+            return None
+        remaining = max(0.0, self.duration - self.out_time)
+        # Prefer FFmpeg's own speed; fall back to the observed average rate
+        speed = self.speed
+        if not speed and self.elapsed > 0:
+            speed = self.out_time / self.elapsed
+        if not speed:
+            return None
+        return remaining / speed
+
+    def to_dict(self):
+        return {
+            "percent": self.percent,
+            "eta": self.eta,
+            "out_time": self.out_time,
+            "duration": self.duration,
+            "speed": self.speed,
+            "fps": self.fps,
+            "done": self.done,
+        }
+
+
+class BatchProgress(MergeProgress):
+    """Combined progress of a batch of merges run one after another"""
+
+    __slots__ = ("item", "items")
+
+    def __init__(self, item, items, **kwargs):
+        super().__init__(**kwargs)
+        self.item = item
+        self.items = items
+
+    def to_dict(self):
+        data = super().to_dict()
+        data["item"] = self.item
+        data["items"] = self.items
+        return data
+
+
+class BatchProgressTracker:
+    """Turn each item's MergeProgress into a BatchProgress over the whole batch
+    
+    Items are weighted by their duration, so the percent and ETA cover the
+    batch rather than restarting at every item.
+    """
+
+    def __init__(self, durations):
+        self.durations = [duration or 0.0 for duration in durations]
+        self.total = sum(self.durations) or None
+        self._started = time.monotonic()
+
+    def update(self, index, progress):
+        finished = sum(self.durations[:index])
+        current = self.durations[index] if progress.done else min(progress.out_time, self.durations[index])
+        return BatchProgress(
+            index + 1, len(self.durations),
+            out_time=finished + current,
+            duration=self.total,
+            speed=progress.speed,
+            fps=progress.fps,
+            elapsed=time.monotonic() - self._started,
+            done=progress.done and index == len(self.durations) - 1,
+        )
+
+
+def _parse_float(value, suffix=""):
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressParser:
+    """Incremental parser for an FFmpeg -progress stream"""
+
+    def __init__(self, duration=None):
+        self.duration = duration
+        self._started = time.monotonic()
+        self._block = {}
+
+    def feed(self, raw_line):
+        """Consume one line; returns a MergeProgress when a block completes"""
+        line = raw_line.decode(errors="replace") if isinstance(raw_line, bytes) else raw_line
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return None
+        if key != "progress":
+            self._block[key] = value.strip()
+            return None
+
+        block, self._block = self._block, {}
+        out_time_us = _parse_float(block.get("out_time_us", ""))
+        return MergeProgress(
+            out_time=max(0.0, out_time_us / 1_000_000) if out_time_us else 0.0,
+            duration=self.duration,
+            speed=_parse_float(block.get("speed", ""), "x"),
+            fps=_parse_float(block.get("fps", "")),
+            elapsed=time.monotonic() - self._started,
+            done=value.strip() == "end",
+        )
+
+
+def iter_progress(lines, duration=None):
+    """Yield a MergeProgress for every block read from an FFmpeg -progress stream"""
+    parser = ProgressParser(duration)
+    for line in lines:
+        progress = parser.feed(line)
+        if progress is not None:
+            yield progress
+
+
+class ProgressThrottle:
+    """Rate-limit progress updates (e.g. to stay under Telegram's edit limits)"""
+
+    def __init__(self, min_interval=5.0, min_delta=1.0):
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self._last_time = None
+        self._last_percent = None
+        self._lock = threading.Lock()
+
+    def ready(self, progress):
+        """Return True if this update should be forwarded"""
+        now = time.monotonic()
+        percent = progress.percent
+        with self._lock:
+            if progress.done:
+                return True
+            if self._last_time is not None and now - self._last_time < self.min_interval:
+                return False
+            if (percent is not None and self._last_percent is not None
+                    and abs(percent - self._last_percent) < self.min_delta):
+                return False
+            self._last_time = now
+            self._last_percent = percent
+            return True
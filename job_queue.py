@@ -0,0 +1,817 @@
+"""
+Bounded FFmpeg job queue shared by the web interface and the Telegram bot.
+
+Merges are queued and drained by a fixed pool of worker threads. Every worker
+must also hold one of MAX_FFMPEG_WORKERS slot locks under TEMP_DIRECTORY, so
+gunicorn workers and the bot process share a single capacity limit.
+
+Merges are planned (ffprobe) and keyed for the result cache (a hash of the
+inputs) on a few preparation threads rather than in the caller, so a web
+request gets its job id back at once. A cache hit finishes the job there;
+anything else joins the queue.
+
+Waiting jobs are served round-robin across owners (a Telegram user or a web
+client), so one user queueing a whole season can't starve everyone else.
+New work is refused with QueueFullError once a user or the whole queue has
+too much waiting, rather than letting the backlog grow without bound.
+"""
+import os
+import asyncio
+import fcntl
+import logging
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from config import (
+    TEMP_DIRECTORY, MAX_FFMPEG_WORKERS, JOB_RETENTION_SECONDS,
+    MAX_RUNNING_JOBS_PER_USER, MAX_QUEUED_JOBS_PER_USER, MAX_QUEUE_LENGTH
+)
+from media_processor import MediaProcessor
+import segment_encoder
+from ffmpeg_progress import MergeProgress, BatchProgressTracker
+from probe import probe
+from merge_planner import plan_merge, tune_encoder
+from metrics import StageTimer, QUEUE_DEPTH, JOBS, BYTES_PROCESSED, record_failure, timed
+from result_cache import result_cache, share_digest
+from storage import storage
+from utils import tag_output_path, output_display_name
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Threads planning and hashing submitted merges; mostly waiting on disk
+PREPARE_THREADS = 4
+
+
+class QueueFullError(Exception):
+    """Raised when a job is refused because its owner or the queue has too much waiting"""
+
+    def __init__(self, message, retry_after=60):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Job:
+    """A unit of work waiting for (or holding) an FFmpeg slot"""
+
+    def __init__(self, func, args=(), kwargs=None, owner=None, timer=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        # Stage timings; a timer passed in belongs to the caller, who writes it out
+        self.timer = timer or StageTimer("job", job_id=self.id, owner=owner)
+        self._owns_timer = timer is None
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        # When it joined the queue, after any preparation
+        self.queued_at = self.created_at
+        self.started_at = None
+        self.finished_at = None
+        self.progress = None
+        # Output file that can be served while the job is still writing it
+        self.preview_path = None
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._done = threading.Event()
+        self._callbacks = []
+        self._progress_callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout=None):
+        """Block until the job has finished"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback(job) once the job finishes (immediately if it already has)"""
+        with self._lock:
+            if not self.finished:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def add_progress_callback(self, callback):
+        """Call callback(job, progress) for every progress update"""
+        self._progress_callbacks.append(callback)
+
+    def set_progress(self, progress):
+        """Record the latest MergeProgress and notify listeners"""
+        self.progress = progress
+        for callback in list(self._progress_callbacks):
+            try:
+                callback(self, progress)
+            except Exception as e:
+                logger.error(f"Error in progress callback for job {self.id}: {e}")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress.to_dict() if self.progress else None,
+        }
+
+    def _run(self):
+        self.status = RUNNING
+        self.started_at = time.time()
+        self.timer.add("queue", self.started_at - self.queued_at)
+        reason = None
+        try:
+            with self.timer.active():
+                self.result = self._func(*self._args, **self._kwargs)
+                _share_digests(self.result)
+            status = DONE
+        except Exception as e:
+            logger.error(f"Job {self.id} failed: {e}")
+            self.error = str(e)
+            reason = record_failure("job", e)
+            status = FAILED
+        JOBS.inc(status=status)
+        self._finish(status, reason)
+
+    def _finish(self, status, reason=None):
+        """Record the outcome and run the done callbacks"""
+        self.finished_at = time.time()
+        if self._owns_timer:
+            self.timer.finish(status, reason)
+
+        with self._lock:
+            self.status = status
+            callbacks, self._callbacks = self._callbacks, []
+        self._done.set()
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logger.error(f"Error in callback for job {self.id}: {e}")
+
+
+class CapacityLimiter:
+    """Cross-process slot pool built on flock()ed files"""
+
+    def __init__(self, slots, directory=None, poll_interval=0.5):
+        self.slots = max(1, slots)
+        self.directory = directory or os.path.join(TEMP_DIRECTORY, ".slots")
+        self.poll_interval = poll_interval
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+    def acquire(self):
+        """Block until a slot is free and return its open file descriptor"""
+        while True:
+            for index in range(self.slots):
+                path = os.path.join(self.directory, f"slot_{index}.lock")
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def release(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def busy_slots(self):
+        """Number of slots currently held by any process on this host"""
+        busy = 0
+        for index in range(self.slots):
+            path = os.path.join(self.directory, f"slot_{index}.lock")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            except BlockingIOError:
+                busy += 1
+            finally:
+                os.close(fd)
+        return busy
+
+
+class FairScheduler:
+    """Per-owner FIFO queues served round-robin
+    
+    Owners already running max_running_per_owner jobs are skipped until one
+    of their jobs finishes. Not thread-safe; JobQueue guards it with its lock.
+    """
+
+    def __init__(self, max_running_per_owner=MAX_RUNNING_JOBS_PER_USER):
+        self.max_running_per_owner = max(1, max_running_per_owner)
+        self._queues = {}
+        self._order = deque()
+        self._running = {}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def pending_for(self, owner):
+        return len(self._queues.get(owner, ()))
+
+    def running_for(self, owner):
+        return self._running.get(owner, 0)
+
+    def push(self, job):
+        if job.owner not in self._queues:
+            self._queues[job.owner] = deque()
+            self._order.append(job.owner)
+        self._queues[job.owner].append(job)
+        self._length += 1
+
+    def pop(self):
+        """Next job to start, or None if every waiting owner is at their cap"""
+        for _ in range(len(self._order)):
+            owner = self._order[0]
+            self._order.rotate(-1)
+            if self.running_for(owner) >= self.max_running_per_owner:
+                continue
+            jobs = self._queues[owner]
+            job = jobs.popleft()
+            if not jobs:
+                del self._queues[owner]
+                self._order.remove(owner)
+            self._length -= 1
+            self._running[owner] = self.running_for(owner) + 1
+            return job
+        return None
+
+    def done(self, job):
+        """Release job's running slot for its owner"""
+        count = self.running_for(job.owner) - 1
+        if count > 0:
+            self._running[job.owner] = count
+        else:
+            self._running.pop(job.owner, None)
+
+    def position(self, job):
+        """Number of waiting jobs that will start before job, or None if it isn't waiting"""
+        jobs = self._queues.get(job.owner)
+        if not jobs or job not in jobs:
+            return None
+        index = jobs.index(job)
+        rank = self._order.index(job.owner)
+        ahead = index
+        # Each round serves one job per owner, starting from the front of _order
+        for other_rank, other in enumerate(self._order):
+            if other != job.owner:
+                rounds = index + 1 if other_rank < rank else index
+                ahead += min(len(self._queues[other]), rounds)
+        return ahead
+
+
+class JobQueue:
+    """Job queue drained fairly across owners by a bounded pool of worker threads"""
+
+    def __init__(self, max_workers=MAX_FFMPEG_WORKERS, limiter=None,
+                 max_queued_per_owner=MAX_QUEUED_JOBS_PER_USER, max_queue_length=MAX_QUEUE_LENGTH):
+        self.max_workers = max(1, max_workers)
+        self.limiter = limiter or CapacityLimiter(self.max_workers)
+        self.max_queued_per_owner = max_queued_per_owner
+        self.max_queue_length = max_queue_length
+        self._pending = FairScheduler()
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._workers = []
+        self._preparer = None
+        # Jobs being prepared, per owner; they count towards the limits
+        self._preparing = {}
+        self._pid = None
+
+    def submit(self, func, *args, owner=None, **kwargs):
+        """Queue func(*args, **kwargs) and return its Job immediately"""
+        return self._enqueue(Job(func, args, kwargs, owner=owner))
+
+    def submit_merge(self, video_path, audio_path, output_path, fast_mode=False, owner=None, progressive=False,
+                     audio_prep=None, keep_original=False, original_default=False):
+        """Queue a MediaProcessor merge; the job result is the output path
+        
+        Returns the job at once: planning and the cache lookup happen on a
+        preparation thread, and a result cache hit finishes the job without
+        queueing it. With progressive, transcoded output is written so that it can be
+        played while it grows, and job.preview_path points at it.
+        audio_prep is an optional AudioPrep applied to the audio.
+        keep_original keeps the video's own audio and subtitle tracks after
+        the dub; original_default makes its first audio track the default.
+        The output's filename is prefixed with the job id (see
+        utils.tag_output_path), so merges with the same name can't collide.
+        """
+        job = Job(_run_merge, owner=owner)
+        job._kwargs["progress_callback"] = job.set_progress
+        output_path = tag_output_path(output_path, job.id)
+
+        def prepare():
+            # The planner may pick another container, so the result is its output path
+            plan = MediaProcessor.plan_merge(video_path, audio_path, output_path, fast_mode,
+                                             progressive=progressive, audio_prep=audio_prep,
+                                             keep_original=keep_original, original_default=original_default)
+            cache_key = result_cache.make_key(video_path, audio_path, plan.cache_options())
+            if result_cache.fetch(cache_key, plan.output_path):
+                storage.track(plan.output_path, owner=owner)
+                return plan.output_path
+            job._args = (video_path, audio_path, plan, cache_key)
+            job.preview_path = plan.output_path if plan.fragmented else None
+            return None
+
+        return self._prepare_and_enqueue(job, prepare, (video_path, audio_path))
+
+    def submit_batch(self, pairs, fast_mode=False, owner=None, archive_path=None, audio_prep=None,
+                     keep_original=False, original_default=False):
+        """Queue several (video_path, audio_path, output_path) merges as one job
+        
+        The merges run back to back in a single worker slot and report their
+        combined progress as BatchProgress. The result is the list of output
+        paths, or archive_path if given, a zip holding all the outputs.
+        audio_prep and the original track options, if given, apply to every
+        merge as for submit_merge.
+        """
+        job = Job(_run_batch, owner=owner)
+        job._kwargs["progress_callback"] = job.set_progress
+
+        def prepare():
+            items = []
+            for video_path, audio_path, output_path in pairs:
+                output_path = tag_output_path(output_path, job.id)
+                plan = MediaProcessor.plan_merge(video_path, audio_path, output_path, fast_mode,
+                                                 audio_prep=audio_prep, keep_original=keep_original,
+                                                 original_default=original_default)
+                cache_key = result_cache.make_key(video_path, audio_path, plan.cache_options())
+                items.append((video_path, audio_path, plan, cache_key))
+            job._args = (items, archive_path)
+            return None
+
+        return self._prepare_and_enqueue(job, prepare, [path for video_path, audio_path, _ in pairs
+                                                        for path in (video_path, audio_path)])
+
+    def submit_multi_audio(self, video_path, tracks, output_path, fast_mode=False, owner=None, progressive=False,
+                           audio_prep=None, keep_original=False, original_default=False):
+        """Queue a single-pass merge of several audio tracks into one video
+        
+        tracks are dicts as taken by MediaProcessor.merge_multi_audio; the
+        job result is the output path. progressive, audio_prep (applied to
+        every track) and the original track options are as for submit_merge.
+        """
+        audio_paths = [track['path'] for track in tracks]
+        job = Job(_run_multi_audio, owner=owner)
+        job._kwargs["progress_callback"] = job.set_progress
+        output_path = tag_output_path(output_path, job.id)
+
+        def prepare():
+            plan = MediaProcessor.plan_multi_audio(video_path, audio_paths, output_path, fast_mode,
+                                                   progressive=progressive, audio_prep=audio_prep,
+                                                   keep_original=keep_original, original_default=original_default)
+            options = plan.cache_options()
+            options["tracks"] = [{"language": track.get('language'), "title": track.get('title')}
+                                 for track in tracks]
+            cache_key = result_cache.make_key(video_path, audio_paths, options)
+            if result_cache.fetch(cache_key, plan.output_path):
+                storage.track(plan.output_path, owner=owner)
+                return plan.output_path
+            job._args = (video_path, tracks, plan, cache_key)
+            job.preview_path = plan.output_path if plan.fragmented else None
+            return None
+
+        return self._prepare_and_enqueue(job, prepare, [video_path, *audio_paths])
+
+    def submit_stream_merge(self, video_path, open_audio, output_path, fast_mode=False, owner=None,
+                            audio_codec=None, progressive=False):
+        """Queue a merge whose audio is streamed in while it runs
+        
+        open_audio is called when the job starts and must return a file-like
+        object or iterable of bytes. The audio isn't known up front, so the
+        result cache is skipped. progressive is as for submit_merge, and as
+        there the job is returned before the video is probed and planned.
+        """
+        job = Job(_run_stream_merge, owner=owner)
+        job._kwargs["progress_callback"] = job.set_progress
+        output_path = tag_output_path(output_path, job.id)
+
+        def prepare():
+            plan = plan_merge(probe(video_path), None, output_path, fast_mode,
+                              allow_container_change=False, audio_codec=audio_codec, progressive=progressive)
+            job._args = (video_path, open_audio, plan)
+            job.preview_path = plan.output_path if plan.fragmented else None
+            return None
+
+        return self._prepare_and_enqueue(job, prepare, (video_path,))
+
+    def _prepare_and_enqueue(self, job, prepare, paths):
+        """Return job at once and queue it once prepare() has planned it
+        
+        prepare runs on a preparation thread. It sets the job's arguments
+        and returns None, or returns the output path of a result cache hit,
+        which finishes the job without queueing it. Admission is checked
+        up front, so QueueFullError is still raised to the caller.
+        """
+        with self._cond:
+            self._admit(job.owner)
+            self._ensure_workers()
+            self._prune()
+            self._jobs[job.id] = job
+            self._preparing[job.owner] = self._preparing.get(job.owner, 0) + 1
+            preparer = self._preparer
+        self._hold_files(job, paths)
+        preparer.submit(self._prepare, job, prepare)
+        return job
+
+    def _prepare(self, job, prepare):
+        try:
+            with job.timer.active(), timed("prepare", job.timer):
+                cached = prepare()
+        except Exception as e:
+            logger.error(f"Preparing job {job.id} failed: {e}")
+            with self._cond:
+                self._prepared(job)
+            job.error = str(e)
+            JOBS.inc(status=FAILED)
+            job._finish(FAILED, record_failure("prepare", e))
+            return
+        if cached is not None:
+            with self._cond:
+                self._prepared(job)
+            _share_digests(cached)
+            job.result = cached
+            job.started_at = time.time()
+            job._finish(DONE)
+            return
+        job.queued_at = time.time()
+        # Admitted when it was submitted
+        self._enqueue(job, admit=False)
+
+    def _prepared(self, job):
+        """Stop counting job as being prepared (call with self._cond held)"""
+        count = self._preparing.get(job.owner, 0) - 1
+        if count > 0:
+            self._preparing[job.owner] = count
+        else:
+            self._preparing.pop(job.owner, None)
+
+    @staticmethod
+    def _hold_files(job, paths):
+        """Keep paths from being swept or discarded until job finishes"""
+        for path in paths:
+            storage.acquire(path)
+        job.add_done_callback(lambda job: [storage.release(path) for path in paths])
+        return job
+
+    async def run_async(self, coro_factory, owner=None, position_callback=None, timer=None):
+        """Run coro_factory(job) on the caller's event loop once the job reaches a worker
+        
+        The worker thread holds the FFmpeg slot while the coroutine runs, so
+        asyncio callers wait in the same queue under the same capacity limit.
+        While the job waits, position_callback (which may be a coroutine
+        function) is called with its queue position whenever that changes.
+        Stage timings go to timer if given (the caller then writes it out).
+        Returns the finished Job; errors are recorded on it rather than raised.
+        Raises QueueFullError if the job is refused.
+        """
+        loop = asyncio.get_running_loop()
+        turn = loop.create_future()
+        finished = threading.Event()
+        outcome = {}
+
+        def grant():
+            if not turn.done():
+                turn.set_result(None)
+
+        def hold_slot():
+            loop.call_soon_threadsafe(grant)
+            finished.wait()
+            if "error" in outcome:
+                raise outcome["error"]
+            return outcome.get("result")
+
+        job = self._enqueue(Job(hold_slot, owner=owner, timer=timer))
+        try:
+            await self._wait_turn(job, turn, position_callback)
+            with job.timer.active():
+                outcome["result"] = await coro_factory(job)
+        except asyncio.CancelledError:
+            outcome["error"] = RuntimeError("Cancelled")
+            raise
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            finished.set()
+
+        await loop.run_in_executor(None, job.wait)
+        return job
+
+    async def _wait_turn(self, job, turn, position_callback, interval=5):
+        """Await turn, reporting job's queue position every interval seconds until it comes"""
+        if position_callback is None:
+            await turn
+            return
+        reported = None
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(turn), timeout=interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            position = self.position(job)
+            if position is not None and position != reported:
+                reported = position
+                await MediaProcessor._report_progress(position_callback, position)
+
+    async def submit_merge_async(self, video_path, audio_path, output_path, fast_mode=False, owner=None,
+                                 progress_callback=None, position_callback=None, timer=None,
+                                 stage_callback=None, audio_prep=None, keep_original=False,
+                                 original_default=False):
+        """submit_merge for asyncio callers; waits for and returns the finished Job
+        
+        FFmpeg runs through asyncio.create_subprocess_exec on the caller's loop.
+        progress_callback and position_callback may be coroutine functions,
+        as may stage_callback, called with "probing" and then "merging" as
+        the merge reaches those stages. audio_prep and the original track
+        options are as for submit_merge.
+        """
+        await MediaProcessor._report_progress(stage_callback, "probing")
+        # The job doesn't exist yet, so the output gets an id of its own
+        output_path = tag_output_path(output_path, uuid.uuid4().hex)
+        plan = await asyncio.to_thread(
+            MediaProcessor.plan_merge, video_path, audio_path, output_path, fast_mode, audio_prep=audio_prep,
+            keep_original=keep_original, original_default=original_default
+        )
+        cache_key = await asyncio.to_thread(
+            result_cache.make_key, video_path, audio_path, plan.cache_options()
+        )
+        if await asyncio.to_thread(result_cache.fetch, cache_key, plan.output_path):
+            storage.track(plan.output_path, owner=owner)
+            return self.add_completed(plan.output_path, owner=owner)
+
+        async def merge(job):
+            async def report(progress):
+                job.set_progress(progress)
+                await MediaProcessor._report_progress(progress_callback, progress)
+
+            await MediaProcessor._report_progress(stage_callback, "merging")
+            await asyncio.to_thread(_tune, plan, video_path)
+            merger = await asyncio.to_thread(_merger_for, plan, video_path, audio_path)
+            success, error_message = await merger.merge_video_audio_async(
+                video_path, audio_path, plan.output_path, fast_mode=fast_mode,
+                progress_callback=report, plan=plan
+            )
+            if not success:
+                raise RuntimeError(error_message or "Failed to merge files")
+            await asyncio.to_thread(result_cache.store, cache_key, plan.output_path)
+            storage.track(plan.output_path, owner=owner)
+            _count_bytes([video_path, audio_path], plan.output_path)
+            return plan.output_path
+
+        for path in (video_path, audio_path):
+            storage.acquire(path)
+        try:
+            return await self.run_async(merge, owner=owner, position_callback=position_callback, timer=timer)
+        finally:
+            for path in (video_path, audio_path):
+                storage.release(path)
+
+    def add_completed(self, result, owner=None):
+        """Register a job that finished without running (e.g. a cache hit)"""
+        job = Job(None, owner=owner)
+        job.result = result
+        job.status = DONE
+        job.started_at = job.finished_at = time.time()
+        job._done.set()
+        with self._cond:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def _enqueue(self, job, admit=True):
+        with self._cond:
+            if admit:
+                self._admit(job.owner)
+            else:
+                self._prepared(job)
+            self._ensure_workers()
+            self._prune()
+            self._jobs[job.id] = job
+            self._pending.push(job)
+            self._cond.notify()
+            pending = len(self._pending)
+            QUEUE_DEPTH.set(pending)
+        logger.info(f"Queued job {job.id} for {job.owner} ({pending} pending)")
+        return job
+
+    def _admit(self, owner):
+        """Raise QueueFullError if a new job for owner would overload the queue"""
+        # Rough wait estimate: each worker clears a merge a minute or so
+        retry_after = 60 * max(1, len(self._pending) // self.max_workers)
+        waiting = len(self._pending) + sum(self._preparing.values())
+        if waiting >= self.max_queue_length:
+            logger.warning(f"Refusing job for {owner}: queue is full ({waiting} pending)")
+            record_failure("queue", "queue_full")
+            raise QueueFullError("The server is busy, please try again later", retry_after)
+        if (owner is not None
+                and self._pending.pending_for(owner) + self._preparing.get(owner, 0) >= self.max_queued_per_owner):
+            logger.warning(f"Refusing job for {owner}: too many queued jobs")
+            record_failure("queue", "user_queue_full")
+            raise QueueFullError("You already have too many merges waiting", retry_after)
+
+    def position(self, job):
+        """Number of jobs ahead of job in the queue, or None once it has started"""
+        with self._cond:
+            return self._pending.position(job)
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def active_jobs(self):
+        """Merges expected to share the CPU: jobs running on this host, plus
+        waiting ones that will take the free slots as soon as they can"""
+        return min(self.limiter.slots, self.limiter.busy_slots() + self.pending_count())
+
+    def _ensure_workers(self):
+        # Threads do not survive fork(), so (re)start them in each process
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._preparer = ThreadPoolExecutor(max_workers=PREPARE_THREADS, thread_name_prefix="prepare")
+        self._workers = []
+        for index in range(self.max_workers):
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"ffmpeg-worker-{index}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while (job := self._pending.pop()) is None:
+                    self._cond.wait()
+                QUEUE_DEPTH.set(len(self._pending))
+
+            slot = self.limiter.acquire()
+            try:
+                job._run()
+            finally:
+                self.limiter.release(slot)
+                with self._cond:
+                    self._pending.done(job)
+                    # An owner at their cap may have work other workers skipped
+                    self._cond.notify_all()
+
+
+def _count_bytes(input_paths, output_path):
+    """Add a finished merge's input and output sizes to the byte counters"""
+    try:
+        BYTES_PROCESSED.inc(sum(os.path.getsize(path) for path in input_paths), direction="input")
+        BYTES_PROCESSED.inc(os.path.getsize(output_path), direction="output")
+    except OSError as e:
+        logger.error(f"Error counting merged bytes: {e}")
+
+
+def _share_digests(result):
+    """Hash a job's outputs before it is marked done, so downloads never have to"""
+    for path in result if isinstance(result, list) else [result]:
+        if isinstance(path, str) and os.path.isfile(path):
+            share_digest(path)
+
+
+def _tune(plan, video_path):
+    """Choose the encoder settings for plan now that the job is about to run"""
+    return tune_encoder(plan, probe(video_path), job_queue.active_jobs())
+
+
+def _merger_for(plan, video_path, audio_path):
+    """MediaProcessor, or segment_encoder for long transcodes"""
+    durations = [info.duration for info in (probe(video_path), probe(audio_path)) if info and info.duration]
+    if segment_encoder.should_segment(plan, min(durations) if durations else None):
+        return segment_encoder
+    return MediaProcessor
+
+
+def _run_merge(video_path, audio_path, plan, cache_key=None, progress_callback=None):
+    _tune(plan, video_path)
+    success, error_message = _merger_for(plan, video_path, audio_path).merge_video_audio(
+        video_path, audio_path, plan.output_path, fast_mode=plan.mode == "fast",
+        progress_callback=progress_callback, plan=plan
+    )
+    if not success:
+        raise RuntimeError(error_message or "Failed to merge files")
+    result_cache.store(cache_key, plan.output_path)
+    storage.track(plan.output_path)
+    _count_bytes([video_path, audio_path], plan.output_path)
+    return plan.output_path
+
+
+def _run_multi_audio(video_path, tracks, plan, cache_key=None, progress_callback=None):
+    _tune(plan, video_path)
+    success, error_message = MediaProcessor.merge_multi_audio(
+        video_path, tracks, plan.output_path, fast_mode=plan.mode == "fast",
+        progress_callback=progress_callback, plan=plan
+    )
+    if not success:
+        raise RuntimeError(error_message or "Failed to merge audio tracks")
+    result_cache.store(cache_key, plan.output_path)
+    storage.track(plan.output_path)
+    _count_bytes([video_path, *(track["path"] for track in tracks)], plan.output_path)
+    return plan.output_path
+
+
+def _run_batch(items, archive_path=None, progress_callback=None):
+    durations = []
+    for video_path, audio_path, _, _ in items:
+        known = [info.duration for info in (probe(video_path), probe(audio_path)) if info and info.duration]
+        durations.append(min(known) if known else None)
+    tracker = BatchProgressTracker(durations)
+
+    outputs = []
+    for index, (video_path, audio_path, plan, cache_key) in enumerate(items):
+        def report(progress, index=index):
+            if progress_callback:
+                progress_callback(tracker.update(index, progress))
+
+        if result_cache.fetch(cache_key, plan.output_path):
+            storage.track(plan.output_path)
+            report(MergeProgress(done=True))
+        else:
+            try:
+                _run_merge(video_path, audio_path, plan, cache_key, progress_callback=report)
+            except RuntimeError as e:
+                storage.discard(outputs)
+                raise RuntimeError(f"Item {index + 1} of {len(items)} failed: {e}")
+        outputs.append(plan.output_path)
+
+    if archive_path is None:
+        return outputs
+    _write_archive(outputs, archive_path)
+    storage.discard(outputs)
+    storage.track(archive_path)
+    return archive_path
+
+
+def _write_archive(paths, archive_path):
+    """Zip paths into archive_path without recompressing the media"""
+    tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+    names = set()
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for index, path in enumerate(paths):
+            name = output_display_name(path)
+            if name in names:
+                name = f"{index + 1:02d}_{name}"
+            names.add(name)
+            archive.write(path, name)
+    os.replace(tmp_path, archive_path)
+
+
+def _run_stream_merge(video_path, open_audio, plan, progress_callback=None):
+    _tune(plan, video_path)
+    audio_source = open_audio()
+    try:
+        success, error_message = MediaProcessor.merge_video_audio_stream(
+            video_path, audio_source, plan.output_path, fast_mode=plan.mode == "fast",
+            progress_callback=progress_callback, plan=plan
+        )
+    finally:
+        if hasattr(audio_source, "close"):
+            audio_source.close()
+    if not success:
+        raise RuntimeError(error_message or "Failed to merge files")
+    storage.track(plan.output_path)
+    _count_bytes([video_path], plan.output_path)
+    return plan.output_path
+
+
+# Shared queue instance
+job_queue = JobQueue()
@@ -3,12 +3,32 @@ Flask app to serve as the web interface for our Telegram bot.
 Enables large file uploads up to 2GB that the Telegram API doesn't support directly.
 """
 import os
+import json
+import logging
+import time
 import uuid
 from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import (Flask, Response, abort, g, render_template, request, redirect, url_for, flash, jsonify,
+                   session, stream_with_context)
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from config import JOB_RETENTION_SECONDS
+from audio_prep import AudioPrep
+from delivery import send_output, follow_file
 from media_processor import MediaProcessor
-from utils import get_file_extension, get_clean_filename
+from job_queue import job_queue, QueueFullError, DONE, FAILED
+from probe import probe
+from storage import storage, StorageFullError
+from blob_store import blob_store
+from session_store import session_store
+from ffmpeg_progress import ProgressThrottle
+from metrics import registry, STAGE_SECONDS
+from chunked_upload import (UploadError, UploadStreamReader, create_upload, load_upload, write_chunk,
+                            seal_upload, finish_upload)
+from utils import (get_file_extension, get_clean_filename, format_duration, format_size, normalize_language,
+                   get_mime_type, output_display_name)
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
@@ -18,14 +38,28 @@ UPLOAD_FOLDER = 'temp_files'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'flv', 'wmv'}
 ALLOWED_AUDIO_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a', 'aac', 'flac'}
+# Audio formats FFmpeg can read from a pipe, with the codec when the extension implies it
+STREAMABLE_AUDIO_CODECS = {'.mp3': 'mp3', '.aac': 'aac', '.flac': 'flac', '.wav': None, '.ogg': None}
 MAX_CONTENT_LENGTH = 2 * 1024 * 1024 * 1024  # 2GB
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-# Store uploaded files temporarily
-video_files = {}
-audio_files = {}
+# Reconcile temp files left by a previous run and start sweeping expired ones
+storage.start()
+
+# Requests whose duration is the "receive" stage: getting the user's files onto disk
+UPLOAD_ENDPOINTS = {'upload_video', 'upload_audio', 'upload_chunk', 'batch_merge'}
+
+@app.before_request
+def start_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_upload_time(response):
+    if request.endpoint in UPLOAD_ENDPOINTS and request.method in ('POST', 'PUT'):
+        STAGE_SECONDS.observe(time.monotonic() - g.request_started, stage='receive')
+    return response
 
 def allowed_video_file(filename):
     return '.' in filename and \
@@ -35,6 +69,32 @@ def allowed_audio_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_AUDIO_EXTENSIONS
 
+def get_session_file(kind, session_id):
+    """A session's uploaded video/audio info, or None if it expired or was swept
+    
+    Sessions live in the shared session store, so any worker can pick up a
+    session another worker started.
+    """
+    info = session_store.get(kind, session_id)
+    if info is None or not os.path.exists(info['path']):
+        return None
+    return info
+
+def describe_media(info):
+    """Human-readable summary of a MediaInfo for templates"""
+    details = {'Container': info.container}
+    if info.duration:
+        details['Duration'] = format_duration(info.duration)
+    if info.resolution:
+        details['Resolution'] = f"{info.resolution[0]}x{info.resolution[1]}"
+    if info.video_codec:
+        details['Video codec'] = info.video_codec
+    if info.audio_codec:
+        details['Audio codec'] = info.audio_codec
+    if info.size:
+        details['Size'] = format_size(info.size)
+    return details
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -63,19 +123,32 @@ def upload_video():
             file_ext = get_file_extension(original_filename)
             filename = f"video_{upload_id}{file_ext}"
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            try:
+                storage.reserve(request.content_length or 0, filepath)
+            except StorageFullError as e:
+                flash(str(e))
+                return redirect(request.url)
+            try:
+                digest = blob_store.save_stream(file.stream, filepath)
+            except Exception as e:
+                logger.error(f"Error saving video upload: {e}")
+                storage.discard([filepath])
+                flash('The upload was interrupted. Please try again.')
+                return redirect(request.url)
+            storage.track(filepath, owner=upload_id)
             
             # Validate video file
             if not MediaProcessor.is_valid_video(filepath):
                 flash('Invalid video file format')
-                os.remove(filepath)
+                storage.discard([filepath])
                 return redirect(request.url)
+            blob_store.ingest(filepath, digest)
             
             # Store file info
-            video_files[upload_id] = {
+            session_store.set('video', upload_id, {
                 'path': filepath,
                 'original_name': original_filename
-            }
+            })
             
             flash('Video uploaded successfully!')
             return redirect(url_for('upload_audio', video_id=upload_id))
@@ -87,7 +160,8 @@ def upload_video():
 
 @app.route('/upload_audio/<video_id>', methods=['GET', 'POST'])
 def upload_audio(video_id):
-    if video_id not in video_files:
+    video = get_session_file('video', video_id)
+    if video is None:
         flash('Video session expired or invalid. Please upload your video again.')
         return redirect(url_for('upload_video'))
     
@@ -110,19 +184,32 @@ def upload_audio(video_id):
             file_ext = get_file_extension(original_filename)
             filename = f"audio_{video_id}{file_ext}"
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            try:
+                storage.reserve(request.content_length or 0, filepath)
+            except StorageFullError as e:
+                flash(str(e))
+                return redirect(request.url)
+            try:
+                digest = blob_store.save_stream(file.stream, filepath)
+            except Exception as e:
+                logger.error(f"Error saving audio upload: {e}")
+                storage.discard([filepath])
+                flash('The upload was interrupted. Please try again.')
+                return redirect(request.url)
+            storage.track(filepath, owner=video_id)
             
             # Validate audio file
             if not MediaProcessor.is_valid_audio(filepath):
                 flash('Invalid audio file format')
-                os.remove(filepath)
+                storage.discard([filepath])
                 return redirect(request.url)
+            blob_store.ingest(filepath, digest)
             
             # Store file info
-            audio_files[video_id] = {
+            session_store.set('audio', video_id, {
                 'path': filepath,
                 'original_name': original_filename
-            }
+            })
             
             flash('Audio uploaded successfully!')
             return redirect(url_for('merge_files', session_id=video_id))
@@ -131,61 +218,446 @@ def upload_audio(video_id):
             return redirect(request.url)
     
     return render_template('upload_audio.html', video_id=video_id, 
-                          video_name=video_files[video_id]['original_name'])
+                          video_name=video['original_name'])
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    """Start a resumable chunked upload"""
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    original_filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    
+    if kind == 'video':
+        if not allowed_video_file(original_filename):
+            return jsonify({'error': 'Invalid file type. Please upload a video file.'}), 400
+        session_id = str(uuid.uuid4())
+    elif kind == 'audio':
+        session_id = data.get('video_id')
+        if get_session_file('video', session_id) is None:
+            return jsonify({'error': 'Video session expired or invalid. Please upload your video again.'}), 400
+        if not allowed_audio_file(original_filename):
+            return jsonify({'error': 'Invalid file type. Please upload an audio file.'}), 400
+    else:
+        return jsonify({'error': 'Unknown upload kind'}), 400
+    
+    if not isinstance(size, int) or size <= 0 or size > MAX_CONTENT_LENGTH:
+        return jsonify({'error': 'File exceeds size limit of 2GB'}), 413
+    
+    # Same naming as the form uploads; chunks are written straight to this path
+    file_ext = get_file_extension(original_filename)
+    filename = f"{kind}_{session_id}{file_ext}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    try:
+        storage.reserve(size, filepath)
+    except StorageFullError as e:
+        return jsonify({'error': str(e)}), 507
+    upload = create_upload(kind, original_filename, filepath, size, session_id=session_id)
+    storage.track(filepath, owner=session_id)
+    return jsonify(upload.status()), 201
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = load_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    return jsonify(upload.status())
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Receive one chunk; the body is raw bytes and ?offset= gives its position"""
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or length is None:
+        return jsonify({'error': 'offset and Content-Length are required'}), 400
+    
+    try:
+        upload = write_chunk(upload_id, offset, request.stream, length)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(upload.status())
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    """Validate a completed upload and move on to the next step"""
+    try:
+        # No chunk can change the file once it has been validated
+        upload = seal_upload(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    if not upload.is_complete:
+        return jsonify(upload.status()), 409
+    
+    session_id = upload.session_id
+    if upload.kind == 'video':
+        if not MediaProcessor.is_valid_video(upload.path):
+            finish_upload(upload_id)
+            storage.discard([upload.path])
+            return jsonify({'error': 'Invalid video file format'}), 400
+        session_store.set('video', session_id, {
+            'path': upload.path,
+            'original_name': upload.original_name
+        })
+        next_url = url_for('upload_audio', video_id=session_id)
+    else:
+        if get_session_file('video', session_id) is None:
+            finish_upload(upload_id)
+            return jsonify({'error': 'Video session expired or invalid. Please upload your video again.'}), 400
+        if not MediaProcessor.is_valid_audio(upload.path):
+            finish_upload(upload_id)
+            storage.discard([upload.path])
+            return jsonify({'error': 'Invalid audio file format'}), 400
+        session_store.set('audio', session_id, {
+            'path': upload.path,
+            'original_name': upload.original_name
+        })
+        next_url = url_for('merge_files', session_id=session_id)
+    
+    finish_upload(upload_id)
+    # Chunks arrive in any order, so the file is hashed once it's complete,
+    # on a background thread so finalizing doesn't wait for it
+    blob_store.ingest_later(upload.path)
+    flash(f"{upload.kind.capitalize()} uploaded successfully!")
+    return jsonify({'redirect': next_url})
 
 @app.route('/merge/<session_id>', methods=['GET', 'POST'])
 def merge_files(session_id):
-    if session_id not in video_files or session_id not in audio_files:
+    video = get_session_file('video', session_id)
+    audio = get_session_file('audio', session_id)
+    if video is None or audio is None:
         flash('Upload session expired or invalid. Please start again.')
         return redirect(url_for('upload_video'))
     
     if request.method == 'POST':
-        # Get custom filename if provided
-        custom_filename = request.form.get('custom_filename', '')
-        if custom_filename.strip() == '':
-            # Use video filename as default
-            base_name = os.path.splitext(video_files[session_id]['original_name'])[0]
-            custom_filename = f"{base_name}_with_audio"
-        else:
-            custom_filename = get_clean_filename(custom_filename)
-        
         # Get fast mode preference
         fast_mode = request.form.get('fast_mode', 'off') == 'on'
+        try:
+            audio_prep = audio_prep_from_form(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        keep_original, original_default = original_tracks_from_form(request.form)
         
         # Set up paths
-        video_path = video_files[session_id]['path']
-        audio_path = audio_files[session_id]['path']
-        output_filename = f"{custom_filename}.mp4"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+        video_path = video['path']
+        audio_path = audio['path']
+        output_path = get_output_path(video, request.form.get('custom_filename', ''))
         
-        # Perform the merge
-        success = MediaProcessor.merge_video_audio(video_path, audio_path, output_path, fast_mode=fast_mode)
+        # Queue the merge and hand the job id back right away
+        try:
+            job = job_queue.submit_merge(video_path, audio_path, output_path, fast_mode=fast_mode,
+                                         owner=client_owner(), progressive=True, audio_prep=audio_prep,
+                                         keep_original=keep_original, original_default=original_default)
+        except QueueFullError as e:
+            return queue_full_response(e)
         
-        if success:
-            # Save the result to download page
-            return redirect(url_for('download_result', filename=output_filename))
-        else:
-            flash('Failed to merge files. Please try again with different files.')
-            return redirect(url_for('upload_video'))
+        return jsonify(job_response(job)), 202
     
     return render_template('merge.html', 
-                          video_name=video_files[session_id]['original_name'],
-                          audio_name=audio_files[session_id]['original_name'],
+                          video_name=video['original_name'],
+                          audio_name=audio['original_name'],
                           session_id=session_id)
 
+@app.route('/merge/<session_id>/stream', methods=['POST'])
+def merge_streaming(session_id):
+    """Start merging while the audio upload is still in progress"""
+    data = request.get_json(silent=True) or {}
+    upload = load_upload(data.get('upload_id', ''))
+    video = get_session_file('video', session_id)
+    if video is None or upload is None or upload.session_id != session_id:
+        return jsonify({'error': 'Upload session expired or invalid. Please start again.'}), 400
+    
+    # Formats that need seeking (MP4/M4A) can't be read from a pipe
+    file_ext = get_file_extension(upload.original_name)
+    if file_ext not in STREAMABLE_AUDIO_CODECS:
+        return jsonify({'error': 'This audio format has to be fully uploaded before merging.'}), 409
+    
+    video_path = video['path']
+    output_path = get_output_path(video, data.get('custom_filename', ''))
+    try:
+        job = job_queue.submit_stream_merge(
+            video_path, lambda: UploadStreamReader(upload), output_path,
+            fast_mode=bool(data.get('fast_mode')), owner=client_owner(),
+            audio_codec=STREAMABLE_AUDIO_CODECS[file_ext], progressive=True
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    return jsonify(job_response(job)), 202
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch_merge():
+    """Merge many videos with one audio each, or many audio tracks into one video"""
+    if request.method == 'GET':
+        return render_template('batch.html')
+    
+    mode = request.form.get('mode', 'pairs')
+    fast_mode = request.form.get('fast_mode', 'off') == 'on'
+    try:
+        audio_prep = audio_prep_from_form(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    keep_original, original_default = original_tracks_from_form(request.form)
+    # Pair files in filename order, which is episode order for a season
+    videos = sorted((f for f in request.files.getlist('videos') if f.filename), key=lambda f: f.filename)
+    audios = sorted((f for f in request.files.getlist('audios') if f.filename), key=lambda f: f.filename)
+    
+    if not videos or not audios:
+        return jsonify({'error': 'Please select video and audio files.'}), 400
+    if mode == 'tracks' and len(videos) != 1:
+        return jsonify({'error': 'Select exactly one video to add several audio tracks to.'}), 400
+    if mode == 'pairs' and len(videos) != len(audios):
+        return jsonify({'error': f'Got {len(videos)} videos but {len(audios)} audio files; they are merged in pairs.'}), 400
+    if not all(allowed_video_file(f.filename) for f in videos) or not all(allowed_audio_file(f.filename) for f in audios):
+        return jsonify({'error': 'Invalid file type in the selection.'}), 400
+    
+    batch_id = str(uuid.uuid4())
+    try:
+        storage.reserve(request.content_length or 0, batch_id)
+    except StorageFullError as e:
+        return jsonify({'error': str(e)}), 507
+    
+    saved = {}
+    
+    def save(file, kind, index):
+        original_filename = secure_filename(file.filename)
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'],
+                                f"{kind}_{batch_id}_{index}{get_file_extension(original_filename)}")
+        saved[filepath] = blob_store.save_stream(file.stream, filepath)
+        storage.track(filepath, owner=batch_id)
+        return {'path': filepath, 'original_name': original_filename}
+    
+    try:
+        video_infos = [save(f, 'video', index) for index, f in enumerate(videos)]
+        audio_infos = [save(f, 'audio', index) for index, f in enumerate(audios)]
+    except Exception as e:
+        logger.error(f"Error saving batch {batch_id}: {e}")
+        storage.discard(saved)
+        return jsonify({'error': 'The upload was interrupted. Please try again.'}), 400
+    finally:
+        # The saved files are tracked and counted now
+        storage.unreserve(batch_id)
+    if (not all(MediaProcessor.is_valid_video(info['path']) for info in video_infos)
+            or not all(MediaProcessor.is_valid_audio(info['path']) for info in audio_infos)):
+        storage.discard(saved)
+        return jsonify({'error': 'One of the files is not a valid video or audio file.'}), 400
+    for filepath, digest in saved.items():
+        blob_store.ingest(filepath, digest)
+    
+    try:
+        if mode == 'tracks':
+            languages = [normalize_language(code) for code in request.form.get('languages', '').split(',')]
+            tracks = [{
+                'path': info['path'],
+                'language': languages[index] if index < len(languages) else None,
+                'title': os.path.splitext(info['original_name'])[0],
+            } for index, info in enumerate(audio_infos)]
+            base_name = os.path.splitext(video_infos[0]['original_name'])[0]
+            output_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{base_name}_multi_audio.mp4")
+            job = job_queue.submit_multi_audio(video_infos[0]['path'], tracks, output_path, fast_mode=fast_mode,
+                                               owner=client_owner(), progressive=True, audio_prep=audio_prep,
+                                               keep_original=keep_original, original_default=original_default)
+        else:
+            pairs = []
+            used_names = set()
+            for index, (video, audio) in enumerate(zip(video_infos, audio_infos)):
+                output_path = get_output_path(video, '')
+                if output_path in used_names:
+                    output_path = get_output_path(video, f"{os.path.splitext(video['original_name'])[0]}_{index + 1}")
+                used_names.add(output_path)
+                pairs.append((video['path'], audio['path'], output_path))
+            archive_path = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_{batch_id}.zip")
+            job = job_queue.submit_batch(pairs, fast_mode=fast_mode, owner=client_owner(),
+                                         archive_path=archive_path, audio_prep=audio_prep,
+                                         keep_original=keep_original, original_default=original_default)
+    except QueueFullError as e:
+        storage.discard(saved)
+        return queue_full_response(e)
+    
+    return jsonify(job_response(job)), 202
+
+def get_output_path(video, custom_filename):
+    """Output path for a session's merge from the user's custom filename"""
+    if custom_filename.strip() == '':
+        # Use video filename as default
+        base_name = os.path.splitext(video['original_name'])[0]
+        custom_filename = f"{base_name}_with_audio"
+    else:
+        custom_filename = get_clean_filename(custom_filename)
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{custom_filename}.mp4")
+
+def audio_prep_from_form(form):
+    """Audio processing options from the merge forms; raises ValueError when out of range"""
+    try:
+        delay_ms = float(form.get('audio_delay') or 0)
+    except ValueError:
+        raise ValueError('Audio delay must be a number of milliseconds.')
+    return AudioPrep(
+        loudnorm=form.get('loudnorm', 'off') == 'on',
+        sample_rate=form.get('sample_rate', type=int),
+        delay=delay_ms / 1000,
+        auto_sync=form.get('auto_sync', 'off') == 'on',
+    )
+
+def original_tracks_from_form(form):
+    """(keep_original, original_default) from the merge forms"""
+    keep_original = form.get('keep_original', 'off') == 'on'
+    return keep_original, keep_original and form.get('default_track') == 'original'
+
+def client_owner():
+    """Scheduling owner for this browser, kept in the session cookie
+    
+    Merges are scheduled fairly per owner, so this has to outlive a single
+    upload session.
+    """
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return f"web:{session['client_id']}"
+
+def queue_full_response(error):
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def job_response(job):
+    publish_job(job)
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'queue_position': job_queue.position(job),
+        'status_url': url_for('job_status', job_id=job.id),
+        'download_url': url_for('job_download', job_id=job.id),
+        'stream_url': url_for('job_stream', job_id=job.id) if job.preview_path else None,
+    }
+
+def job_status_dict(job):
+    status = job.to_dict()
+    status['queue_position'] = job_queue.position(job)
+    status['filename'] = os.path.basename(job.result) if job.status == DONE else None
+    status['preview_filename'] = os.path.basename(job.preview_path) if job.preview_path else None
+    return status
+
+def publish_job(job):
+    """Mirror a job's status into the session store for the other workers"""
+    throttle = ProgressThrottle(min_interval=1.0, min_delta=0)
+    
+    def save(job):
+        session_store.set('job', job.id, job_status_dict(job))
+    
+    def save_progress(job, progress):
+        if throttle.ready(progress):
+            save(job)
+    
+    save(job)
+    job.add_progress_callback(save_progress)
+    job.add_done_callback(save)
+
+def load_job_status(job_id):
+    """Status of a job queued by this or any other worker, or None"""
+    job = job_queue.get(job_id)
+    if job is not None:
+        return job_status_dict(job)
+    return session_store.get('job', job_id)
+
+@app.route('/job/<job_id>')
+def job_status(job_id):
+    status = load_job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    status['queue_length'] = job_queue.pending_count()
+    if status['status'] == DONE:
+        status['download_url'] = url_for('job_download', job_id=job_id)
+    if status.get('preview_filename'):
+        status['stream_url'] = url_for('job_stream', job_id=job_id)
+    return jsonify(status)
+
+@app.route('/job/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events stream of job status until the job finishes"""
+    if load_job_status(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    def generate():
+        while True:
+            status = load_job_status(job_id)
+            yield f"data: {json.dumps(status)}\n\n"
+            if status is None or status['status'] in (DONE, FAILED):
+                break
+            job = job_queue.get(job_id)
+            if job is not None:
+                job.wait(timeout=1)
+            else:
+                time.sleep(1)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/job/<job_id>/stream')
+def job_stream(job_id):
+    """Play a merge's output while it is being written (fragmented MP4 only)"""
+    status = load_job_status(job_id)
+    if status is None or status['status'] == FAILED:
+        return jsonify({'error': 'Unknown job'}), 404
+    if status['status'] == DONE:
+        filepath = safe_join(app.config['UPLOAD_FOLDER'], status['filename'])
+        if filepath is None or not os.path.isfile(filepath):
+            abort(404)
+        return send_output(filepath, download_name=output_display_name(filepath), as_attachment=False)
+    if not status.get('preview_filename'):
+        return jsonify({'error': 'This merge can only be played once it has finished.'}), 409
+    
+    filepath = safe_join(app.config['UPLOAD_FOLDER'], status['preview_filename'])
+    if filepath is None:
+        abort(404)
+    
+    def is_finished():
+        status = load_job_status(job_id)
+        return status is None or status['status'] in (DONE, FAILED)
+    
+    # Not seekable or resumable while growing, so no Content-Length or ranges
+    body = follow_file(filepath, is_finished, not_before=status.get('started_at'),
+                       timeout=JOB_RETENTION_SECONDS)
+    return Response(stream_with_context(body), mimetype=get_mime_type(filepath),
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/job/<job_id>/download')
+def job_download(job_id):
+    status = load_job_status(job_id)
+    if status is None:
+        flash('Merge job not found or expired. Please start again.')
+        return redirect(url_for('upload_video'))
+    
+    if status['status'] == FAILED:
+        flash('Failed to merge files. Please try again with different files.')
+        return redirect(url_for('upload_video'))
+    
+    if status['status'] != DONE:
+        return jsonify(status), 409
+    
+    return redirect(url_for('download_result', filename=status['filename']))
+
 @app.route('/download/<filename>')
 def download_result(filename):
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     if os.path.exists(filepath):
-        # Set headers for download
-        return render_template('download.html', filename=filename)
+        # Describe the result from the (cached) probe of the output file
+        info = probe(filepath)
+        return render_template('download.html', filename=filename, display_name=output_display_name(filename),
+                               details=describe_media(info) if info else None)
     else:
         flash('File not found or processing error occurred.')
         return redirect(url_for('index'))
 
+@app.route('/metrics')
+def metrics():
+    """Metrics of every web worker and the bot on this host, for Prometheus"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/get_file/<filename>')
 def get_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+    filepath = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if filepath is None or not os.path.isfile(filepath):
+        abort(404)
+    return send_output(filepath, download_name=output_display_name(filepath), as_attachment=True)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
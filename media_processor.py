@@ -1,14 +1,30 @@
 import os
+import asyncio
+import inspect
 import logging
 import subprocess
 import time
+import threading
+from collections import deque
 from pathlib import Path
+from ffmpeg_progress import ProgressParser, iter_progress
+from probe import probe
+from merge_planner import plan_merge, plan_multi_audio
+from audio_prep import prepare_plan
+from storage import storage
+from result_cache import link_or_copy
+from blob_store import blob_store
+from downloader import downloader, telegram_file_url
+from metrics import ACTIVE_FFMPEG, FFMPEG_SPEED, timed, record_failure
 
 logger = logging.getLogger(__name__)
 
 # Create temp directory if it doesn't exist
 TEMP_DIRECTORY = "temp_files"
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB
+# Title of the dub when the original audio tracks are kept next to it
+DUB_TRACK_TITLE = "Dub"
 Path(TEMP_DIRECTORY).mkdir(parents=True, exist_ok=True)
 
 class MediaProcessor:
@@ -16,109 +32,405 @@ class MediaProcessor:
     MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
     
     @staticmethod
-    def download_file(file, file_path):
-        """Download a file from Telegram"""
+    async def fetch_stored(media, file_path, timer=None):
+        """Link a Telegram file we already have to file_path, without asking Telegram for it
+        
+        media is the message's Video, Audio, Voice or Document. Returns False
+        if the blob store doesn't have it; then get_file() and download_file().
+        """
+        with timed("download", timer):
+            return await asyncio.to_thread(blob_store.fetch_telegram, media.file_unique_id, file_path)
+
+    @staticmethod
+    async def download_file(file, file_path, timer=None):
+        """Download a file from Telegram, timed as the "download" stage of timer
+        
+        A local Bot API server (--local) reports files by absolute path on its
+        disk; those are hard-linked into place rather than copied. Anything
+        else goes through the shared range downloader, which resumes a
+        partial download of the same file after a restart.
+        """
         try:
-            file.download(file_path)
+            with timed("download", timer):
+                if file.file_path and os.path.isabs(file.file_path) and os.path.isfile(file.file_path):
+                    await asyncio.to_thread(link_or_copy, file.file_path, file_path)
+                else:
+                    await downloader.download(telegram_file_url(file), file_path, size=file.file_size,
+                                              key=file.file_unique_id)
+                    # Range parts arrive out of order, so the file is hashed once it's complete
+                    await asyncio.to_thread(blob_store.ingest, file_path, telegram_id=file.file_unique_id)
             return True
         except Exception as e:
             logger.error(f"Error downloading file: {e}")
+            record_failure("download", e)
             return False
 
     @staticmethod
-    def merge_video_audio(video_path, audio_path, output_path, fast_mode=False):
-        """Merge video and audio files using FFmpeg"""
+    def plan_merge(video_path, audio_path, output_path, fast_mode=False, allow_container_change=True,
+                   progressive=False, audio_prep=None, keep_original=False, original_default=False):
+        """Pick the cheapest merge for these inputs (see merge_planner)"""
+        return plan_merge(probe(video_path), probe(audio_path), output_path,
+                          fast_mode=fast_mode, allow_container_change=allow_container_change,
+                          progressive=progressive, audio_prep=audio_prep, keep_original=keep_original,
+                          original_default=original_default)
+
+    @staticmethod
+    def merge_video_audio(video_path, audio_path, output_path, fast_mode=False, progress_callback=None,
+                          plan=None):
+        """Merge video and audio files using FFmpeg
+        
+        Streams are copied whenever the output container accepts them. Pass a
+        plan from plan_merge() to allow a different output container; its
+        output_path then replaces the one given here.
+        
+        If progress_callback is given it is called with a MergeProgress for
+        every progress block FFmpeg reports while the merge runs.
+        """
         try:
-            # Set FFmpeg command options based on upload mode
-            if fast_mode:
-                # Fast mode: Use lower quality settings
-                cmd = [
-                    "ffmpeg", "-i", video_path, "-i", audio_path, 
-                    "-c:v", "libx264", "-preset", "ultrafast", "-crf", "28",
-                    "-c:a", "aac", "-b:a", "128k", 
-                    "-map", "0:v", "-map", "1:a", 
-                    "-shortest", output_path, "-y"
-                ]
-            else:
-                # Default mode: Maintain quality
-                cmd = [
-                    "ffmpeg", "-i", video_path, "-i", audio_path, 
-                    "-c:v", "copy", "-c:a", "aac", "-b:a", "192k",
-                    "-map", "0:v", "-map", "1:a", 
-                    "-shortest", output_path, "-y"
-                ]
-
-            # Execute FFmpeg command
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            
-            stdout, stderr = process.communicate()
+            if plan is None:
+                plan = MediaProcessor.plan_merge(video_path, audio_path, output_path, fast_mode,
+                                                 allow_container_change=False)
+            cmd, duration = MediaProcessor._build_merge_command(video_path, audio_path, plan)
+            return MediaProcessor._run_ffmpeg(cmd, duration, progress_callback)
             
-            if process.returncode != 0:
-                logger.error(f"FFmpeg error: {stderr.decode()}")
-                return False, stderr.decode()
-                
-            return True, None
+        except Exception as e:
+            logger.error(f"Error merging files: {e}")
+            return False, str(e)
+
+    @staticmethod
+    async def merge_video_audio_async(video_path, audio_path, output_path, fast_mode=False,
+                                      progress_callback=None, plan=None):
+        """merge_video_audio for asyncio callers, using asyncio.create_subprocess_exec
+        
+        progress_callback may be a plain function or a coroutine function.
+        """
+        try:
+            if plan is None:
+                plan = await asyncio.to_thread(
+                    MediaProcessor.plan_merge, video_path, audio_path, output_path, fast_mode,
+                    allow_container_change=False
+                )
+            cmd, duration = await asyncio.to_thread(
+                MediaProcessor._build_merge_command, video_path, audio_path, plan
+            )
+            return await MediaProcessor._run_ffmpeg_async(cmd, duration, progress_callback)
             
         except Exception as e:
             logger.error(f"Error merging files: {e}")
             return False, str(e)
 
     @staticmethod
-    def is_valid_video(file_path):
-        """Check if the file is a valid video"""
+    def plan_multi_audio(video_path, audio_paths, output_path, fast_mode=False, allow_container_change=True,
+                         progressive=False, audio_prep=None, keep_original=False, original_default=False):
+        """Plan muxing several audio files as separate tracks of one video"""
+        return plan_multi_audio(probe(video_path), [probe(path) for path in audio_paths], output_path,
+                                fast_mode=fast_mode, allow_container_change=allow_container_change,
+                                progressive=progressive, audio_prep=audio_prep, keep_original=keep_original,
+                                original_default=original_default)
+
+    @staticmethod
+    def merge_multi_audio(video_path, tracks, output_path, fast_mode=False, progress_callback=None,
+                          plan=None):
+        """Mux several audio tracks (e.g. one dub per language) into one video in a single pass
+        
+        tracks is a list of dicts with a 'path' and optional 'language' (ISO
+        639-2) and 'title'. The first track is marked as the default, unless
+        the plan keeps the original tracks with those as the default. The
+        output runs for the length of the video.
+        """
         try:
-            # Using FFprobe to check file validity
-            cmd = [
-                "ffprobe", "-v", "error", "-select_streams", "v:0",
-                "-show_entries", "stream=codec_type", "-of", "default=noprint_wrappers=1:nokey=1", 
-                file_path
-            ]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, _ = process.communicate()
+            if plan is None:
+                plan = MediaProcessor.plan_multi_audio(
+                    video_path, [track['path'] for track in tracks], output_path, fast_mode,
+                    allow_container_change=False
+                )
+            cmd, duration = MediaProcessor._build_multi_audio_command(video_path, tracks, plan)
+            return MediaProcessor._run_ffmpeg(cmd, duration, progress_callback)
             
-            return stdout.decode().strip() == "video"
         except Exception as e:
-            logger.error(f"Error validating video: {e}")
-            return False
+            logger.error(f"Error merging audio tracks: {e}")
+            return False, str(e)
 
     @staticmethod
-    def is_valid_audio(file_path):
-        """Check if the file is a valid audio"""
+    def _build_multi_audio_command(video_path, tracks, plan):
+        """FFmpeg command and expected output duration for a multi-track merge"""
+        # Never write through an existing file: it may be hard-linked into the result cache
+        if os.path.exists(plan.output_path):
+            os.remove(plan.output_path)
+        
+        info = probe(video_path)
+        duration = info.duration if info else None
+        prepare_plan(plan, video_path, [track['path'] for track in tracks])
+        
+        cmd = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-i", video_path]
+        for track in tracks:
+            cmd += ["-i", track['path']]
+        cmd += plan.codec_args()
+        cmd += plan.audio_filter_args()
+        cmd += ["-map", "0:v"]
+        for index in range(len(tracks)):
+            cmd += ["-map", f"{index + 1}:a:0"]
+        for index, track in enumerate(tracks):
+            if track.get('language'):
+                cmd += [f"-metadata:s:a:{index}", f"language={track['language']}"]
+            if track.get('title'):
+                cmd += plan.title_args(f"a:{index}", track['title'])
+            cmd += [f"-disposition:a:{index}", plan.dub_disposition(index)]
+        cmd += plan.original_track_args()
+        cmd += [*plan.muxer_args(), *MediaProcessor._length_args(duration), plan.output_path, "-y"]
+        return cmd, duration
+
+    @staticmethod
+    def _build_merge_command(video_path, audio_path, plan):
+        """FFmpeg command and expected output duration for a planned merge"""
+        # Never write through an existing file: it may be hard-linked into the result cache
+        if os.path.exists(plan.output_path):
+            os.remove(plan.output_path)
+        
+        # Output stops at the shorter input
+        audio_info = probe(audio_path)
+        durations = [info.duration for info in (probe(video_path), audio_info)
+                     if info and info.duration]
+        duration = min(durations) if durations else None
+        prepare_plan(plan, video_path, [audio_path])
+        
+        cmd = [
+            "ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1",
+            "-i", video_path, "-i", audio_path,
+            *plan.codec_args(),
+            *plan.audio_filter_args(),
+            "-map", "0:v",
+            *MediaProcessor._dub_track_args(plan, audio_info),
+            *plan.original_track_args(),
+            *plan.muxer_args(),
+            *MediaProcessor._length_args(duration),
+            plan.output_path, "-y"
+        ]
+        return cmd, duration
+
+    @staticmethod
+    def _dub_track_args(plan, audio_info, audio_input=1):
+        """FFmpeg -map and metadata options for a single merge's dub"""
+        if not plan.keeps_original:
+            return ["-map", f"{audio_input}:a"]
+        # Next to the original tracks the dub needs a label and a single stream
+        streams = audio_info.audio_streams if audio_info else []
+        title = (streams[0].title if streams else None) or DUB_TRACK_TITLE
+        return ["-map", f"{audio_input}:a:0", "-disposition:a:0", plan.dub_disposition(0),
+                *plan.title_args("a:0", title)]
+
+    @staticmethod
+    def merge_video_audio_stream(video_path, audio_source, output_path, fast_mode=False,
+                                 progress_callback=None, audio_codec=None, plan=None):
+        """Merge a video file with audio that is still arriving
+        
+        audio_source is a file-like object or an iterable of bytes; it is fed
+        to FFmpeg's stdin as it is read, so the merge overlaps the transfer.
+        The audio must be in a streamable format (MP3, OGG, ADTS AAC, FLAC,
+        WAV); MP4/M4A audio needs seeking and can't be piped. audio_codec is
+        an optional hint that lets the planner copy the audio stream. The
+        output runs for the length of the video.
+        """
         try:
-            # Using FFprobe to check file validity
+            if plan is None:
+                plan = plan_merge(probe(video_path), None, output_path, fast_mode,
+                                  allow_container_change=False, audio_codec=audio_codec)
+            
+            # Never write through an existing file: it may be hard-linked into the result cache
+            if os.path.exists(plan.output_path):
+                os.remove(plan.output_path)
+            
+            # Only the video length is known up front, so it bounds the output
+            info = probe(video_path)
+            duration = info.duration if info else None
+            
             cmd = [
-                "ffprobe", "-v", "error", "-select_streams", "a:0",
-                "-show_entries", "stream=codec_type", "-of", "default=noprint_wrappers=1:nokey=1", 
-                file_path
+                "ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1",
+                "-i", video_path, "-i", "pipe:0",
+                *plan.codec_args(),
+                "-map", "0:v", "-map", "1:a",
+                *plan.muxer_args(),
+                *MediaProcessor._length_args(duration),
+                plan.output_path, "-y"
             ]
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, _ = process.communicate()
+
+            return MediaProcessor._run_ffmpeg(cmd, duration, progress_callback, stdin_source=audio_source)
             
-            return stdout.decode().strip() == "audio"
         except Exception as e:
-            logger.error(f"Error validating audio: {e}")
-            return False
+            logger.error(f"Error merging streamed audio: {e}")
+            return False, str(e)
 
     @staticmethod
-    def clean_temp_files(file_paths):
-        """Clean up temporary files"""
-        for file_path in file_paths:
+    def _length_args(duration):
+        """Limit the output to duration seconds
+        
+        An explicit -t is preferred over -shortest, which drops the video
+        track in some FFmpeg releases when every stream is copied.
+        """
+        if duration:
+            return ["-t", f"{duration:.3f}"]
+        return ["-shortest"]
+
+    @staticmethod
+    def _feed_stdin(stdin, source):
+        """Copy a file-like object or iterable of bytes into FFmpeg's stdin"""
+        try:
+            if hasattr(source, "read"):
+                chunks = iter(lambda: source.read(STREAM_CHUNK_SIZE), b"")
+            else:
+                chunks = source
+            for chunk in chunks:
+                stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # FFmpeg closed its input early, which is normal with -shortest
+            pass
+        except Exception as e:
+            logger.error(f"Error streaming input to FFmpeg: {e}")
+        finally:
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                logger.error(f"Error removing temporary file {file_path}: {e}")
+                stdin.close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _run_ffmpeg(cmd, duration=None, progress_callback=None, stdin_source=None):
+        """Run an FFmpeg command that writes -progress to stdout"""
+        with ACTIVE_FFMPEG.track(), timed("merge"):
+            started = time.monotonic()
+            success, error = MediaProcessor._run_ffmpeg_process(cmd, duration, progress_callback, stdin_source)
+            MediaProcessor._record_run(success, duration, time.monotonic() - started)
+        return success, error
+
+    @staticmethod
+    def _run_ffmpeg_process(cmd, duration, progress_callback, stdin_source):
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if stdin_source is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+        # Drain stderr in the background so FFmpeg never blocks on a full pipe
+        stderr_tail = deque(maxlen=50)
+        stderr_reader = threading.Thread(
+            target=lambda: stderr_tail.extend(process.stderr), daemon=True
+        )
+        stderr_reader.start()
+
+        if stdin_source is not None:
+            threading.Thread(
+                target=MediaProcessor._feed_stdin, args=(process.stdin, stdin_source), daemon=True
+            ).start()
+
+        for progress in iter_progress(process.stdout, duration):
+            if progress_callback:
+                try:
+                    progress_callback(progress)
+                except Exception as e:
+                    logger.error(f"Error in progress callback: {e}")
+
+        process.wait()
+        stderr_reader.join()
+
+        if process.returncode != 0:
+            stderr = b"".join(stderr_tail).decode(errors="replace")
+            logger.error(f"FFmpeg error: {stderr}")
+            return False, stderr
+
+        return True, None
+
+    @staticmethod
+    async def _run_ffmpeg_async(cmd, duration=None, progress_callback=None):
+        """_run_ffmpeg on the event loop"""
+        with ACTIVE_FFMPEG.track(), timed("merge"):
+            started = time.monotonic()
+            success, error = await MediaProcessor._run_ffmpeg_process_async(cmd, duration, progress_callback)
+            MediaProcessor._record_run(success, duration, time.monotonic() - started)
+        return success, error
+
+    @staticmethod
+    async def _run_ffmpeg_process_async(cmd, duration, progress_callback):
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        # Drain stderr concurrently so FFmpeg never blocks on a full pipe
+        stderr_tail = deque(maxlen=50)
+
+        async def drain_stderr():
+            async for line in process.stderr:
+                stderr_tail.append(line)
+
+        stderr_task = asyncio.ensure_future(drain_stderr())
+        try:
+            parser = ProgressParser(duration)
+            async for line in process.stdout:
+                progress = parser.feed(line)
+                if progress is not None:
+                    await MediaProcessor._report_progress(progress_callback, progress)
+
+            await process.wait()
+            await stderr_task
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+
+        if process.returncode != 0:
+            stderr = b"".join(stderr_tail).decode(errors="replace")
+            logger.error(f"FFmpeg error: {stderr}")
+            return False, stderr
+
+        return True, None
+
+    @staticmethod
+    def _record_run(success, duration, elapsed):
+        """Update the FFmpeg metrics after a run"""
+        if not success:
+            record_failure("merge", "ffmpeg_error")
+        elif duration and elapsed > 0:
+            FFMPEG_SPEED.observe(duration / elapsed)
+
+    @staticmethod
+    async def _report_progress(progress_callback, progress):
+        if not progress_callback:
+            return
+        try:
+            result = progress_callback(progress)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"Error in progress callback: {e}")
+
+    @staticmethod
+    def is_valid_video(file_path):
+        """Check if the file is a valid video"""
+        info = probe(file_path)
+        return info is not None and info.has_video
+
+    @staticmethod
+    def is_valid_audio(file_path):
+        """Check if the file is a valid audio"""
+        info = probe(file_path)
+        return info is not None and info.has_audio
+
+    @staticmethod
+    def clean_temp_files(file_paths):
+        """Clean up temporary files
+        
+        Files still used by a queued or running job are removed once it finishes.
+        """
+        storage.discard(file_paths)
 
     @staticmethod
-    def generate_temp_path(user_id, file_type, ext):
-        """Generate a unique temporary file path"""
-        import uuid
-        filename = f"{user_id}_{uuid.uuid4().hex}.{ext}"
-        return os.path.join(TEMP_DIRECTORY, filename)
+    def generate_temp_path(user_id, file_type, ext, size=None):
+        """Generate a unique temporary file path
+        
+        Raises StorageFullError if size more bytes would exceed the temp quota.
+        """
+        return storage.allocate(user_id, file_type, ext, size=size)
 
     @classmethod
     def check_file_size(cls, file_size):
@@ -0,0 +1,383 @@
+"""
+Choose the cheapest valid FFmpeg command for a merge.
+
+Streams are copied whenever the output container accepts their codec. In fast
+mode the planner will switch MP4 output to MKV if that turns a transcode into
+a remux; default mode keeps MP4 for player compatibility and transcodes only
+the stream that doesn't fit.
+
+MP4 outputs are written with the index up front (faststart), or as
+fragmented MP4 for progressive transcodes, whose output can be played while
+FFmpeg is still writing it.
+
+Audio pre-processing (audio_prep.AudioPrep) runs as filters in the same
+command, so it always transcodes the audio.
+
+With keep_original the video's own audio and subtitle tracks are muxed in
+after the dub instead of being dropped. They are copied like everything
+else; text subtitles the container can't hold are converted (to mov_text
+for MP4), and bitmap subtitles MP4 can't hold move fast mode to MKV or are
+left out.
+
+When the video has to be transcoded, tune_encoder() picks the x264 preset and
+thread count for the job from the machine's measured encoder profile and the
+number of merges sharing the CPU.
+"""
+import os
+import logging
+
+from config import ENCODE_TARGET_SPEED, FAST_ENCODE_TARGET_SPEED
+from encoder_profile import get_profile, REFERENCE_WIDTH, REFERENCE_HEIGHT
+
+logger = logging.getLogger(__name__)
+
+# Codecs each container can hold without re-encoding
+CONTAINER_VIDEO_CODECS = {
+    "mp4": {"h264", "hevc", "mpeg4", "av1", "vp9"},
+    # Matroska accepts practically anything FFmpeg can demux
+    "mkv": None,
+}
+CONTAINER_AUDIO_CODECS = {
+    "mp4": {"aac", "mp3", "opus", "ac3", "eac3", "alac"},
+    "mkv": None,
+}
+CONTAINER_SUBTITLE_CODECS = {
+    "mp4": {"mov_text"},
+    "mkv": {"subrip", "ass", "ssa", "webvtt", "hdmv_pgs_subtitle", "dvd_subtitle", "dvb_subtitle"},
+}
+# Subtitles that can be converted to another text format, and what each container gets
+TEXT_SUBTITLE_CODECS = {"subrip", "ass", "ssa", "webvtt", "mov_text", "text"}
+SUBTITLE_ENCODERS = {"mp4": "mov_text", "mkv": "srt"}
+# Title given to kept original audio tracks that have none
+ORIGINAL_TRACK_TITLE = "Original"
+
+# Encoder settings used when a stream has to be transcoded
+VIDEO_ENCODE_ARGS = {
+    "default": ["libx264", "-preset", "veryfast", "-crf", "20"],
+    "fast": ["libx264", "-preset", "ultrafast", "-crf", "28"],
+}
+AUDIO_ENCODE_ARGS = {
+    "default": ["aac", "-b:a", "192k"],
+    "fast": ["aac", "-b:a", "128k"],
+}
+
+# MP4 layouts: fragments playable while the file grows, or the moov atom
+# moved to the front once the file is complete
+FRAGMENTED_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+FASTSTART_MOVFLAGS = "+faststart"
+
+# Presets tune_encoder() may choose from, slowest first, and the speed (multiple
+# of realtime) it aims for. CRF stays fixed per mode so quality doesn't vary
+# with load; a slower preset only buys a smaller file.
+TUNED_PRESETS = {
+    "default": ["medium", "fast", "faster", "veryfast", "superfast", "ultrafast"],
+    "fast": ["veryfast", "superfast", "ultrafast"],
+}
+TARGET_SPEED = {
+    "default": ENCODE_TARGET_SPEED,
+    "fast": FAST_ENCODE_TARGET_SPEED,
+}
+
+
+class MergePlan:
+    """Codec and container decisions for one merge
+    
+    audio_copies holds one copy decision per audio input when several audio
+    tracks are muxed together; copy_audio is then true only if all are copied.
+    encoder, set by tune_encoder(), overrides the video preset and sets the
+    thread count as {"preset": ..., "threads": ...}. fragmented MP4 output
+    can be served while it is still being written. audio_prep is the
+    requested AudioPrep, if any; audio_filters, its filter chain for each
+    audio input, is filled in by audio_prep.prepare_plan() before the merge
+    runs, since it may need to analyse the inputs.
+
+    original_audio has the title of each audio track kept from the video
+    (its own, or ORIGINAL_TRACK_TITLE). Their copy decisions follow
+    the dubs' in audio_copies. subtitle_codecs has an entry per subtitle
+    track of the video: "copy", the encoder to convert it with, or None to
+    leave it out. original_default makes the first original track the
+    default instead of the first dub.
+    """
+
+    __slots__ = ("container", "output_path", "copy_video", "audio_copies", "mode", "encoder", "fragmented",
+                 "audio_prep", "audio_filters", "original_audio", "subtitle_codecs", "original_default")
+
+    def __init__(self, container, output_path, copy_video, copy_audio, mode, audio_copies=None,
+                 fragmented=False, audio_prep=None, original_audio=None, subtitle_codecs=None,
+                 original_default=False):
+        self.container = container
+        self.output_path = output_path
+        self.copy_video = copy_video
+        self.audio_copies = list(audio_copies) if audio_copies is not None else [copy_audio]
+        self.mode = mode
+        self.encoder = None
+        self.fragmented = fragmented and container == "mp4"
+        self.audio_prep = audio_prep if audio_prep is not None and audio_prep.active else None
+        self.audio_filters = None
+        self.original_audio = list(original_audio or [])
+        self.subtitle_codecs = list(subtitle_codecs or [])
+        self.original_default = original_default and bool(self.original_audio)
+
+    @property
+    def copy_audio(self):
+        return all(self.audio_copies)
+
+    @property
+    def is_remux(self):
+        return self.copy_video and self.copy_audio
+
+    @property
+    def dub_tracks(self):
+        return len(self.audio_copies) - len(self.original_audio)
+
+    @property
+    def keeps_original(self):
+        return bool(self.original_audio) or any(self.subtitle_codecs)
+
+    @property
+    def description(self):
+        if self.is_remux:
+            action = "remux (copy video and audio)"
+        elif self.copy_video and any(self.audio_copies):
+            action = "copy video, transcode some audio"
+        elif self.copy_video:
+            action = "copy video, transcode audio"
+        elif self.copy_audio:
+            action = "transcode video, copy audio"
+        else:
+            action = "transcode video and audio"
+        if len(self.audio_copies) > 1:
+            action += f" ({len(self.audio_copies)} audio tracks)"
+        if self.keeps_original:
+            subtitles = sum(1 for codec in self.subtitle_codecs if codec)
+            action += f", keeping {len(self.original_audio)} original audio and {subtitles} subtitle track(s)"
+        if self.audio_prep:
+            action += " with audio processing"
+        return f"{action} into {self.container}"
+
+    def codec_args(self, tuned=True):
+        """FFmpeg -c:v/-c:a arguments for this plan"""
+        args = ["-c:v"]
+        args += ["copy"] if self.copy_video else self._video_encode_args(tuned)
+        if len(self.audio_copies) == 1:
+            args += ["-c:a"]
+            args += ["copy"] if self.copy_audio else AUDIO_ENCODE_ARGS[self.mode]
+            return args
+        for index, copy in enumerate(self.audio_copies):
+            encoder = ["copy"] if copy else AUDIO_ENCODE_ARGS[self.mode]
+            # Per-stream options such as -b:a apply to this output stream only
+            args += [f"-c:a:{index}", encoder[0]]
+            args += [f"{option}:{index}" if option.startswith("-") else option for option in encoder[1:]]
+        return args
+
+    def audio_filter_args(self):
+        """FFmpeg -filter:a options for the prepared audio_filters"""
+        args = []
+        for index, chain in enumerate(self.audio_filters or []):
+            if chain:
+                args += [f"-filter:a:{index}", chain]
+        return args
+
+    def dub_disposition(self, index):
+        """FFmpeg -disposition value for the dub track at index"""
+        return "default" if index == 0 and not self.original_default else "0"
+
+    def title_args(self, stream, title):
+        """FFmpeg options naming the output stream (e.g. "a:1") title"""
+        args = [f"-metadata:s:{stream}", f"title={title}"]
+        # MP4 players show the handler name as the track's name
+        if self.container == "mp4":
+            args += [f"-metadata:s:{stream}", f"handler_name={title}"]
+        return args
+
+    def original_track_args(self, source_input=0):
+        """FFmpeg -map and per-stream options for the tracks kept from input source_input"""
+        args = []
+        for n, title in enumerate(self.original_audio):
+            index = self.dub_tracks + n
+            args += ["-map", f"{source_input}:a:{n}",
+                     f"-disposition:a:{index}", "default" if self.original_default and n == 0 else "0"]
+            args += self.title_args(f"a:{index}", title)
+        index = 0
+        for n, codec in enumerate(self.subtitle_codecs):
+            if codec is None:
+                continue
+            args += ["-map", f"{source_input}:s:{n}", f"-c:s:{index}", codec]
+            index += 1
+        return args
+
+    def muxer_args(self):
+        """FFmpeg output options for the file layout"""
+        if self.container != "mp4":
+            return []
+        return ["-movflags", FRAGMENTED_MOVFLAGS if self.fragmented else FASTSTART_MOVFLAGS]
+
+    def _video_encode_args(self, tuned):
+        args = list(VIDEO_ENCODE_ARGS[self.mode])
+        if not tuned or not self.encoder:
+            return args
+        args[args.index("-preset") + 1] = self.encoder["preset"]
+        return args + ["-threads", str(self.encoder["threads"])]
+
+    def cache_options(self):
+        """Normalized options that determine the output bytes
+        
+        The tuned preset depends on load at the time of the merge, so it is
+        left out: any preset of the mode gives an equivalent result.
+        """
+        options = {
+            "container": self.container,
+            "codec_args": self.codec_args(tuned=False),
+            "muxer_args": self.muxer_args(),
+        }
+        if self.audio_prep:
+            options["audio_prep"] = self.audio_prep.to_dict()
+        if self.keeps_original:
+            options["original_tracks"] = self.original_track_args()
+        return options
+
+    def to_dict(self):
+        return {
+            "container": self.container,
+            "copy_video": self.copy_video,
+            "copy_audio": self.copy_audio,
+            "audio_copies": self.audio_copies,
+            "mode": self.mode,
+            "encoder": self.encoder,
+            "fragmented": self.fragmented,
+            "audio_prep": self.audio_prep.to_dict() if self.audio_prep else None,
+            "original_audio": self.original_audio,
+            "subtitle_codecs": self.subtitle_codecs,
+            "original_default": self.original_default,
+            "description": self.description,
+        }
+
+
+def container_for_path(path):
+    ext = os.path.splitext(path)[1].lower()
+    return "mkv" if ext in (".mkv", ".mka") else "mp4"
+
+
+def accepts(container, codec, table):
+    allowed = table.get(container)
+    if codec is None:
+        return False
+    return allowed is None or codec in allowed
+
+
+def subtitle_codec(container, codec):
+    """"copy", the encoder to convert a subtitle codec with, or None if container can't hold it"""
+    if codec in CONTAINER_SUBTITLE_CODECS[container]:
+        return "copy"
+    if codec in TEXT_SUBTITLE_CODECS:
+        return SUBTITLE_ENCODERS[container]
+    return None
+
+
+def plan_merge(video_info, audio_info, output_path, fast_mode=False, allow_container_change=True,
+               audio_codec=None, progressive=False, audio_prep=None, keep_original=False, original_default=False):
+    """Plan a merge from probed MediaInfo of both inputs
+    
+    audio_codec is a hint used when the audio can't be probed (e.g. when it
+    is streamed into FFmpeg); without either the audio is transcoded.
+    progressive asks for output that can be played while it is written;
+    remuxes finish quickly and get faststart instead. audio_prep is an
+    optional AudioPrep for the audio. keep_original keeps the video's own
+    audio and subtitle tracks after the dub, with the first original audio
+    track as the default if original_default.
+    """
+    if audio_info is not None:
+        audio_codec = audio_info.audio_codec
+    return _plan_tracks(video_info, [audio_codec], output_path, fast_mode, allow_container_change, progressive,
+                        audio_prep, keep_original, original_default)
+
+
+def plan_multi_audio(video_info, audio_infos, output_path, fast_mode=False, allow_container_change=True,
+                     progressive=False, audio_prep=None, keep_original=False, original_default=False):
+    """Plan muxing several audio inputs as separate tracks alongside one video"""
+    audio_codecs = [info.audio_codec if info else None for info in audio_infos]
+    return _plan_tracks(video_info, audio_codecs, output_path, fast_mode, allow_container_change, progressive,
+                        audio_prep, keep_original, original_default)
+
+
+def _plan_tracks(video_info, audio_codecs, output_path, fast_mode, allow_container_change, progressive=False,
+                 audio_prep=None, keep_original=False, original_default=False):
+    mode = "fast" if fast_mode else "default"
+    container = container_for_path(output_path)
+
+    video_codec = video_info.video_codec if video_info else None
+    dubs = len(audio_codecs)
+    original_streams = video_info.audio_streams if keep_original and video_info else []
+    subtitle_streams = video_info.subtitle_streams if keep_original and video_info else []
+    # Kept original audio is planned like the dubs, after them
+    audio_codecs = audio_codecs + [stream.codec_name for stream in original_streams]
+
+    copy_video = accepts(container, video_codec, CONTAINER_VIDEO_CODECS)
+    audio_copies = [accepts(container, codec, CONTAINER_AUDIO_CODECS) for codec in audio_codecs]
+    subtitle_codecs = [subtitle_codec(container, stream.codec_name) for stream in subtitle_streams]
+
+    # Without probe data keep the historical behaviour of copying video
+    if video_info is None:
+        copy_video = True
+
+    # A remux into Matroska beats any transcode (or dropped subtitle) when speed is what matters
+    if (fast_mode and allow_container_change and container != "mkv"
+            and not (copy_video and all(audio_copies) and all(subtitle_codecs))
+            and video_codec and all(audio_codecs)):
+        container = "mkv"
+        output_path = os.path.splitext(output_path)[0] + ".mkv"
+        copy_video = copy_video or accepts(container, video_codec, CONTAINER_VIDEO_CODECS)
+        audio_copies = [copy or accepts(container, codec, CONTAINER_AUDIO_CODECS)
+                        for copy, codec in zip(audio_copies, audio_codecs)]
+        subtitle_codecs = [subtitle_codec(container, stream.codec_name) for stream in subtitle_streams]
+
+    # Filtered audio has to be encoded
+    if audio_prep is not None and audio_prep.active:
+        audio_copies[:dubs] = [False] * dubs
+
+    for stream, codec in zip(subtitle_streams, subtitle_codecs):
+        if codec is None:
+            logger.info(f"Leaving out {stream.codec_name} subtitles, which {container} can't hold")
+    plan = MergePlan(container, output_path, copy_video, all(audio_copies), mode, audio_copies=audio_copies,
+                     fragmented=progressive and not copy_video, audio_prep=audio_prep,
+                     original_audio=[stream.title or ORIGINAL_TRACK_TITLE for stream in original_streams],
+                     subtitle_codecs=subtitle_codecs, original_default=original_default)
+    logger.info(
+        f"Merge plan for {os.path.basename(output_path)}: {plan.description} "
+        f"(video={video_codec}, audio={','.join(str(codec) for codec in audio_codecs)}, mode={mode})"
+    )
+    return plan
+
+
+def tune_encoder(plan, video_info, active_jobs=1, profile=None, cpu_count=None):
+    """Set plan.encoder for a video transcode sharing the CPU with active_jobs merges
+    
+    The cores are split evenly between the running merges, which keeps
+    concurrent jobs from oversubscribing the CPU. With an encoder profile the
+    slowest preset expected to reach the mode's target speed on that share
+    is chosen; without one the mode's preset is kept. Returns plan.
+    """
+    if plan.copy_video:
+        return plan
+    cpu_count = cpu_count or os.cpu_count() or 1
+    threads = max(1, cpu_count // max(1, active_jobs))
+    base_args = VIDEO_ENCODE_ARGS[plan.mode]
+    preset = base_args[base_args.index("-preset") + 1]
+
+    profile = profile or get_profile()
+    if profile is not None:
+        width, height = (video_info.resolution if video_info else None) or (None, None)
+        width, height = (width, height) if width and height else (REFERENCE_WIDTH, REFERENCE_HEIGHT)
+        source_fps = (video_info.frame_rate if video_info else None) or 30
+        target_fps = TARGET_SPEED[plan.mode] * source_fps
+        candidates = [p for p in TUNED_PRESETS[plan.mode] if profile.fps(p, threads, width, height)]
+        if candidates:
+            preset = next((p for p in candidates if profile.fps(p, threads, width, height) >= target_fps),
+                          candidates[-1])
+
+    plan.encoder = {"preset": preset, "threads": threads}
+    logger.info(
+        f"Encoder for {os.path.basename(plan.output_path)}: preset={preset}, threads={threads} "
+        f"({active_jobs} active job(s), profile={'yes' if profile else 'no'})"
+    )
+    return plan
@@ -0,0 +1,357 @@
+"""
+Prometheus-style metrics shared by the web app, the bot and the merge pipeline.
+
+Counters, gauges and histograms live in this module and are updated in place
+by the code that does the work. Each process periodically writes a snapshot
+of its metrics under METRICS_DIRECTORY, so the /metrics endpoint of any web
+worker reports the sum over every process on the host (gunicorn workers and
+the bot) in the Prometheus text format.
+
+StageTimer collects how long each stage of one job took (download, probe,
+queue, merge, upload, ...) and appends them as one JSON line to
+JOB_TIMING_LOG when the job finishes. Code wrapped in timed(stage) feeds both
+the per-stage histogram and the timer of the job it runs for.
+"""
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from config import METRICS_DIRECTORY, METRICS_FLUSH_INTERVAL, JOB_TIMING_LOG
+
+logger = logging.getLogger(__name__)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """{label values: value} snapshot"""
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        registry.touch()
+
+
+class Gauge(_Metric):
+    """Value that goes up and down"""
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+        registry.touch()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        registry.touch()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the wrapped block as in progress while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        self.buckets = sorted(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            index = bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts = list(counts)
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+        registry.touch()
+
+
+class Registry:
+    """All metrics of this process, with snapshot files for the other processes"""
+
+    def __init__(self, directory=METRICS_DIRECTORY, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def touch(self):
+        """Start the snapshot writer the first time this process records anything"""
+        # Threads do not survive fork(), so start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        threading.Thread(target=self._flush_loop, name="metrics-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def snapshot(self):
+        metrics = {}
+        for name, metric in list(self._metrics.items()):
+            metrics[name] = {
+                "type": metric.type,
+                "help": metric.documentation,
+                "labels": list(metric.labelnames),
+                "buckets": getattr(metric, "buckets", None),
+                "samples": [[list(key), value] for key, value in metric.samples().items()],
+            }
+        return {"pid": os.getpid(), "written_at": time.time(), "metrics": metrics}
+
+    def flush(self):
+        """Write this process's snapshot for the other processes to read"""
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Error writing metrics snapshot: {e}")
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def collect(self):
+        """Snapshots of every live process on this host, this one read live"""
+        snapshots = [self.snapshot()]
+        if not os.path.isdir(self.directory):
+            return snapshots
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                pid = int(entry.name[:-len(".json")])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            if not _process_alive(pid):
+                # Gauges of a dead process would otherwise stick forever
+                _remove(entry.path)
+                continue
+            try:
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """All metrics summed over every process, in the Prometheus text format"""
+        merged = {}
+        for snapshot in self.collect():
+            for name, metric in snapshot["metrics"].items():
+                target = merged.setdefault(name, {**metric, "samples": {}})
+                for key, value in metric["samples"]:
+                    key = tuple(key)
+                    target["samples"][key] = _add(target["samples"].get(key), value)
+
+        lines = []
+        for name in sorted(merged):
+            metric = merged[name]
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric["samples"].items()):
+                labels = dict(zip(metric["labels"], key))
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric["buckets"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _add(current, value):
+    if current is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        counts, total, count = value
+        current_counts, current_total, current_count = current
+        return ([a + b for a, b in zip(current_counts, counts)], current_total + total, current_count + count)
+    return current + value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+registry = Registry()
+
+STAGE_SECONDS = Histogram(
+    "merge_stage_seconds", "Time spent in each stage of handling a merge", ["stage"],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+)
+QUEUE_DEPTH = Gauge("merge_queue_depth", "Jobs waiting for an FFmpeg slot")
+ACTIVE_FFMPEG = Gauge("ffmpeg_active_processes", "FFmpeg processes currently running")
+FFMPEG_SPEED = Histogram(
+    "ffmpeg_speed_ratio", "Seconds of media processed per second of FFmpeg run time",
+    buckets=[0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]
+)
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups by cache and result (hit/miss)", ["cache", "result"])
+BYTES_PROCESSED = Counter("merge_bytes_total", "Bytes of media read (input) and written (output) by merges",
+                          ["direction"])
+FAILURES = Counter("failures_total", "Failures by stage and reason", ["stage", "reason"])
+JOBS = Counter("merge_jobs_total", "Finished jobs by status", ["status"])
+
+
+_current_timer = ContextVar("current_timer", default=None)
+
+
+class StageTimer:
+    """Stage durations of one job, written as a JSON line to JOB_TIMING_LOG by finish()"""
+
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+        self.stages = {}
+        self.started_at = time.time()
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def active(self):
+        """Make timed() blocks in this context (and threads it starts via asyncio.to_thread) count here"""
+        token = _current_timer.set(self)
+        try:
+            yield self
+        finally:
+            _current_timer.reset(token)
+
+    def finish(self, status, reason=None, **fields):
+        """Write the timing record once; later calls are ignored"""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            stages = {stage: round(seconds, 3) for stage, seconds in self.stages.items()}
+        record = {
+            "kind": self.kind,
+            **self.fields,
+            **fields,
+            "status": status,
+            "reason": reason,
+            "started_at": self.started_at,
+            "finished_at": time.time(),
+            "total_s": round(time.time() - self.started_at, 3),
+            "stages": stages,
+        }
+        try:
+            with open(JOB_TIMING_LOG, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            logger.error(f"Error writing job timing record: {e}")
+
+
+@contextmanager
+def timed(stage, timer=None):
+    """Observe how long the block takes as stage, for timer or the job being run"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timer = timer or _current_timer.get()
+        if timer is not None:
+            timer.add(stage, elapsed)
+
+
+def current_timer():
+    """The StageTimer of the job running in this context, or None"""
+    return _current_timer.get()
+
+
+def record_failure(stage, error):
+    """Count a failure in stage, by a low-cardinality reason derived from error"""
+    reason = error if isinstance(error, str) else type(error).__name__
+    FAILURES.inc(stage=stage, reason=reason)
+    return reason
@@ -0,0 +1,213 @@
+"""
+Single-pass ffprobe with an in-process LRU cache.
+
+probe(path) runs ffprobe once with JSON output and returns a MediaInfo. The
+result is cached by (path, size, mtime), so validation, merge planning,
+progress ETA and the download page all share one ffprobe run per file.
+"""
+import os
+import json
+import logging
+import subprocess
+import threading
+from collections import OrderedDict
+
+from config import PROBE_CACHE_SIZE
+from metrics import CACHE_LOOKUPS, timed
+
+logger = logging.getLogger(__name__)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_rate(value):
+    """Frame rate from ffprobe's "30000/1001" form"""
+    numerator, _, denominator = (value or "").partition("/")
+    numerator, denominator = _to_float(numerator), _to_float(denominator or "1")
+    if not numerator or not denominator:
+        return None
+    return numerator / denominator
+
+
+class StreamInfo:
+    """One stream as reported by ffprobe"""
+
+    __slots__ = (
+        "index", "codec_type", "codec_name", "profile", "width", "height",
+        "sample_rate", "channels", "bit_rate", "duration", "frame_rate", "language", "title",
+        "is_default", "is_attached_pic",
+    )
+
+    def __init__(self, data):
+        tags = data.get("tags") or {}
+        disposition = data.get("disposition") or {}
+        self.index = _to_int(data.get("index"))
+        self.codec_type = data.get("codec_type")
+        self.codec_name = data.get("codec_name")
+        self.profile = data.get("profile")
+        self.width = _to_int(data.get("width"))
+        self.height = _to_int(data.get("height"))
+        self.sample_rate = _to_int(data.get("sample_rate"))
+        self.channels = _to_int(data.get("channels"))
+        self.bit_rate = _to_int(data.get("bit_rate"))
+        self.duration = _to_float(data.get("duration"))
+        self.frame_rate = _to_rate(data.get("avg_frame_rate"))
+        self.language = tags.get("language")
+        self.title = tags.get("title")
+        self.is_default = bool(disposition.get("default"))
+        self.is_attached_pic = bool(disposition.get("attached_pic"))
+
+    def __repr__(self):
+        return f"<StreamInfo #{self.index} {self.codec_type}:{self.codec_name}>"
+
+
+class MediaInfo:
+    """Container-level metadata and streams of a media file"""
+
+    __slots__ = ("path", "container", "duration", "bit_rate", "size", "streams")
+
+    def __init__(self, path, data):
+        fmt = data.get("format") or {}
+        self.path = path
+        self.container = fmt.get("format_name")
+        self.duration = _to_float(fmt.get("duration"))
+        self.bit_rate = _to_int(fmt.get("bit_rate"))
+        self.size = _to_int(fmt.get("size"))
+        self.streams = [StreamInfo(stream) for stream in data.get("streams") or []]
+
+    @property
+    def video_streams(self):
+        # Cover art in audio files shows up as a video stream; skip it
+        return [s for s in self.streams if s.codec_type == "video" and not s.is_attached_pic]
+
+    @property
+    def audio_streams(self):
+        return [s for s in self.streams if s.codec_type == "audio"]
+
+    @property
+    def subtitle_streams(self):
+        return [s for s in self.streams if s.codec_type == "subtitle"]
+
+    @property
+    def has_video(self):
+        return bool(self.video_streams)
+
+    @property
+    def has_audio(self):
+        return bool(self.audio_streams)
+
+    @property
+    def video_codec(self):
+        streams = self.video_streams
+        return streams[0].codec_name if streams else None
+
+    @property
+    def audio_codec(self):
+        streams = self.audio_streams
+        return streams[0].codec_name if streams else None
+
+    @property
+    def resolution(self):
+        """(width, height) of the first video stream, or None"""
+        streams = self.video_streams
+        if not streams or not streams[0].width:
+            return None
+        return streams[0].width, streams[0].height
+
+    @property
+    def frame_rate(self):
+        """Average frame rate of the first video stream, or None"""
+        streams = self.video_streams
+        return streams[0].frame_rate if streams else None
+
+    def to_dict(self):
+        return {
+            "container": self.container,
+            "duration": self.duration,
+            "bit_rate": self.bit_rate,
+            "size": self.size,
+            "video_codec": self.video_codec,
+            "audio_codec": self.audio_codec,
+            "resolution": self.resolution,
+        }
+
+    def __repr__(self):
+        return f"<MediaInfo {self.path} {self.container} {self.duration}s>"
+
+
+class ProbeCache:
+    """Thread-safe LRU cache of MediaInfo keyed by (path, size, mtime)"""
+
+    def __init__(self, max_entries=PROBE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None:
+                self._entries.move_to_end(key)
+            return info
+
+    def put(self, key, info):
+        with self._lock:
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = ProbeCache()
+
+
+def probe(file_path):
+    """Return a MediaInfo for file_path, or None if it can't be probed"""
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        logger.error(f"Error probing {file_path}: {e}")
+        return None
+
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    info = _cache.get(key)
+    CACHE_LOOKUPS.inc(cache="probe", result="hit" if info is not None else "miss")
+    if info is not None:
+        return info
+
+    try:
+        cmd = [
+            "ffprobe", "-v", "error", "-print_format", "json",
+            "-show_format", "-show_streams", file_path
+        ]
+        with timed("probe"):
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+
+        if process.returncode != 0:
+            logger.error(f"FFprobe error for {file_path}: {stderr.decode(errors='replace')}")
+            return None
+
+        info = MediaInfo(file_path, json.loads(stdout.decode()))
+    except Exception as e:
+        logger.error(f"Error probing {file_path}: {e}")
+        return None
+
+    _cache.put(key, info)
+    return info
@@ -0,0 +1,188 @@
+"""
+Content-addressed cache of merge results on local disk.
+
+Entries are keyed by a hash of the video bytes, the audio bytes and the
+normalized merge options, so resending the same episode with the same dub
+returns the stored output without starting FFmpeg. Entries are published
+atomically with os.replace() and evicted least-recently-used first once the
+cache grows past its size budget.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from config import TEMP_DIRECTORY, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_ENABLED
+from metrics import CACHE_LOOKUPS
+from session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+# Bump when the merge pipeline changes in a way that invalidates old outputs
+CACHE_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+_digests = OrderedDict()
+_digests_lock = threading.Lock()
+_MAX_DIGESTS = 1024
+
+
+def file_digest(file_path):
+    """Streaming SHA-256 of a file, memoized by (path, size, mtime)"""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        digest = _digests.get(key)
+        if digest is not None:
+            _digests.move_to_end(key)
+            return digest
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _remember(key, digest)
+    return digest
+
+
+def remember_digest(file_path, digest):
+    """Tell file_digest the digest of a file hashed elsewhere, e.g. while it was written"""
+    stat = os.stat(file_path)
+    _remember((os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns), digest)
+
+
+def digest_key(file_path, stat=None):
+    """Session store key of a file's digest, so every worker can look it up"""
+    stat = stat or os.stat(file_path)
+    return f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def share_digest(file_path):
+    """Hash a finished output and publish the digest for the web workers' ETags"""
+    try:
+        stat = os.stat(file_path)
+        session_store.set('digest', digest_key(file_path, stat), file_digest(file_path))
+    except Exception as e:
+        logger.error(f"Error sharing digest of {file_path}: {e}")
+
+
+def _remember(key, digest):
+    with _digests_lock:
+        _digests[key] = digest
+        _digests.move_to_end(key)
+        while len(_digests) > _MAX_DIGESTS:
+            _digests.popitem(last=False)
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst (replacing dst), copying if linking isn't possible"""
+    tmp_path = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class ResultCache:
+    """Disk-backed LRU store of merged outputs"""
+
+    def __init__(self, directory=None, max_bytes=RESULT_CACHE_MAX_BYTES, enabled=RESULT_CACHE_ENABLED):
+        self.directory = directory or os.path.join(TEMP_DIRECTORY, "result_cache")
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+    def make_key(self, video_path, audio_path, options):
+        """Cache key for a merge of these inputs with these (JSON-able) options
+        
+        audio_path may also be a list of paths for multi-track merges.
+        """
+        if not self.enabled:
+            return None
+        audio_paths = [audio_path] if isinstance(audio_path, str) else audio_path
+        try:
+            sha = hashlib.sha256()
+            sha.update(f"v{CACHE_VERSION}\0".encode())
+            sha.update(file_digest(video_path).encode())
+            sha.update(b"\0")
+            for path in audio_paths:
+                sha.update(file_digest(path).encode())
+                sha.update(b"\0")
+            sha.update(json.dumps(options, sort_keys=True).encode())
+            return sha.hexdigest()
+        except Exception as e:
+            logger.error(f"Error computing result cache key: {e}")
+            return None
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.directory, f"{key}{ext}")
+
+    def fetch(self, key, output_path):
+        """Place a cached result at output_path; returns True on a hit"""
+        if not key:
+            return False
+        entry = self._entry_path(key, os.path.splitext(output_path)[1])
+        try:
+            link_or_copy(entry, output_path)
+            # Refresh the entry's position in the LRU order
+            os.utime(entry)
+        except FileNotFoundError:
+            CACHE_LOOKUPS.inc(cache="result", result="miss")
+            return False
+        except Exception as e:
+            logger.error(f"Error reading result cache entry {key}: {e}")
+            CACHE_LOOKUPS.inc(cache="result", result="miss")
+            return False
+        logger.info(f"Result cache hit for {os.path.basename(output_path)}")
+        CACHE_LOOKUPS.inc(cache="result", result="hit")
+        return True
+
+    def store(self, key, output_path):
+        """Publish a finished output under key"""
+        if not key:
+            return
+        entry = self._entry_path(key, os.path.splitext(output_path)[1])
+        try:
+            link_or_copy(output_path, entry)
+        except Exception as e:
+            logger.error(f"Error storing result cache entry {key}: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits its budget"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    logger.info(f"Evicted result cache entry {os.path.basename(path)}")
+                except FileNotFoundError:
+                    total -= size
+                except Exception as e:
+                    logger.error(f"Error evicting result cache entry {path}: {e}")
+
+
+# Shared cache instance
+result_cache = ResultCache()
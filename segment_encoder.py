@@ -0,0 +1,421 @@
+"""
+Segment-parallel transcoding for long merges.
+
+A single libx264 process (ultrafast in particular) can't keep a many-core
+machine busy, so
+long videos are split at keyframes (stream copy, no quality loss) into
+SEGMENT_DURATION pieces that are encoded at the same time, SEGMENT_THREADS
+x264 threads each. The encoded pieces are joined with the concat demuxer
+(stream copy again) and the audio is muxed in that same final pass.
+
+Segments can also be encoded on other hosts: each entry of SEGMENT_WORKERS
+is a `python segment_encoder.py worker` process that takes a segment in a
+POST body and answers with the encoded segment. A segment whose remote
+encode fails is encoded locally instead.
+
+merge_video_audio() and merge_video_audio_async() take the same arguments as
+the MediaProcessor methods, and should_segment() tells whether a plan is
+worth splitting.
+"""
+import os
+import csv
+import hmac
+import queue
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import time
+import http.client
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from config import (
+    TEMP_DIRECTORY, SEGMENT_ENCODING, SEGMENT_MIN_DURATION, SEGMENT_DURATION, SEGMENT_THREADS,
+    SEGMENT_WORKERS, SEGMENT_WORKER_SLOTS, SEGMENT_WORKER_TOKEN, SEGMENT_WORKER_TIMEOUT
+)
+from ffmpeg_progress import MergeProgress, iter_progress
+from media_processor import MediaProcessor
+from merge_planner import MergePlan, VIDEO_ENCODE_ARGS, TUNED_PRESETS
+from audio_prep import prepare_plan
+from metrics import ACTIVE_FFMPEG, timed
+from probe import probe
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024  # 1MB
+DEFAULT_WORKER_PORT = 8765
+
+
+class SegmentError(Exception):
+    """An FFmpeg step or a remote worker failed"""
+
+
+def local_slots(plan, cpu_count=None):
+    """Segments encoded at once on this host for plan"""
+    threads = (plan.encoder or {}).get("threads") or cpu_count or os.cpu_count() or 1
+    return max(1, threads // max(1, SEGMENT_THREADS))
+
+
+def should_segment(plan, duration, workers=SEGMENT_WORKERS):
+    """True if plan is a video transcode long enough to gain from splitting"""
+    if not SEGMENT_ENCODING or plan.copy_video:
+        return False
+    if not duration or duration < max(SEGMENT_MIN_DURATION, 2 * SEGMENT_DURATION):
+        return False
+    return local_slots(plan) + len(workers) * SEGMENT_WORKER_SLOTS > 1
+
+
+def encode_args(mode, preset, threads):
+    """x264 arguments for one segment; also what a remote worker runs"""
+    args = list(VIDEO_ENCODE_ARGS[mode])
+    args[args.index("-preset") + 1] = preset
+    return ["-c:v", *args, "-threads", str(threads)]
+
+
+def _plan_preset(plan):
+    if plan.encoder:
+        return plan.encoder["preset"]
+    base_args = VIDEO_ENCODE_ARGS[plan.mode]
+    return base_args[base_args.index("-preset") + 1]
+
+
+def _run(cmd, processes, duration=None, progress_callback=None):
+    """Run an FFmpeg command, registered in processes so a cancel can kill it"""
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    processes.add(process)
+    stderr_tail = deque(maxlen=50)
+    stderr_reader = threading.Thread(target=lambda: stderr_tail.extend(process.stderr), daemon=True)
+    stderr_reader.start()
+    try:
+        with ACTIVE_FFMPEG.track():
+            for progress in iter_progress(process.stdout, duration):
+                if progress_callback:
+                    progress_callback(progress)
+            process.wait()
+        stderr_reader.join()
+    finally:
+        processes.discard(process)
+    if process.returncode != 0:
+        raise SegmentError(b"".join(stderr_tail).decode(errors="replace") or
+                           f"FFmpeg exited with {process.returncode}")
+
+
+def split_video(video_path, workdir, processes, segment_duration=SEGMENT_DURATION):
+    """Copy the first video stream into keyframe-aligned pieces; returns [(path, duration)]"""
+    list_path = os.path.join(workdir, "segments.csv")
+    _run([
+        "ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-i", video_path,
+        "-map", "0:v:0", "-c", "copy", "-f", "segment", "-segment_time", str(segment_duration),
+        "-segment_format", "matroska", "-reset_timestamps", "1",
+        "-segment_list", list_path, "-segment_list_type", "csv",
+        os.path.join(workdir, "source_%05d.mkv"), "-y"
+    ], processes)
+    segments = []
+    with open(list_path, newline="") as f:
+        for name, start, end in csv.reader(f):
+            segments.append((os.path.join(workdir, name), float(end) - float(start)))
+    return segments
+
+
+class _Progress:
+    """Combined MergeProgress over segments encoded in parallel"""
+
+    def __init__(self, durations, callback):
+        self.durations = durations
+        self.total = sum(durations) or None
+        self.callback = callback
+        self._out_times = [0.0] * len(durations)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, index, out_time):
+        if not self.callback:
+            return
+        with self._lock:
+            self._out_times[index] = min(out_time, self.durations[index])
+            out_time = sum(self._out_times)
+        elapsed = time.monotonic() - self._started
+        try:
+            self.callback(MergeProgress(out_time=out_time, duration=self.total,
+                                        speed=out_time / elapsed if elapsed > 0 else None,
+                                        elapsed=elapsed))
+        except Exception as e:
+            logger.error(f"Error in progress callback: {e}")
+
+
+class SegmentEncoder:
+    """Encodes the segments of one merge on local FFmpeg processes and remote workers"""
+
+    def __init__(self, plan, workers=SEGMENT_WORKERS, token=SEGMENT_WORKER_TOKEN):
+        self.mode = plan.mode
+        self.preset = _plan_preset(plan)
+        self.slots = ["local"] * local_slots(plan)
+        for url in workers:
+            self.slots += [url] * SEGMENT_WORKER_SLOTS
+        self.token = token
+        self.cancelled = threading.Event()
+        self.processes = set()
+
+    def cancel(self):
+        self.cancelled.set()
+        for process in list(self.processes):
+            process.kill()
+
+    def encode_all(self, segments, workdir, progress_callback=None):
+        """Encode every segment; returns the encoded paths in order"""
+        progress = _Progress([duration for _, duration in segments], progress_callback)
+        pending = queue.Queue()
+        for index in range(len(segments)):
+            pending.put(index)
+        outputs = [os.path.join(workdir, f"encoded_{index:05d}.mkv") for index in range(len(segments))]
+        errors = []
+
+        def work(slot):
+            while not self.cancelled.is_set():
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                source, duration = segments[index]
+                try:
+                    self.encode(slot, source, outputs[index], duration,
+                                lambda out_time: progress.update(index, out_time))
+                    progress.update(index, duration)
+                except Exception as e:
+                    errors.append(e)
+                    self.cancel()
+
+        threads = [threading.Thread(target=work, args=(slot,), daemon=True)
+                   for slot in self.slots[:len(segments)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if self.cancelled.is_set():
+            raise SegmentError("Segment encoding was cancelled")
+        return outputs
+
+    def encode(self, slot, source, output, duration, report):
+        if slot != "local":
+            try:
+                encode_remote(slot, source, output, self.mode, self.preset, self.token)
+                return
+            except Exception as e:
+                if self.cancelled.is_set():
+                    raise
+                logger.error(f"Segment worker {slot} failed on {os.path.basename(source)}, "
+                             f"encoding locally: {e}")
+        cmd = ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1", "-i", source,
+               *encode_args(self.mode, self.preset, SEGMENT_THREADS), "-an", output, "-y"]
+        _run(cmd, self.processes, duration, lambda p: report(p.out_time))
+
+
+def encode_remote(url, source, output, mode, preset, token=SEGMENT_WORKER_TOKEN, timeout=SEGMENT_WORKER_TIMEOUT):
+    """Have the segment worker at url encode source into output"""
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+    try:
+        with open(source, "rb") as f:
+            connection.request("POST", "/encode", body=f, headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Length": str(os.path.getsize(source)),
+                "X-Segment-Mode": mode,
+                "X-Segment-Preset": preset,
+            })
+        response = connection.getresponse()
+        if response.status != 200:
+            raise SegmentError(f"HTTP {response.status}: {response.read(500).decode(errors='replace')}")
+        with open(output, "wb") as f:
+            shutil.copyfileobj(response, f, COPY_CHUNK_SIZE)
+    finally:
+        connection.close()
+
+
+def concat_with_audio(encoded, video_path, audio_path, plan, duration, processes):
+    """Join the encoded segments and mux the audio into plan.output_path"""
+    list_path = os.path.join(os.path.dirname(encoded[0]), "concat.txt")
+    with open(list_path, "w") as f:
+        for path in encoded:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    # Same audio decision as the planned merge, with the encoded video copied
+    copy_plan = MergePlan(plan.container, plan.output_path, True, plan.copy_audio, plan.mode,
+                          audio_copies=plan.audio_copies)
+    # Kept original tracks come from the source video, as a third input
+    source_args = ["-i", video_path] if plan.keeps_original else []
+    if os.path.exists(plan.output_path):
+        os.remove(plan.output_path)
+    _run([
+        "ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:1",
+        "-f", "concat", "-safe", "0", "-i", list_path, "-i", audio_path, *source_args,
+        *copy_plan.codec_args(), *plan.audio_filter_args(), "-map", "0:v",
+        *MediaProcessor._dub_track_args(plan, probe(audio_path)), *plan.original_track_args(source_input=2),
+        *plan.muxer_args(), *MediaProcessor._length_args(duration),
+        plan.output_path, "-y"
+    ], processes)
+
+
+def merge_video_audio(video_path, audio_path, output_path, fast_mode=False, progress_callback=None,
+                      plan=None, encoder=None):
+    """MediaProcessor.merge_video_audio with the video encoded in parallel segments"""
+    if plan is None:
+        plan = MediaProcessor.plan_merge(video_path, audio_path, output_path, fast_mode,
+                                         allow_container_change=False)
+    if plan.copy_video:
+        return MediaProcessor.merge_video_audio(video_path, audio_path, output_path, fast_mode,
+                                                progress_callback, plan=plan)
+
+    durations = [info.duration for info in (probe(video_path), probe(audio_path)) if info and info.duration]
+    duration = min(durations) if durations else None
+    encoder = encoder or SegmentEncoder(plan)
+    workdir = tempfile.mkdtemp(prefix=".segments_", dir=TEMP_DIRECTORY)
+    started = time.monotonic()
+    success, error = False, None
+    try:
+        # Any audio analysis needs the original video, not the segments
+        prepare_plan(plan, video_path, [audio_path])
+        with timed("merge"):
+            segments = split_video(video_path, workdir, encoder.processes)
+            logger.info(f"Encoding {os.path.basename(video_path)} as {len(segments)} segments "
+                        f"on {len(encoder.slots)} slot(s)")
+            encoded = encoder.encode_all(segments, workdir, progress_callback)
+            concat_with_audio(encoded, video_path, audio_path, plan, duration, encoder.processes)
+        success = True
+        if progress_callback:
+            progress_callback(MergeProgress(out_time=duration or 0.0, duration=duration,
+                                            elapsed=time.monotonic() - started, done=True))
+    except Exception as e:
+        if encoder.cancelled.is_set():
+            logger.info(f"Segmented merge of {os.path.basename(video_path)} cancelled")
+            error = "Cancelled"
+        else:
+            logger.error(f"Error in segmented merge: {e}")
+            error = str(e)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    MediaProcessor._record_run(success, duration, time.monotonic() - started)
+    return success, error
+
+
+async def merge_video_audio_async(video_path, audio_path, output_path, fast_mode=False,
+                                  progress_callback=None, plan=None):
+    """merge_video_audio for asyncio callers; cancelling kills the running encodes
+
+    progress_callback may be a plain function or a coroutine function.
+    """
+    loop = asyncio.get_running_loop()
+
+    def report(progress):
+        asyncio.run_coroutine_threadsafe(MediaProcessor._report_progress(progress_callback, progress), loop)
+
+    if plan is None:
+        plan = await asyncio.to_thread(MediaProcessor.plan_merge, video_path, audio_path, output_path,
+                                       fast_mode, allow_container_change=False)
+    encoder = SegmentEncoder(plan)
+    task = asyncio.ensure_future(asyncio.to_thread(
+        merge_video_audio, video_path, audio_path, output_path, fast_mode,
+        report if progress_callback else None, plan, encoder
+    ))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        encoder.cancel()
+        raise
+
+
+class _WorkerHandler(BaseHTTPRequestHandler):
+    """POST /encode: request body is a source segment, response body the encoded segment"""
+
+    token = None
+    slots = None
+
+    def do_POST(self):
+        if self.path != "/encode":
+            self.send_error(404)
+            return
+        authorization = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {self.token}".encode()):
+            self.send_error(403)
+            return
+        mode = self.headers.get("X-Segment-Mode")
+        preset = self.headers.get("X-Segment-Preset")
+        # Only settings the planner itself could have chosen, never raw FFmpeg arguments
+        if mode not in VIDEO_ENCODE_ARGS or preset not in TUNED_PRESETS[mode]:
+            self.send_error(400, "Unknown mode or preset")
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+
+        with self.slots, tempfile.TemporaryDirectory(prefix=".segment_worker_") as tmp:
+            source = os.path.join(tmp, "source.mkv")
+            output = os.path.join(tmp, "encoded.mkv")
+            with open(source, "wb") as f:
+                while length > 0:
+                    chunk = self.rfile.read(min(COPY_CHUNK_SIZE, length))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+            try:
+                _run(["ffmpeg", "-hide_banner", "-nostats", "-v", "error", "-i", source,
+                      *encode_args(mode, preset, SEGMENT_THREADS), "-an", output, "-y"], set())
+            except SegmentError as e:
+                logger.error(f"Error encoding segment: {e}")
+                self.send_error(500, "Encoding failed")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "video/x-matroska")
+            self.send_header("Content-Length", str(os.path.getsize(output)))
+            self.end_headers()
+            with open(output, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, COPY_CHUNK_SIZE)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def serve_worker(host, port, token, slots):
+    """Run a segment worker until interrupted"""
+    handler = type("WorkerHandler", (_WorkerHandler,), {
+        "token": token, "slots": threading.BoundedSemaphore(slots)
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info(f"Segment worker listening on {host}:{port} with {slots} slot(s)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Encode video segments for other merge hosts")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    worker = subcommands.add_parser("worker", help="serve segment encodes over HTTP")
+    worker.add_argument("--host", default="0.0.0.0")
+    worker.add_argument("--port", type=int, default=DEFAULT_WORKER_PORT)
+    worker.add_argument("--slots", type=int, default=max(1, (os.cpu_count() or 1) // max(1, SEGMENT_THREADS)),
+                        help="segments encoded at once")
+    worker.add_argument("--token", default=SEGMENT_WORKER_TOKEN, help="shared secret (SEGMENT_WORKER_TOKEN)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not args.token:
+        parser.error("a shared token is required (--token or SEGMENT_WORKER_TOKEN)")
+    serve_worker(args.host, args.port, args.token, args.slots)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Key/value store for web upload sessions and job status, shared across workers.
+
+Flask requests for one upload session can land on any gunicorn worker or
+replica, so session records (and snapshots of merge jobs, which only exist in
+the worker that queued them) live here rather than in module-level dicts.
+Records are JSON documents grouped by namespace and expire after a TTL.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pymongo
+
+from config import (SESSION_STORE, SESSION_DB_PATH, SESSION_TTL, MONGO_URI, DATABASE_NAME,
+                    SESSIONS_COLLECTION)
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySessionStore:
+    """Process-local store; only correct with a single web worker"""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            record = self._records.get((namespace, key))
+            if record is None:
+                return None
+            value, expires_at = record
+            if expires_at <= time.time():
+                del self._records[(namespace, key)]
+                return None
+            return value
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._records[(namespace, key)] = (value, expires_at)
+            self._purge_expired()
+        return True
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._records.pop((namespace, key), None)
+        return True
+
+    def _purge_expired(self):
+        now = time.time()
+        for record_key in [k for k, (_, expires_at) in self._records.items() if expires_at <= now]:
+            del self._records[record_key]
+
+
+class SQLiteSessionStore:
+    """Store in a SQLite file shared by every process on the host"""
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads or across fork()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key):
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM sessions WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (namespace, key, time.time())
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Error reading session {namespace}/{key}: {e}")
+            return None
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (namespace, key, json.dumps(value), now + (self.ttl if ttl is None else ttl))
+                )
+                conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            return True
+        except Exception as e:
+            logger.error(f"Error saving session {namespace}/{key}: {e}")
+            return False
+
+    def delete(self, namespace, key):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting session {namespace}/{key}: {e}")
+            return False
+
+
+class MongoSessionStore:
+    """Store in a MongoDB collection, for replicas on different hosts
+
+    Uses the synchronous pymongo client (Flask views are synchronous); expiry
+    is left to a TTL index on expires_at.
+    """
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        try:
+            self.client = pymongo.MongoClient(MONGO_URI)
+            self.sessions = self.client[DATABASE_NAME][SESSIONS_COLLECTION]
+            self.sessions.create_index("expires_at", expireAfterSeconds=0)
+            logger.info("MongoDB session store connected")
+        except Exception as e:
+            logger.error(f"MongoDB connection error: {e}")
+            raise
+
+    def get(self, namespace, key):
+        try:
+            record = self.sessions.find_one({"_id": f"{namespace}:{key}", "expires_at": {"$gt": _utcnow()}})
+            return record["value"] if record else None
+        except Exception as e:
+            logger.error(f"Error reading session {namespace}/{key}: {e}")
+            return None
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = _utcnow() + timedelta(seconds=self.ttl if ttl is None else ttl)
+        try:
+            self.sessions.replace_one(
+                {"_id": f"{namespace}:{key}"},
+                {"value": value, "expires_at": expires_at},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error saving session {namespace}/{key}: {e}")
+            return False
+
+    def delete(self, namespace, key):
+        try:
+            self.sessions.delete_one({"_id": f"{namespace}:{key}"})
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting session {namespace}/{key}: {e}")
+            return False
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+def create_session_store(backend=SESSION_STORE):
+    """Build the configured session store backend"""
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "mongo":
+        return MongoSessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown session store backend: {backend}")
+
+
+# Shared session store
+session_store = create_session_store()
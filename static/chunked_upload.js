@@ -0,0 +1,149 @@
+// Resumable chunked uploads for the video/audio upload forms.
+//
+// The selected File is sliced into chunks that are PUT to /upload/<id>?offset=N.
+// Failed chunks are retried with backoff, and the upload id is kept in
+// localStorage so a reload or dropped connection resumes instead of restarting.
+(function() {
+    const PARALLEL_CHUNKS = 3;
+    const MAX_ATTEMPTS = 8;
+
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+    async function requestJSON(url, options) {
+        const response = await fetch(url, options);
+        const body = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            const error = new Error(body.error || `Request failed (${response.status})`);
+            error.status = response.status;
+            throw error;
+        }
+        return body;
+    }
+
+    async function putChunk(upload, index, file) {
+        const start = index * upload.chunk_size;
+        const chunk = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+        for (let attempt = 1; ; attempt++) {
+            try {
+                return await requestJSON(`/upload/${upload.upload_id}?offset=${start}`, {
+                    method: 'PUT',
+                    headers: {'Content-Type': 'application/octet-stream'},
+                    body: chunk
+                });
+            } catch (error) {
+                // Client errors won't succeed on retry
+                if (attempt >= MAX_ATTEMPTS || (error.status >= 400 && error.status < 500)) {
+                    throw error;
+                }
+                await sleep(Math.min(30000, 1000 * 2 ** (attempt - 1)));
+            }
+        }
+    }
+
+    async function startOrResume(form, file) {
+        const kind = form.dataset.chunkedUpload;
+        const key = `chunked-upload:${kind}:${form.dataset.videoId || ''}:${file.name}:${file.size}:${file.lastModified}`;
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            try {
+                const upload = await requestJSON(`/upload/${savedId}`);
+                return {key, upload};
+            } catch (error) {
+                localStorage.removeItem(key);
+            }
+        }
+        const upload = await requestJSON('/upload/init', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                kind: kind,
+                filename: file.name,
+                size: file.size,
+                video_id: form.dataset.videoId
+            })
+        });
+        localStorage.setItem(key, upload.upload_id);
+        return {key, upload};
+    }
+
+    async function waitForJob(job, onStatus) {
+        for (;;) {
+            const status = await requestJSON(job.status_url).catch(() => null);
+            if (status && (status.status === 'done' || status.status === 'failed')) {
+                return;
+            }
+            if (status) {
+                onStatus(status);
+            }
+            await sleep(2000);
+        }
+    }
+
+    async function uploadFile(form, file, onProgress) {
+        const {key, upload} = await startOrResume(form, file);
+
+        // Optionally let FFmpeg start consuming the audio while it uploads
+        let mergeJob = null;
+        const streamToggle = form.querySelector('input[name="stream_merge"]');
+        if (streamToggle && streamToggle.checked) {
+            mergeJob = await requestJSON(form.dataset.streamMergeUrl, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({upload_id: upload.upload_id})
+            }).catch(() => null);
+        }
+
+        const pending = upload.missing_chunks.slice();
+        let received = upload.bytes_received;
+        onProgress(received / file.size);
+
+        const worker = async () => {
+            while (pending.length) {
+                const index = pending.shift();
+                const start = index * upload.chunk_size;
+                await putChunk(upload, index, file);
+                received += Math.min(upload.chunk_size, file.size - start);
+                onProgress(received / file.size);
+            }
+        };
+        await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+
+        const result = await requestJSON(`/upload/${upload.upload_id}/finalize`, {method: 'POST'});
+        localStorage.removeItem(key);
+        if (mergeJob) {
+            await waitForJob(mergeJob, () => onProgress(1, 'Merging...'));
+            return {redirect: mergeJob.download_url};
+        }
+        return result;
+    }
+
+    document.querySelectorAll('form[data-chunked-upload]').forEach(form => {
+        // Old browsers fall back to the plain multipart form post
+        if (!window.fetch || !window.Blob || !Blob.prototype.slice) {
+            return;
+        }
+        form.addEventListener('submit', function(e) {
+            const input = form.querySelector('input[type="file"]');
+            const file = input.files[0];
+            if (!file) {
+                return;
+            }
+            e.preventDefault();
+
+            const progressBar = form.querySelector('.progress-bar');
+            const progressLabel = form.querySelector('.progress-container .form-label');
+            uploadFile(form, file, (fraction, label) => {
+                const percent = Math.floor(fraction * 100);
+                progressBar.style.width = `${percent}%`;
+                progressLabel.textContent = label || `Uploading... ${percent}%`;
+            }).then(result => {
+                window.location = result.redirect;
+            }).catch(error => {
+                progressLabel.textContent = `Upload failed: ${error.message}. Submit again to resume.`;
+                const submitBtn = form.querySelector('button[type="submit"]');
+                submitBtn.disabled = false;
+                submitBtn.textContent = 'Resume Upload';
+            });
+        });
+    });
+})();
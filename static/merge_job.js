@@ -0,0 +1,84 @@
+// Submit a merge form in the background and poll the job until it finishes.
+//
+// Used by every form with a data-merge-job attribute. The form needs
+// #merge-status, #merge-progress and #merge-eta elements for the progress view,
+// and optionally a #merge-preview video that plays the output while it is written.
+(function() {
+    const formatEta = function(seconds) {
+        const minutes = Math.floor(seconds / 60);
+        const rest = Math.round(seconds % 60);
+        return minutes > 0 ? `${minutes}m ${rest}s` : `${rest}s`;
+    };
+
+    document.querySelectorAll('form[data-merge-job]').forEach(form => {
+        form.addEventListener('submit', function(e) {
+            e.preventDefault();
+            const statusLabel = form.querySelector('#merge-status');
+            const progressBar = form.querySelector('#merge-progress');
+            const etaLabel = form.querySelector('#merge-eta');
+            const preview = form.querySelector('#merge-preview');
+
+            fetch(this.action, {method: 'POST', body: new FormData(this)})
+                .then(response => response.json().then(job => {
+                    // 429 means the queue is full; show why instead of polling
+                    if (!response.ok) {
+                        statusLabel.textContent = job.error || 'The server is busy, please try again later.';
+                        progressBar.classList.remove('progress-bar-animated');
+                        return;
+                    }
+                    // Cached results come back already finished
+                    if (job.status === 'done') {
+                        window.location = job.download_url;
+                        return;
+                    }
+                    const poll = function() {
+                        fetch(job.status_url)
+                            .then(response => response.json())
+                            .then(status => {
+                                // Don't interrupt someone watching the preview; link to the download instead
+                                if (status.status === 'done' && preview && preview.src && !preview.paused) {
+                                    const link = document.createElement('a');
+                                    link.href = job.download_url;
+                                    link.textContent = 'Download';
+                                    statusLabel.replaceChildren('Merge finished. ', link);
+                                    progressBar.style.width = '100%';
+                                    etaLabel.textContent = '';
+                                    return;
+                                }
+                                if (status.status === 'done' || status.status === 'failed') {
+                                    window.location = job.download_url;
+                                    return;
+                                }
+                                const progress = status.progress;
+                                if (status.status === 'queued') {
+                                    statusLabel.textContent = status.queue_position
+                                        ? `Waiting for a free worker... (${status.queue_position} ahead of you)`
+                                        : 'Waiting for a free worker...';
+                                } else if (progress && progress.percent !== null) {
+                                    // Batch jobs also report which item is being merged
+                                    const item = progress.items > 1 ? ` (file ${progress.item} of ${progress.items})` : '';
+                                    statusLabel.textContent = `Merging files... ${Math.floor(progress.percent)}%${item}`;
+                                    progressBar.style.width = `${progress.percent}%`;
+                                    progressBar.classList.remove('progress-bar-animated');
+                                    // Fragmented output can be watched once the first fragments are written
+                                    if (preview && status.stream_url && !preview.src) {
+                                        preview.src = status.stream_url;
+                                        preview.classList.remove('d-none');
+                                    }
+                                    if (progress.eta !== null) {
+                                        etaLabel.textContent = `About ${formatEta(progress.eta)} remaining`
+                                            + (progress.speed ? ` (${progress.speed.toFixed(1)}x)` : '');
+                                    }
+                                } else {
+                                    statusLabel.textContent = 'Merging files...';
+                                }
+                                setTimeout(poll, 2000);
+                            })
+                            .catch(() => setTimeout(poll, 5000));
+                    };
+                    poll();
+                }))
+                .catch(() => { window.location.reload(); });
+        });
+    });
+})();
@@ -0,0 +1,346 @@
+"""
+Lifecycle of the files under TEMP_DIRECTORY.
+
+Every upload, download and merge output is tracked here with a reference
+count and an expiry time. Jobs hold a reference to their inputs while they
+run; a file is deleted once nothing references it and it has expired or been
+discarded. A background sweeper removes expired files, including ones left
+behind by other processes or a crash, and new files are refused before the
+temp directory outgrows its quota or the disk runs low.
+
+Room for a file is reserved before it is written and the reservation is held
+until the file is tracked or discarded, so concurrent uploads can't all pass
+the quota check against the same free space. Usage is kept as a running total
+that each sweep recounts from disk, rather than walked on every reservation.
+
+Other processes (gunicorn workers, the bot) can't see this process's
+references, so a file in use is also marked with a lease file under
+.leases whose mtime is kept fresh. Leases are used instead of touching the
+file itself because the probe and result caches key on the file's mtime.
+"""
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+from pathlib import Path
+
+from config import TEMP_DIRECTORY, TEMP_FILE_TTL, TEMP_SWEEP_INTERVAL, TEMP_DISK_QUOTA, MIN_FREE_DISK
+from chunked_upload import UPLOAD_STATE_DIRECTORY, finish_upload, load_upload
+from blob_store import blob_store
+from metrics import record_failure
+
+logger = logging.getLogger(__name__)
+
+
+class StorageFullError(Exception):
+    """Raised when a new file would exceed the temp quota or fill the disk"""
+
+
+class TrackedFile:
+    """Reference count and expiry of one temp file"""
+
+    __slots__ = ("path", "owner", "refs", "expires_at")
+
+    def __init__(self, path, owner=None, ttl=TEMP_FILE_TTL):
+        self.path = path
+        self.owner = owner
+        self.refs = 0
+        self.expires_at = time.time() + ttl
+
+    @property
+    def expired(self):
+        return self.expires_at <= time.time()
+
+
+class StorageManager:
+    """Tracks temp files, sweeps unused ones and enforces the disk quota"""
+
+    def __init__(self, directory=TEMP_DIRECTORY, ttl=TEMP_FILE_TTL, quota=TEMP_DISK_QUOTA,
+                 min_free=MIN_FREE_DISK, sweep_interval=TEMP_SWEEP_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.quota = quota
+        self.min_free = min_free
+        self.sweep_interval = sweep_interval
+        self.lease_directory = os.path.join(directory, ".leases")
+        self._files = {}
+        self._reserved = {}  # key -> (bytes, reserved at) for files not written yet
+        self._usage = None  # bytes under directory, recounted by each sweep
+        self._lock = threading.RLock()
+        self._pid = None
+        Path(self.lease_directory).mkdir(parents=True, exist_ok=True)
+
+    def allocate(self, owner, file_type, ext, size=None):
+        """Reserve room for a new file and return its tracked path"""
+        filename = f"{owner}_{uuid.uuid4().hex}.{ext}"
+        path = os.path.join(self.directory, filename)
+        self.reserve(size or 0, path)
+        self.track(path, owner=owner)
+        logger.debug(f"Allocated {file_type} file {filename}")
+        return path
+
+    def reserve(self, size, key=None):
+        """Hold size bytes for a file about to be written; returns the reservation key
+
+        key is normally the file's path: the hold is released once that path is
+        tracked with its contents on disk or discarded. Other keys are released
+        with unreserve(). Raises StorageFullError unless the bytes fit in the
+        quota and on disk.
+        """
+        key = key or uuid.uuid4().hex
+        if self._claim(key, size):
+            return key
+        # Expired files may be all that stands in the way
+        self.sweep()
+        if not self._claim(key, size):
+            # Blobs only kept in case the same file comes again go before new work is refused
+            if blob_store.sweep(max_age=0):
+                self._recount()
+        if not self._claim(key, size):
+            record_failure("storage", "storage_full")
+            raise StorageFullError("Not enough storage space right now, please try again later")
+        return key
+
+    def unreserve(self, key):
+        """Release a reservation that isn't tied to a tracked path"""
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def track(self, path, owner=None, ttl=None):
+        """Start tracking path; it expires after ttl seconds unless referenced"""
+        self.start()
+        with self._lock:
+            tracked = self._files.get(path)
+            if path in self._reserved:
+                self._settle(path)
+            if tracked is None:
+                self._files[path] = TrackedFile(path, owner, self.ttl if ttl is None else ttl)
+            else:
+                tracked.expires_at = max(tracked.expires_at, time.time() + (self.ttl if ttl is None else ttl))
+        self._touch_lease(path)
+        return path
+
+    def acquire(self, path):
+        """Take a reference that keeps path alive until release()"""
+        with self._lock:
+            tracked = self._files.get(path)
+            if tracked is None:
+                tracked = self._files[path] = TrackedFile(path, ttl=self.ttl)
+            tracked.refs += 1
+        self._touch_lease(path)
+
+    def release(self, path):
+        """Drop a reference; the file goes once unreferenced and expired"""
+        with self._lock:
+            tracked = self._files.get(path)
+            if tracked is None:
+                return
+            tracked.refs = max(0, tracked.refs - 1)
+            if tracked.refs or not tracked.expired:
+                return
+        self._delete(path)
+
+    def discard(self, paths):
+        """Expire paths now; each is deleted as soon as no job references it"""
+        for path in paths:
+            if not path:
+                continue
+            with self._lock:
+                self._reserved.pop(path, None)
+                tracked = self._files.get(path)
+                if tracked is None:
+                    tracked = self._files[path] = TrackedFile(path, ttl=0)
+                tracked.expires_at = time.time()
+                if tracked.refs:
+                    continue
+            self._delete(path)
+
+    def usage(self):
+        """Bytes used under the temp directory, counting hard-linked files once"""
+        seen = set()
+        total = 0
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(root, filename))
+                except FileNotFoundError:
+                    continue
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+        return total
+
+    def _claim(self, key, size):
+        """Reserve size bytes under key if they fit next to the other reservations"""
+        try:
+            free = shutil.disk_usage(self.directory).free
+        except OSError as e:
+            logger.error(f"Error checking free disk space: {e}")
+            free = None
+        with self._lock:
+            if self._usage is None:
+                self._usage = self.usage()
+            reserved = sum(held for held, _ in self._reserved.values())
+            if free is not None and free - reserved - size < self.min_free:
+                logger.warning(f"Refusing {size} bytes: only {free} bytes free on disk, {reserved} reserved")
+                return False
+            if self._usage + reserved + size > self.quota:
+                logger.warning(f"Refusing {size} bytes: temp directory is at its quota")
+                return False
+            held, _ = self._reserved.get(key, (0, None))
+            self._reserved[key] = (held + size, time.time())
+            return True
+
+    def _settle(self, path):
+        """Move a written file from its reservation into the usage total (lock held)"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Allocated but not written yet: keep holding the room
+            return
+        self._reserved.pop(path, None)
+        # Extra links (blobs, cached results) are already counted
+        if self._usage is not None and stat.st_nlink == 1:
+            self._usage += stat.st_size
+
+    def _recount(self):
+        """Replace the running usage total with a walk of the directory"""
+        usage = self.usage()
+        now = time.time()
+        with self._lock:
+            self._usage = usage
+            # Files on disk are in the walk now; holds nobody released have been forgotten
+            for key, (_, reserved_at) in list(self._reserved.items()):
+                if os.path.exists(key) or now - reserved_at > self.ttl:
+                    del self._reserved[key]
+
+    def start(self):
+        """Reconcile with the disk and start the sweeper (once per process)"""
+        # Threads do not survive fork(), so (re)start the sweeper in each process
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        self.reconcile()
+        threading.Thread(target=self._sweep_loop, name="temp-sweeper", daemon=True).start()
+
+    def reconcile(self):
+        """Bring tracking in line with the disk after a (re)start
+
+        Drops tracking for files that vanished, removes leases without a file
+        and sweeps whatever was left behind long enough to have expired.
+        """
+        with self._lock:
+            for path in [path for path in self._files if not os.path.exists(path)]:
+                del self._files[path]
+        for entry in os.scandir(self.lease_directory):
+            if not os.path.exists(os.path.join(self.directory, entry.name)):
+                self._remove(entry.path)
+        self.sweep()
+
+    def sweep(self):
+        """Delete expired, unreferenced files; returns how many were removed"""
+        now = time.time()
+        removed = 0
+        for entry in os.scandir(self.directory):
+            # Subdirectories (result cache, slots, leases) manage themselves
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            with self._lock:
+                tracked = self._files.get(entry.path)
+                if tracked is not None and tracked.refs:
+                    # Keep the lease fresh so other processes see the file in use
+                    self._touch_lease(entry.path)
+                    continue
+                if tracked is not None and not tracked.expired:
+                    continue
+            if tracked is None and now - self._last_used(entry) < self.ttl:
+                continue
+            if self._delete(entry.path):
+                removed += 1
+        removed += self._sweep_uploads(now)
+        removed += blob_store.sweep()
+        if removed:
+            logger.info(f"Swept {removed} expired temp file(s)")
+        self._recount()
+        return removed
+
+    def _sweep_uploads(self, now):
+        """Abandon chunked uploads that have seen no chunk for a whole TTL"""
+        removed = 0
+        if not os.path.isdir(UPLOAD_STATE_DIRECTORY):
+            return removed
+        for entry in os.scandir(UPLOAD_STATE_DIRECTORY):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                idle = now - entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if idle < self.ttl:
+                continue
+            upload_id = entry.name[:-len(".json")]
+            upload = load_upload(upload_id)
+            finish_upload(upload_id)
+            if upload is not None and self._delete(upload.path):
+                removed += 1
+        return removed
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping temp files: {e}")
+
+    def _last_used(self, entry):
+        """Newest of the file's mtime and its lease"""
+        last_used = entry.stat().st_mtime
+        try:
+            last_used = max(last_used, os.stat(self._lease_path(entry.path)).st_mtime)
+        except FileNotFoundError:
+            pass
+        return last_used
+
+    def _lease_path(self, path):
+        return os.path.join(self.lease_directory, os.path.basename(path))
+
+    def _touch_lease(self, path):
+        try:
+            Path(self._lease_path(path)).touch()
+        except OSError as e:
+            logger.error(f"Error updating lease for {path}: {e}")
+
+    def _delete(self, path):
+        with self._lock:
+            self._files.pop(path, None)
+            self._reserved.pop(path, None)
+        self._remove(self._lease_path(path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        removed = self._remove(path)
+        if removed and stat is not None and stat.st_nlink == 1:
+            with self._lock:
+                if self._usage is not None:
+                    self._usage = max(0, self._usage - stat.st_size)
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(f"Error removing temporary file {path}: {e}")
+            return False
+
+
+# Shared storage manager
+storage = StorageManager()
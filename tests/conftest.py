@@ -0,0 +1,8 @@
+"""Keep the state modules write at import time out of the working tree."""
+import os
+import tempfile
+
+_state_directory = tempfile.mkdtemp(prefix="merge-bot-tests-")
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("METRICS_DIRECTORY", os.path.join(_state_directory, "metrics"))
+os.environ.setdefault("JOB_TIMING_LOG", os.path.join(_state_directory, "job_timings.jsonl"))
@@ -0,0 +1,117 @@
+"""Chunked uploads: positioned writes, and sealing the file before it is shared."""
+import io
+import os
+import hashlib
+import threading
+
+import pytest
+
+import chunked_upload
+from blob_store import BlobStore
+from chunked_upload import UploadError, create_upload, seal_upload, write_chunk
+
+SIZE = 1000
+
+
+@pytest.fixture(autouse=True)
+def state_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunked_upload, "UPLOAD_STATE_DIRECTORY", str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def upload(tmp_path):
+    return create_upload("video", "video.mp4", str(tmp_path / "video.mp4"), SIZE)
+
+
+def sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class SlowStream:
+    """Hands out data only once release is set"""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def read(self, size):
+        self.started.set()
+        self.release.wait(5)
+        return self.data.read(size)
+
+
+def test_chunks_complete_upload(upload):
+    write_chunk(upload.upload_id, 0, io.BytesIO(b"a" * SIZE), SIZE)
+
+    sealed = seal_upload(upload.upload_id)
+    assert sealed.is_complete
+    assert sealed.finalized
+    with open(upload.path, "rb") as f:
+        assert f.read() == b"a" * SIZE
+
+
+def test_incomplete_upload_is_not_sealed(upload):
+    sealed = seal_upload(upload.upload_id)
+
+    assert not sealed.finalized
+    # Still open for chunks
+    write_chunk(upload.upload_id, 0, io.BytesIO(b"a" * SIZE), SIZE)
+
+
+def test_rejects_bad_chunks(upload):
+    with pytest.raises(UploadError) as error:
+        write_chunk(upload.upload_id, 1, io.BytesIO(b"a" * SIZE), SIZE)
+    assert error.value.status == 400
+    with pytest.raises(UploadError) as error:
+        write_chunk("missing", 0, io.BytesIO(b"a" * SIZE), SIZE)
+    assert error.value.status == 404
+
+
+def test_late_chunk_cannot_change_shared_blob(tmp_path, upload):
+    write_chunk(upload.upload_id, 0, io.BytesIO(b"a" * SIZE), SIZE)
+
+    # A chunk is in flight when the client finalizes
+    stream = SlowStream(b"b" * SIZE)
+    writer = threading.Thread(target=write_chunk, args=(upload.upload_id, 0, stream, SIZE))
+    writer.start()
+    assert stream.started.wait(5)
+    sealed = []
+    sealer = threading.Thread(target=lambda: sealed.append(seal_upload(upload.upload_id)))
+    sealer.start()
+    sealer.join(0.2)
+    assert sealer.is_alive(), "sealing must wait for the chunk being written"
+    stream.release.set()
+    writer.join(5)
+    sealer.join(5)
+    assert sealed[0].finalized
+
+    # Validated and linked into the blob store, where other uploads share it
+    blobs = BlobStore(directory=str(tmp_path / "blobs"), enabled=True)
+    digest = blobs.ingest(upload.path)
+    blob = blobs.blob_path(digest)
+    assert os.path.samefile(blob, upload.path)
+
+    with pytest.raises(UploadError) as error:
+        write_chunk(upload.upload_id, 0, io.BytesIO(b"c" * SIZE), SIZE)
+    assert error.value.status == 409
+    assert sha256(blob) == digest == hashlib.sha256(b"b" * SIZE).hexdigest()
+
+
+def test_upload_is_sealed_once(upload):
+    write_chunk(upload.upload_id, 0, io.BytesIO(b"a" * SIZE), SIZE)
+    seal_upload(upload.upload_id)
+
+    with pytest.raises(UploadError) as error:
+        seal_upload(upload.upload_id)
+    assert error.value.status == 409
+
+
+def test_chunk_for_rejected_upload(upload):
+    # Rejecting an upload deletes its file
+    os.remove(upload.path)
+
+    with pytest.raises(UploadError) as error:
+        write_chunk(upload.upload_id, 0, io.BytesIO(b"a" * SIZE), SIZE)
+    assert error.value.status == 404
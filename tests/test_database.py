@@ -0,0 +1,140 @@
+"""Task leases in database.py, on an in-memory MongoDB shared by several workers."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import database
+from config import TASK_LEASE_SECONDS
+from database import Database, TASK_QUEUED, TASK_MERGING, TASK_FAILED
+
+
+class Clock:
+    """Stands in for database._utcnow so leases can expire without waiting"""
+
+    def __init__(self):
+        self.now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(database, "_utcnow", clock)
+    return clock
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Three Database instances, as in three bot processes, on one tasks collection"""
+    # The real client is created lazily and never used; keep it off the network
+    monkeypatch.setattr(database, "MONGO_URI", "mongodb://localhost:1")
+    client = AsyncMongoMockClient()
+    result = []
+    for _ in range(3):
+        db = Database()
+        db.client = client
+        db.db = client["test"]
+        db.users = db.db["users"]
+        db.tasks = db.db["tasks"]
+        result.append(db)
+    return result
+
+
+def expire_lease(clock):
+    clock.advance(TASK_LEASE_SECONDS + 1)
+
+
+def test_create_task_is_leased_to_creator(workers, clock):
+    a, b, _ = workers
+
+    async def scenario():
+        task_id = await a.create_task(1, {"video": "v.mp4"})
+        task = await a.get_task(task_id)
+        # Already running on a, so no other worker may take it
+        return task, await b.claim_next_task()
+
+    task, claimed = asyncio.run(scenario())
+    assert task["status"] == TASK_QUEUED
+    assert task["worker_id"] == a.worker_id
+    assert task["attempts"] == 1
+    assert claimed is None
+
+
+def test_only_one_worker_claims_a_task(workers, clock):
+    a, b, c = workers
+
+    async def scenario():
+        task_id = await a.create_task(1, {})
+        expire_lease(clock)
+        await b.requeue_stale_tasks()
+        claims = await asyncio.gather(b.claim_next_task(), c.claim_next_task())
+        return task_id, claims, await a.get_task(task_id)
+
+    task_id, claims, task = asyncio.run(scenario())
+    winners = [claim for claim in claims if claim is not None]
+    assert len(winners) == 1
+    assert str(winners[0]["_id"]) == task_id
+    assert task["worker_id"] in (b.worker_id, c.worker_id)
+
+
+def test_heartbeat_keeps_lease(workers, clock):
+    a, b, _ = workers
+
+    async def scenario():
+        task_id = await a.create_task(1, {})
+        await a.update_task(task_id, {"status": TASK_MERGING})
+        clock.advance(TASK_LEASE_SECONDS - 1)
+        await a.heartbeat_tasks()
+        clock.advance(TASK_LEASE_SECONDS - 1)
+        return await b.requeue_stale_tasks(), await b.get_task(task_id)
+
+    requeued, task = asyncio.run(scenario())
+    assert requeued == 0
+    assert task["worker_id"] == a.worker_id
+
+
+def test_expired_heartbeat_requeues_task(workers, clock):
+    a, b, _ = workers
+
+    async def scenario():
+        task_id = await a.create_task(1, {})
+        await a.update_task(task_id, {"status": TASK_MERGING})
+        await a.heartbeat_tasks()
+        # a stops renewing, e.g. because the process died
+        expire_lease(clock)
+        requeued = await b.requeue_stale_tasks()
+        return requeued, await b.get_task(task_id)
+
+    requeued, task = asyncio.run(scenario())
+    assert requeued == 1
+    assert task["status"] == TASK_QUEUED
+    assert task["worker_id"] is None
+
+
+def test_attempts_count_up_until_task_fails(workers, clock):
+    a, b, _ = workers
+
+    async def scenario():
+        task_id = await a.create_task(1, {})
+        attempts = []
+        for _ in range(3):
+            expire_lease(clock)
+            await b.requeue_stale_tasks(max_attempts=3)
+            task = await b.claim_next_task()
+            if task is None:
+                break
+            attempts.append(task["attempts"])
+        return attempts, await b.get_task(task_id)
+
+    attempts, task = asyncio.run(scenario())
+    assert attempts == [2, 3]
+    assert task["status"] == TASK_FAILED
+    assert task["error"] == "Interrupted 3 times"
+    assert "expires_at" in task
@@ -0,0 +1,131 @@
+"""delivery.send_output's Range and conditional request handling, through a Flask test client."""
+import os
+import hashlib
+
+import pytest
+from flask import Flask
+from werkzeug.http import http_date
+
+import delivery
+from result_cache import share_digest
+
+PAYLOAD = os.urandom(10000)
+
+
+@pytest.fixture
+def output(tmp_path):
+    path = tmp_path / "merged.mp4"
+    path.write_bytes(PAYLOAD)
+    return str(path)
+
+
+@pytest.fixture
+def client(output, monkeypatch):
+    monkeypatch.setattr(delivery, "DELIVERY_OFFLOAD", None)
+    app = Flask(__name__)
+    app.add_url_rule("/output", "output", lambda: delivery.send_output(output), methods=["GET", "HEAD"])
+    return app.test_client()
+
+
+def size_etag(path):
+    stat = os.stat(path)
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def test_full_download(client, output):
+    response = client.get("/output")
+
+    assert response.status_code == 200
+    assert response.data == PAYLOAD
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] == size_etag(output)
+    assert "Content-Range" not in response.headers
+
+
+def test_shared_digest_is_the_etag(client, output):
+    share_digest(output)
+
+    response = client.get("/output")
+
+    assert response.headers["ETag"] == f'"{hashlib.sha256(PAYLOAD).hexdigest()}"'
+
+
+def test_byte_range(client):
+    response = client.get("/output", headers={"Range": "bytes=100-199"})
+
+    assert response.status_code == 206
+    assert response.data == PAYLOAD[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(PAYLOAD)}"
+    assert response.headers["Content-Length"] == "100"
+
+
+def test_suffix_range(client):
+    response = client.get("/output", headers={"Range": "bytes=-500"})
+
+    assert response.status_code == 206
+    assert response.data == PAYLOAD[-500:]
+    assert response.headers["Content-Range"] == f"bytes {len(PAYLOAD) - 500}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}"
+
+
+def test_unsatisfiable_range(client):
+    response = client.get("/output", headers={"Range": f"bytes={len(PAYLOAD)}-"})
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(PAYLOAD)}"
+    assert response.data == b""
+
+
+def test_multiple_ranges_get_whole_file(client):
+    response = client.get("/output", headers={"Range": "bytes=0-9,20-29"})
+
+    assert response.status_code == 200
+    assert response.data == PAYLOAD
+
+
+def test_if_range_with_current_etag_resumes(client, output):
+    response = client.get("/output", headers={"Range": "bytes=5000-", "If-Range": size_etag(output)})
+
+    assert response.status_code == 206
+    assert response.data == PAYLOAD[5000:]
+
+
+def test_stale_if_range_sends_whole_file(client, output):
+    # The client's partial copy came from an earlier file
+    for if_range in ('"0-0"', http_date(os.stat(output).st_mtime - 3600)):
+        response = client.get("/output", headers={"Range": "bytes=5000-", "If-Range": if_range})
+
+        assert response.status_code == 200
+        assert response.data == PAYLOAD
+
+
+def test_if_none_match_not_modified(client, output):
+    response = client.get("/output", headers={"If-None-Match": size_etag(output)})
+
+    assert response.status_code == 304
+    assert response.data == b""
+    assert client.get("/output", headers={"If-None-Match": '"0-0"'}).status_code == 200
+
+
+def test_if_modified_since_not_modified(client, output):
+    response = client.get("/output", headers={"If-Modified-Since": http_date(os.stat(output).st_mtime)})
+
+    assert response.status_code == 304
+
+
+def test_head_sends_no_body(client):
+    response = client.head("/output", headers={"Range": "bytes=-500"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Length"] == "500"
+    assert response.data == b""
+
+
+def test_offload_leaves_ranges_to_proxy(client, output, monkeypatch):
+    monkeypatch.setattr(delivery, "DELIVERY_OFFLOAD", "x-sendfile")
+
+    response = client.get("/output", headers={"Range": "bytes=-500"})
+
+    assert response.status_code == 200
+    assert response.headers["X-Sendfile"] == os.path.abspath(output)
+    assert "Content-Range" not in response.headers
+    assert response.data == b""
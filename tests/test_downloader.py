@@ -0,0 +1,203 @@
+"""Downloader against a real HTTP server on localhost that answers byte ranges."""
+import os
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import downloader as downloader_module
+from downloader import Downloader, DownloadError
+
+PART_SIZE = 64 * 1024
+PAYLOAD = os.urandom(10 * PART_SIZE + 123)
+
+
+class RangeServer:
+    """Serves PAYLOAD with Range support; fail() scripts errors for given offsets"""
+
+    def __init__(self):
+        self.requests = []  # (start, end) of each range request
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0
+        self._failures = {}  # start offset -> list of actions: an HTTP status or "truncate"
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self.url = f"http://127.0.0.1:{self._httpd.server_port}/file.bin"
+
+    def fail(self, start, *actions):
+        self._failures.setdefault(start, []).extend(actions)
+
+    def _next_action(self, start):
+        with self._lock:
+            actions = self._failures.get(start)
+            return actions.pop(0) if actions else None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                start, end = self._range()
+                with server._lock:
+                    server.requests.append((start, end))
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    time.sleep(server.delay)
+                    self._respond(start, end, server._next_action(start))
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def _range(self):
+                header = self.headers.get("Range")
+                if not header:
+                    return None, None
+                first, _, last = header.removeprefix("bytes=").partition("-")
+                return int(first), min(int(last) + 1, len(PAYLOAD))
+
+            def _respond(self, start, end, action):
+                if isinstance(action, int):
+                    self.send_response(action)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if start is None:
+                    start, end = 0, len(PAYLOAD)
+                    self.send_response(200)
+                else:
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(PAYLOAD)}")
+                body = PAYLOAD[start:end]
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if action == "truncate":
+                    # Promise the whole range, send half and hang up
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = RangeServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def quick_backoff(monkeypatch):
+    monkeypatch.setattr(downloader_module, "BACKOFF_BASE", 0.01)
+
+
+def run_download(tmp_path, url, connections=4, retries=3, size=len(PAYLOAD), key="file"):
+    """Download url into tmp_path with a fresh Downloader; returns the destination path"""
+    loader = Downloader(directory=str(tmp_path / "partial"), connections=connections, part_size=PART_SIZE,
+                        retries=retries, timeout=5)
+    destination = str(tmp_path / "file.bin")
+
+    async def download():
+        try:
+            return await loader.download(url, destination, size=size, key=key)
+        finally:
+            await loader.close()
+
+    return asyncio.run(download())
+
+
+def test_downloads_parts_in_parallel(tmp_path, server):
+    server.delay = 0.05
+    path = run_download(tmp_path, server.url, connections=4)
+
+    with open(path, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert sorted(server.requests) == [(start, min(start + PART_SIZE, len(PAYLOAD)))
+                                       for start in range(0, len(PAYLOAD), PART_SIZE)]
+    assert 1 < server.max_active <= 4
+    # Nothing is left behind once the file is in place
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_probes_size_when_unknown(tmp_path, server):
+    path = run_download(tmp_path, server.url, size=None)
+
+    with open(path, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert server.requests[0] == (0, 1)
+
+
+def test_resumes_from_sidecar(tmp_path, server):
+    # One connection takes the parts in order; the fourth is refused for good
+    server.fail(3 * PART_SIZE, 403)
+    with pytest.raises(httpx.HTTPStatusError):
+        run_download(tmp_path, server.url, connections=1)
+
+    with open(tmp_path / "partial" / "file.json") as f:
+        assert json.load(f)["done"] == [0, 1, 2]
+
+    server.requests.clear()
+    path = run_download(tmp_path, server.url, connections=1)
+
+    with open(path, "rb") as f:
+        assert f.read() == PAYLOAD
+    # Only the parts missing from the first attempt are fetched again
+    assert min(start for start, _ in server.requests) == 3 * PART_SIZE
+    assert len(server.requests) == 8
+
+
+def test_retries_transient_errors(tmp_path, server):
+    server.fail(PART_SIZE, 503, 429)
+    path = run_download(tmp_path, server.url, connections=2)
+
+    with open(path, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert server.requests.count((PART_SIZE, 2 * PART_SIZE)) == 3
+
+
+def test_retry_continues_from_last_byte(tmp_path, server):
+    server.fail(0, "truncate")
+    path = run_download(tmp_path, server.url, connections=1)
+
+    with open(path, "rb") as f:
+        assert f.read() == PAYLOAD
+    # The second request for the first part only asks for what is still missing
+    assert server.requests[:2] == [(0, PART_SIZE), (PART_SIZE // 2, PART_SIZE)]
+
+
+def test_gives_up_after_retries(tmp_path, server):
+    server.fail(0, 503, 503, 503)
+    with pytest.raises(DownloadError):
+        run_download(tmp_path, server.url, connections=1, retries=2)
+
+    assert server.requests.count((0, PART_SIZE)) == 3
+
+
+def test_client_error_fails_immediately(tmp_path, server):
+    server.fail(0, 404)
+    with pytest.raises(httpx.HTTPStatusError):
+        run_download(tmp_path, server.url, connections=1)
+
+    assert server.requests == [(0, PART_SIZE)]
+    assert not os.path.exists(tmp_path / "file.bin")
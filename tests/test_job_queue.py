@@ -0,0 +1,102 @@
+"""FairScheduler ordering and JobQueue refusing work once it is full."""
+import threading
+
+import pytest
+
+from job_queue import CapacityLimiter, FairScheduler, Job, JobQueue, QueueFullError, DONE, RUNNING
+
+
+def job(owner):
+    return Job(None, owner=owner)
+
+
+def drain(scheduler):
+    jobs = []
+    while (next_job := scheduler.pop()) is not None:
+        jobs.append(next_job)
+    return jobs
+
+
+def test_owners_are_served_round_robin():
+    scheduler = FairScheduler(max_running_per_owner=10)
+    a1, a2, a3, b1, c1, c2 = job("a"), job("a"), job("a"), job("b"), job("c"), job("c")
+    for queued in (a1, a2, a3, b1, c1, c2):
+        scheduler.push(queued)
+
+    # One user's backlog doesn't hold back the others
+    assert drain(scheduler) == [a1, b1, c1, a2, c2, a3]
+    assert len(scheduler) == 0
+
+
+def test_positions_match_pop_order():
+    scheduler = FairScheduler(max_running_per_owner=10)
+    jobs = [job("a"), job("a"), job("a"), job("b"), job("c"), job("c")]
+    for queued in jobs:
+        scheduler.push(queued)
+    positions = {queued: scheduler.position(queued) for queued in jobs}
+
+    assert [positions[started] for started in drain(scheduler)] == list(range(len(jobs)))
+    assert scheduler.position(jobs[0]) is None
+
+
+def test_owner_at_running_cap_is_skipped():
+    scheduler = FairScheduler(max_running_per_owner=1)
+    a1, a2, b1 = job("a"), job("a"), job("b")
+    for queued in (a1, a2, b1):
+        scheduler.push(queued)
+
+    assert scheduler.pop() is a1
+    assert scheduler.pop() is b1
+    # a2 waits for a1 even though a worker is free
+    assert scheduler.pop() is None
+    scheduler.done(a1)
+    assert scheduler.pop() is a2
+    assert scheduler.running_for("a") == 1
+
+
+@pytest.fixture
+def blocked_queue(tmp_path):
+    """A one-worker queue whose worker is busy until release is set"""
+    limiter = CapacityLimiter(1, directory=str(tmp_path / "slots"))
+    queue = JobQueue(max_workers=1, limiter=limiter, max_queued_per_owner=2, max_queue_length=3)
+    release = threading.Event()
+    started = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait(5)
+
+    running = queue.submit(hold, owner="running")
+    assert started.wait(5)
+    assert running.status == RUNNING
+    yield queue, release
+    release.set()
+
+
+def test_refuses_owner_with_too_many_waiting(blocked_queue):
+    queue, release = blocked_queue
+    waiting = [queue.submit(lambda: None, owner="a") for _ in range(2)]
+
+    with pytest.raises(QueueFullError) as error:
+        queue.submit(lambda: None, owner="a")
+    assert "too many merges waiting" in str(error.value)
+    # Other users still get in
+    waiting.append(queue.submit(lambda: None, owner="b"))
+
+    release.set()
+    for queued in waiting:
+        assert queued.wait(5)
+        assert queued.status == DONE
+
+
+def test_refuses_everyone_when_queue_is_full(blocked_queue):
+    queue, _ = blocked_queue
+    for owner in ("a", "b", "c"):
+        queue.submit(lambda: None, owner=owner)
+
+    with pytest.raises(QueueFullError) as error:
+        queue.submit(lambda: None, owner="d")
+    assert "busy" in str(error.value)
+    # Three jobs waiting for one worker, about a minute each
+    assert error.value.retry_after == 180
+    assert queue.pending_count() == 3
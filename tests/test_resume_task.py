@@ -0,0 +1,169 @@
+"""bot.resume_task picking up a merge whose process died while its files were downloading."""
+import os
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import bot
+import database
+import media_processor as media_processor_module
+from blob_store import BlobStore
+from config import TASK_LEASE_SECONDS
+from database import Database, TASK_DOWNLOADING
+from storage import StorageManager
+from user_state import UserStateCache
+
+USER_ID = 42
+CHAT_ID = 4242
+
+
+class Media:
+    """The file_id/file_unique_id pair of a message's Video, Audio or Document"""
+
+    def __init__(self, file_unique_id):
+        self.file_id = f"id-{file_unique_id}"
+        self.file_unique_id = file_unique_id
+
+
+class FakeBot:
+    """Records messages; get_file must not be reached when the blob store has the file"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+    async def get_file(self, *args, **kwargs):
+        raise AssertionError("the file should come from the blob store")
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.user_data = defaultdict(dict)
+
+
+class Context:
+    def __init__(self, application, user_id):
+        self.bot = application.bot
+        self.user_data = application.user_data[user_id]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [datetime(2024, 1, 1, tzinfo=timezone.utc)]
+    monkeypatch.setattr(database, "_utcnow", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """The process that died and the one taking over, on one tasks collection"""
+    monkeypatch.setattr(database, "MONGO_URI", "mongodb://localhost:1")
+    client = AsyncMongoMockClient()
+    result = []
+    for _ in range(2):
+        db = Database()
+        db.client = client
+        db.db = client["test"]
+        db.users = db.db["users"]
+        db.tasks = db.db["tasks"]
+        result.append(db)
+    return result
+
+
+@pytest.fixture
+def blobs(tmp_path, monkeypatch):
+    blobs = BlobStore(directory=str(tmp_path / "blobs"), enabled=True)
+    monkeypatch.setattr(media_processor_module, "blob_store", blobs)
+    monkeypatch.setattr(bot, "storage", StorageManager(directory=str(tmp_path), min_free=0))
+    return blobs
+
+
+def use_worker(monkeypatch, db):
+    monkeypatch.setattr(bot, "db", db)
+    monkeypatch.setattr(bot, "user_states", UserStateCache(db))
+
+
+def stored(blobs, tmp_path, name, file_unique_id):
+    """A file Telegram sent before, kept in the blob store"""
+    path = tmp_path / f"earlier-{name}"
+    path.write_bytes(os.urandom(1000))
+    blobs.ingest(str(path), telegram_id=file_unique_id)
+    return str(path)
+
+
+def take_over(clock, dead, alive):
+    """dead stops renewing its leases; alive requeues and claims its task"""
+    async def scenario():
+        clock[0] += timedelta(seconds=TASK_LEASE_SECONDS + 1)
+        await alive.requeue_stale_tasks()
+        return await alive.claim_next_task()
+
+    return scenario
+
+
+def test_resumes_task_interrupted_downloading_video(tmp_path, monkeypatch, workers, clock, blobs):
+    dead, alive = workers
+    earlier = stored(blobs, tmp_path, "video.mp4", "video-1")
+    video_path = str(tmp_path / "video.mp4")
+
+    async def scenario():
+        # The video's download starts, and the process dies before it lands
+        use_worker(monkeypatch, dead)
+        await bot.start_merge_task(Context(FakeApplication(), USER_ID), CHAT_ID, USER_ID,
+                                   Media("video-1"), video_path)
+        task = await take_over(clock, dead, alive)()
+
+        use_worker(monkeypatch, alive)
+        application = FakeApplication()
+        await bot.resume_task(application, task)
+        return application, await alive.get_task(str(task["_id"]))
+
+    application, task = asyncio.run(scenario())
+    assert task["status"] == TASK_DOWNLOADING
+    assert task["worker_id"] == alive.worker_id
+    assert task["attempts"] == 2
+    assert os.path.samefile(video_path, earlier)
+    # The conversation waits for the audio again, still tied to the task
+    assert application.user_data[USER_ID] == {bot.STATE: bot.AWAITING_AUDIO, bot.VIDEO_PATH: video_path,
+                                              bot.TASK_ID: str(task["_id"])}
+    assert "send an audio file" in application.bot.messages[-1][1]
+
+
+def test_resumes_task_interrupted_downloading_audio(tmp_path, monkeypatch, workers, clock, blobs):
+    dead, alive = workers
+    earlier_video = stored(blobs, tmp_path, "video.mp4", "video-1")
+    earlier_audio = stored(blobs, tmp_path, "audio.mp3", "audio-1")
+    video_path, audio_path = str(tmp_path / "video.mp4"), str(tmp_path / "audio.mp3")
+    merges = []
+
+    async def merge_and_send(context, chat_id, user_id, status_message, video_path, audio_path, output_path,
+                             fast_mode, task_id, timer, audio_options=None, keep_original=False):
+        merges.append((video_path, audio_path, output_path, task_id))
+
+    monkeypatch.setattr(bot, "merge_and_send", merge_and_send)
+
+    async def scenario():
+        # Both downloads were recorded; neither file made it to disk before the crash
+        use_worker(monkeypatch, dead)
+        context = Context(FakeApplication(), USER_ID)
+        await bot.start_merge_task(context, CHAT_ID, USER_ID, Media("video-1"), video_path)
+        await bot.set_task_status(context.user_data[bot.TASK_ID], TASK_DOWNLOADING, audio_path=audio_path,
+                                  audio_file=bot.telegram_source(Media("audio-1")))
+        task = await take_over(clock, dead, alive)()
+
+        use_worker(monkeypatch, alive)
+        await bot.resume_task(FakeApplication(), task)
+        return str(task["_id"])
+
+    task_id = asyncio.run(scenario())
+    assert os.path.samefile(video_path, earlier_video)
+    assert os.path.samefile(audio_path, earlier_audio)
+    [(merged_video, merged_audio, output_path, merged_task)] = merges
+    assert (merged_video, merged_audio, merged_task) == (video_path, audio_path, task_id)
+    assert output_path.startswith(os.path.join("temp_files", f"merged_{USER_ID}_"))
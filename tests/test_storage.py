@@ -0,0 +1,123 @@
+"""StorageManager reservations, references and leases in a private temp directory."""
+import os
+import time
+
+import pytest
+
+import storage as storage_module
+from blob_store import BlobStore
+from storage import StorageManager, StorageFullError
+
+QUOTA = 1000
+
+
+@pytest.fixture(autouse=True)
+def private_state(tmp_path, monkeypatch):
+    """Keep the sweep's blob store and upload states away from the real temp directory"""
+    monkeypatch.setattr(storage_module, "blob_store", BlobStore(directory=str(tmp_path / "blobs"), enabled=True))
+    monkeypatch.setattr(storage_module, "UPLOAD_STATE_DIRECTORY", str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def directory(tmp_path):
+    directory = tmp_path / "temp"
+    directory.mkdir()
+    return str(directory)
+
+
+def manager(directory, ttl=60):
+    return StorageManager(directory=directory, ttl=ttl, quota=QUOTA, min_free=0, sweep_interval=3600)
+
+
+def write(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_reserve_refuses_past_quota(directory):
+    storage = manager(directory)
+    storage.reserve(600, "first")
+
+    # Both would fit on their own, but not next to each other
+    with pytest.raises(StorageFullError):
+        storage.reserve(600, "second")
+    storage.unreserve("first")
+    assert storage.reserve(600, "second") == "second"
+
+
+def test_reservation_becomes_usage_once_written(directory):
+    storage = manager(directory)
+    path = storage.allocate("user", "video", "mp4", size=600)
+    with pytest.raises(StorageFullError):
+        storage.reserve(600)
+
+    write(path, 600)
+    storage.track(path)
+
+    # Counted once: as usage, no longer as a reservation
+    assert storage._reserved == {}
+    assert storage._usage == 600
+    storage.reserve(400)
+    with pytest.raises(StorageFullError):
+        storage.reserve(1)
+
+
+def test_discard_releases_reservation(directory):
+    storage = manager(directory)
+    path = storage.allocate("user", "video", "mp4", size=600)
+
+    storage.discard([path])
+
+    storage.reserve(1000)
+
+
+def test_referenced_file_outlives_its_ttl(directory):
+    storage = manager(directory, ttl=0.1)
+    path = os.path.join(directory, "video.mp4")
+    write(path, 100)
+    storage.track(path)
+    storage.acquire(path)
+    storage.acquire(path)
+    time.sleep(0.2)
+
+    storage.sweep()
+    assert os.path.exists(path)
+    storage.release(path)
+    assert os.path.exists(path)
+    # Expired, and the last reference is gone
+    storage.release(path)
+    assert not os.path.exists(path)
+    assert storage._usage == 0
+
+
+def test_sweep_removes_file_released_before_expiry(directory):
+    storage = manager(directory, ttl=0.1)
+    path = os.path.join(directory, "video.mp4")
+    write(path, 100)
+    storage.track(path)
+    storage.acquire(path)
+
+    storage.release(path)
+    assert os.path.exists(path)
+    time.sleep(0.2)
+    assert storage.sweep() == 1
+    assert not os.path.exists(path)
+    assert not os.path.exists(storage._lease_path(path))
+
+
+def test_lease_protects_file_from_other_processes(directory):
+    owner, other = manager(directory), manager(directory)
+    path = os.path.join(directory, "video.mp4")
+    write(path, 100)
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    # other doesn't know the file, but sees owner's fresh lease
+    owner.acquire(path)
+    other.sweep()
+    assert os.path.exists(path)
+
+    # Once the lease goes stale the leftover is swept
+    os.utime(owner._lease_path(path), (old, old))
+    other.sweep()
+    assert not os.path.exists(path)
@@ -0,0 +1,180 @@
+"""MediaProcessor.download_file against a stand-in Bot API server on localhost."""
+import os
+import json
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import pytest
+from telegram import Bot
+
+import media_processor as media_processor_module
+from blob_store import BlobStore
+from downloader import Downloader
+from media_processor import MediaProcessor
+
+TOKEN = "123456:TEST"
+PAYLOAD = os.urandom(300 * 1024)
+FILE_UNIQUE_ID = "AgADtest"
+
+
+class BotApiServer:
+    """Answers getMe and getFile, and serves the file under /file/bot<token>/ with ranges"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path  # What getFile reports: absolute in local mode
+        self.available = True  # False once the file has expired on Telegram's side
+        self.requests = []
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self.url = f"http://127.0.0.1:{self._httpd.server_port}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                method = self.path.rpartition("/")[2]
+                server.requests.append(("POST", method))
+                if method == "getMe":
+                    result = {"id": 123456, "is_bot": True, "first_name": "Merge", "username": "merge_bot"}
+                elif method == "getFile":
+                    result = {"file_id": "file-1", "file_unique_id": FILE_UNIQUE_ID,
+                              "file_size": len(PAYLOAD), "file_path": server.file_path}
+                else:
+                    result = True
+                body = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # The token's colon arrives escaped
+                path = unquote(self.path)
+                server.requests.append(("GET", path, self.headers["Range"]))
+                if not server.available or path != f"/file/bot{TOKEN}/{server.file_path}":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                first, _, last = self.headers["Range"].removeprefix("bytes=").partition("-")
+                start, end = int(first), min(int(last) + 1, len(PAYLOAD))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(PAYLOAD)}")
+                self.send_header("Content-Length", str(end - start))
+                self.end_headers()
+                self.wfile.write(PAYLOAD[start:end])
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def stores(tmp_path, monkeypatch):
+    """A private blob store and downloader, so nothing lands in the real temp directory"""
+    blobs = BlobStore(directory=str(tmp_path / "blobs"), enabled=True)
+    monkeypatch.setattr(media_processor_module, "blob_store", blobs)
+    monkeypatch.setattr(media_processor_module, "downloader",
+                        Downloader(directory=str(tmp_path / "partial"), part_size=64 * 1024))
+    return blobs
+
+
+def start_server(file_path):
+    server = BotApiServer(file_path)
+    server.start()
+    return server
+
+
+def fetch(server, destination, local_mode):
+    """getFile from the stand-in server, configured like bot.main(), then download_file()"""
+    bot = Bot(TOKEN, base_url=f"{server.url}/bot", base_file_url=f"{server.url}/file/bot",
+              local_mode=local_mode)
+
+    async def run():
+        try:
+            async with bot:
+                file = await bot.get_file("file-1")
+                return await MediaProcessor.download_file(file, destination)
+        finally:
+            await media_processor_module.downloader.close()
+
+    return asyncio.run(run())
+
+
+def test_local_mode_links_file_from_server_disk(tmp_path):
+    # A --local server stores files on its own disk and reports absolute paths
+    server_file = tmp_path / "bot-api" / "videos" / "file_1.mp4"
+    server_file.parent.mkdir(parents=True)
+    server_file.write_bytes(PAYLOAD)
+    destination = str(tmp_path / "video.mp4")
+    server = start_server(str(server_file))
+    try:
+        assert fetch(server, destination, local_mode=True)
+    finally:
+        server.stop()
+
+    assert os.path.samefile(destination, server_file)
+    assert ("POST", "getFile") in server.requests
+    assert not [request for request in server.requests if request[0] == "GET"]
+
+
+def test_remote_mode_downloads_over_http(tmp_path):
+    destination = str(tmp_path / "video.mp4")
+    server = start_server("videos/file_1.mp4")
+    try:
+        assert fetch(server, destination, local_mode=False)
+    finally:
+        server.stop()
+
+    with open(destination, "rb") as f:
+        assert f.read() == PAYLOAD
+    # Fetched from the configured base file URL, in range requests
+    downloads = [request[1] for request in server.requests if request[0] == "GET"]
+    assert downloads and set(downloads) == {f"/file/bot{TOKEN}/videos/file_1.mp4"}
+    assert len(downloads) > 1
+
+
+def test_downloaded_file_is_reused_without_telegram(tmp_path):
+    destination = str(tmp_path / "video.mp4")
+    server = start_server("videos/file_1.mp4")
+    try:
+        assert fetch(server, destination, local_mode=False)
+    finally:
+        server.stop()
+
+    class Video:
+        file_unique_id = FILE_UNIQUE_ID
+
+    again = str(tmp_path / "again.mp4")
+    assert asyncio.run(MediaProcessor.fetch_stored(Video(), again))
+    assert os.path.samefile(again, destination)
+
+
+def test_missing_file_fails_download(tmp_path):
+    destination = str(tmp_path / "video.mp4")
+    server = start_server("videos/file_1.mp4")
+    server.available = False
+    try:
+        assert not fetch(server, destination, local_mode=False)
+    finally:
+        server.stop()
+
+    assert not os.path.exists(destination)
+    # A 404 is final: no range is asked for twice
+    ranges = [request[2] for request in server.requests if request[0] == "GET"]
+    assert ranges and len(ranges) == len(set(ranges))
@@ -0,0 +1,73 @@
+"""
+Per-user settings and conversation state for the bot, cached in front of Mongo.
+
+Reads are served from an in-process LRU cache, so handling a message doesn't
+cost a database round trip; entries are re-read from Mongo after
+USER_CACHE_TTL so replicas pick up each other's changes. Updates change the
+cache at once and are written through to Mongo in batches: everything
+updated within USER_FLUSH_INTERVAL goes out as one bulk upsert.
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, USER_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class UserStateCache:
+    """LRU+TTL cache of user documents, written back to a Database in batches"""
+
+    def __init__(self, db, max_entries=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, flush_interval=USER_FLUSH_INTERVAL):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._flush_task = None
+
+    async def get(self, user_id):
+        """The user's settings document (defaults are created on first use)"""
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+        user = dict(await self.db.get_user_settings(user_id))
+        user.pop("_id", None)
+        # Changes not written yet are newer than what Mongo has
+        user.update(self._pending.get(user_id, {}))
+        self._entries[user_id] = (time.monotonic(), user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return user
+
+    async def update(self, user_id, **fields):
+        """Set fields for the user now, and in Mongo with the next batch"""
+        user = await self.get(user_id)
+        user.update(fields)
+        self._pending.setdefault(user_id, {}).update(fields)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Write every pending update in one bulk upsert"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return True
+        if await self.db.upsert_users(pending):
+            return True
+        # Keep the failed batch, under anything updated since, for the next try
+        for user_id, fields in pending.items():
+            self._pending[user_id] = {**fields, **self._pending.get(user_id, {})}
+        if self._flush_task is None or self._flush_task.done() or self._flush_task is asyncio.current_task():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return False
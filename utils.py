@@ -1,4 +1,5 @@
 import os
+import re
 import logging
 from functools import wraps
 
@@ -44,4 +45,52 @@ def check_file_exists(file_path):
     if os.path.getsize(file_path) == 0:
         return False
     
-    return True
\ No newline at end of file
+    return True
+
+def format_duration(seconds):
+    """Format a number of seconds as e.g. '1h 02m', '3m 05s' or '42s'"""
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+def format_size(num_bytes):
+    """Format a byte count as e.g. '1.5 GB'"""
+    size = float(num_bytes)
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+
+def normalize_language(code):
+    """ISO 639-2 language tag for stream metadata, or None if code isn't one"""
+    # MP4 only stores three-letter codes, so map the common two-letter ones
+    two_letter = {
+        'en': 'eng', 'hi': 'hin', 'ja': 'jpn', 'es': 'spa', 'fr': 'fra', 'de': 'deu',
+        'it': 'ita', 'pt': 'por', 'ru': 'rus', 'zh': 'zho', 'ko': 'kor', 'ar': 'ara',
+        'ta': 'tam', 'te': 'tel', 'bn': 'ben', 'ml': 'mal', 'mr': 'mar', 'ur': 'urd',
+    }
+    code = (code or '').strip().lower()
+    if len(code) == 2:
+        return two_letter.get(code)
+    if len(code) == 3 and code.isalpha():
+        return code
+    return None
+
+# Outputs carry the start of their job's id, so two merges never share a path
+OUTPUT_TAG_LENGTH = 12
+OUTPUT_TAG_PATTERN = re.compile(r"^[0-9a-f]{%d}_" % OUTPUT_TAG_LENGTH)
+
+def tag_output_path(output_path, job_id):
+    """output_path with job_id in the filename, unique to the merge writing it"""
+    directory, filename = os.path.split(output_path)
+    return os.path.join(directory, f"{job_id[:OUTPUT_TAG_LENGTH]}_{filename}")
+
+def output_display_name(path):
+    """Filename of an output as the user named it, without its job tag"""
+    return OUTPUT_TAG_PATTERN.sub('', os.path.basename(path), count=1)